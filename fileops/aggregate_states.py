@@ -0,0 +1,274 @@
+#!/usr/bin/python3
+#
+# Streaming aggregate states for file_select_ops.py, beyond SUM & COUNT.
+#
+# Every state takes the values of a group one at a time with add(), and two
+# states of the same group can be combined with merge(), so they work with the
+# chunked, parallel & spilling modes of file_select_ops.py. The memory used by
+# a state is bounded no matter how many rows its group has:
+#   min, max, avg       A couple of numbers
+#   count_distinct      HyperLogLog sketch, exact for small groups
+#   pNN, median         KLL quantile sketch, exact for small groups
+#
+
+import abc
+import argparse
+import math
+import re
+from typing import Callable, List, Optional
+
+from . import file_ops_common
+
+# Aggregate functions that are plain numbers added up, for which no state is needed
+NUMERIC_FUNCTIONS = ('sum', 'count')
+FUNCTIONS = NUMERIC_FUNCTIONS + ('min', 'max', 'avg', 'count_distinct', 'median', 'pNN')
+
+# HyperLogLog registers are indexed with the low HLL_PRECISION bits of the
+# hashes: 4096 one byte registers, for a standard error of about 1.6%
+HLL_PRECISION = 12
+# Distinct hashes are kept as is, and counted exactly, up to that many
+_HLL_EXACT_LIMIT = 64
+# Accuracy parameter of the KLL sketch: the rank error is about 1.7 / KLL_K
+KLL_K = 200
+
+_PERCENTILE = re.compile(r'^p(\d+(?:\.\d+)?)$')
+
+
+class AggregateState(abc.ABC):
+    ''' Base class of the aggregate states. Converts to the output value '''
+    __slots__ = ()
+
+    @abc.abstractmethod
+    def add(self, value: str) -> None:
+        ''' Add a value of the group '''
+
+    @abc.abstractmethod
+    def merge(self, other: 'AggregateState') -> None:
+        ''' Add the values of another state of the same group '''
+
+    @abc.abstractmethod
+    def result(self):
+        ''' Output value of the group '''
+
+    def __str__(self) -> str:
+        return str(self.result())
+
+
+class MinState(AggregateState):
+    __slots__ = ('value',)
+
+    def __init__(self) -> None:
+        self.value: Optional[float] = None
+
+    def add(self, value: str) -> None:
+        value = float(value)
+        if self.value is None or value < self.value:
+            self.value = value
+
+    def merge(self, other: 'MinState') -> None:
+        if other.value is not None and (self.value is None or other.value < self.value):
+            self.value = other.value
+
+    def result(self) -> Optional[float]:
+        return self.value
+
+
+class MaxState(AggregateState):
+    __slots__ = ('value',)
+
+    def __init__(self) -> None:
+        self.value: Optional[float] = None
+
+    def add(self, value: str) -> None:
+        value = float(value)
+        if self.value is None or value > self.value:
+            self.value = value
+
+    def merge(self, other: 'MaxState') -> None:
+        if other.value is not None and (self.value is None or other.value > self.value):
+            self.value = other.value
+
+    def result(self) -> Optional[float]:
+        return self.value
+
+
+class AvgState(AggregateState):
+    __slots__ = ('total', 'count')
+
+    def __init__(self) -> None:
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, value: str) -> None:
+        self.total += float(value)
+        self.count += 1
+
+    def merge(self, other: 'AvgState') -> None:
+        self.total += other.total
+        self.count += other.count
+
+    def result(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+
+class DistinctState(AggregateState):
+    ''' Approximate number of distinct values, with a HyperLogLog sketch.
+    Values are hashed with file_ops_common.hash_key, which is the same in
+    every process. Until there are more than _HLL_EXACT_LIMIT distinct
+    hashes, they are kept in a set and the count is exact '''
+    __slots__ = ('hashes', 'registers')
+
+    def __init__(self) -> None:
+        self.hashes: Optional[set] = set()
+        self.registers: Optional[bytearray] = None
+
+    def add(self, value: str) -> None:
+        digest = file_ops_common.hash_key(value)
+        if self.hashes is not None:
+            self.hashes.add(digest)
+            if len(self.hashes) > _HLL_EXACT_LIMIT:
+                self._to_registers()
+        else:
+            self._add_hash(digest)
+
+    def _add_hash(self, digest: int) -> None:
+        index = digest & ((1 << HLL_PRECISION) - 1)
+        # Position of the first 1 bit in the remaining bits of the hash
+        rank = 64 - HLL_PRECISION - (digest >> HLL_PRECISION).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def _to_registers(self) -> None:
+        self.registers = bytearray(1 << HLL_PRECISION)
+        for digest in self.hashes:
+            self._add_hash(digest)
+        self.hashes = None
+
+    def merge(self, other: 'DistinctState') -> None:
+        if other.hashes is not None:
+            for digest in other.hashes:
+                if self.hashes is not None:
+                    self.hashes.add(digest)
+                else:
+                    self._add_hash(digest)
+            if self.hashes is not None and len(self.hashes) > _HLL_EXACT_LIMIT:
+                self._to_registers()
+            return
+        if self.hashes is not None:
+            self._to_registers()
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def result(self) -> int:
+        if self.hashes is not None:
+            return len(self.hashes)
+        num_registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / num_registers)
+        estimate = alpha * num_registers ** 2 / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * num_registers and zeros:
+            # Small range correction: linear counting
+            estimate = num_registers * math.log(num_registers / zeros)
+        return int(round(estimate))
+
+
+class QuantileState(AggregateState):
+    ''' Approximate quantile, with a KLL sketch. The sketch is a stack of
+    compactors: when one is full, it is sorted and every other item is
+    promoted to the next one with twice the weight. Compaction alternates
+    between the odd & even items, so the output is reproducible. As long as
+    nothing has been compacted, the quantile is exact (nearest rank) '''
+    __slots__ = ('quantile', 'compactors', 'size', 'max_size', 'coin')
+
+    def __init__(self, quantile: float) -> None:
+        self.quantile = quantile
+        self.compactors: List[List[float]] = []
+        self.size = 0
+        self.max_size = 0
+        self.coin = 0
+        self._grow()
+
+    def _capacity(self, height: int) -> int:
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(KLL_K * (2.0 / 3) ** depth)) + 1
+
+    def _grow(self) -> None:
+        self.compactors.append([])
+        self.max_size = sum(self._capacity(height) for height in range(len(self.compactors)))
+
+    def add(self, value: str) -> None:
+        self.compactors[0].append(float(value))
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def _compress(self) -> None:
+        for height in range(len(self.compactors)):
+            compactor = self.compactors[height]
+            if len(compactor) < self._capacity(height):
+                continue
+            if height + 1 == len(self.compactors):
+                self._grow()
+            compactor.sort()
+            # An odd item out stays in the compactor
+            keep = compactor.pop() if len(compactor) % 2 else None
+            self.compactors[height + 1].extend(compactor[self.coin::2])
+            self.coin ^= 1
+            compactor[:] = [] if keep is None else [keep]
+            self.size = sum(len(c) for c in self.compactors)
+            if self.size < self.max_size:
+                break
+
+    def merge(self, other: 'QuantileState') -> None:
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for height, compactor in enumerate(other.compactors):
+            self.compactors[height].extend(compactor)
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.max_size:
+            self._compress()
+
+    def result(self) -> Optional[float]:
+        weighted = sorted((value, 1 << height)
+                          for height, compactor in enumerate(self.compactors)
+                          for value in compactor)
+        if not weighted:
+            return None
+        total = sum(weight for _, weight in weighted)
+        rank = max(1, math.ceil(self.quantile * total))
+        seen = 0
+        for value, weight in weighted:
+            seen += weight
+            if seen >= rank:
+                return value
+        return weighted[-1][0]
+
+
+def state_factory(agg_function: str) -> Callable[[], AggregateState]:
+    ''' Function creating the empty state of an aggregate function.
+    Raises ValueError for sum, count & unknown functions '''
+    if agg_function == 'min':
+        return MinState
+    if agg_function == 'max':
+        return MaxState
+    if agg_function == 'avg':
+        return AvgState
+    if agg_function == 'count_distinct':
+        return DistinctState
+    if agg_function == 'median':
+        return lambda: QuantileState(0.5)
+    match = _PERCENTILE.match(agg_function)
+    if match and float(match.group(1)) <= 100:
+        quantile = float(match.group(1)) / 100
+        return lambda: QuantileState(quantile)
+    raise ValueError('Invalid aggregate function: ' + agg_function)
+
+
+def check_function(agg_function: str) -> str:
+    ''' argparse type of the aggregate function option. Returns it lower cased '''
+    agg_function = agg_function.lower()
+    if agg_function not in NUMERIC_FUNCTIONS:
+        try:
+            state_factory(agg_function)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    return agg_function
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+#
+# Bloom filter of keys for file_intersection.py and file_diff.py
+#
+# A first pass over the right file adds its keys to the filter, which takes
+# about 10 bits per key. Left rows whose key isn't in the filter can't match
+# any right row, so they are dropped by the intersection, or output right away
+# by the diff, instead of being held in the hash table. Only the left rows
+# whose key may be in the right file are kept, so memory scales with the
+# number of matches rather than with the size of the left file.
+#
+# The number of keys isn't known beforehand, so the filter grows: when a
+# slice is full, a new one twice as big with half the error rate is added,
+# which keeps the overall error rate under DEFAULT_ERROR_RATE.
+#
+
+import math
+from typing import List, Optional
+
+from . import ingest
+
+DEFAULT_ERROR_RATE = 0.01
+# Number of keys of the first slice
+DEFAULT_CAPACITY = 1 << 20
+
+_HASH_MASK = (1 << 64) - 1
+
+
+class _Slice(object):
+    __slots__ = ('bits', 'num_bits', 'num_hashes', 'capacity', 'count')
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        # Optimal size & number of hash functions for that many keys
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) /
+                                             math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.capacity = capacity
+        self.count = 0
+
+
+class BloomFilter(object):
+    """Set of strings answering "maybe" or "definitely not", with a bounded
+    false positive rate. Keys are hashed with the built-in hash(), so a
+    filter is only valid in the process that built it"""
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY,
+                 error_rate: float = DEFAULT_ERROR_RATE) -> None:
+        # The error rates of the slices add up to at most error_rate
+        self.error_rate = error_rate
+        self.slices = [_Slice(capacity, error_rate / 2)]
+
+    def __len__(self) -> int:
+        """Number of keys added, counting the keys added several times"""
+        return sum(slice_.count for slice_ in self.slices)
+
+    def add(self, key: str) -> None:
+        current = self.slices[-1]
+        if current.count >= current.capacity:
+            current = _Slice(current.capacity * 2,
+                             self.error_rate / 2 ** (len(self.slices) + 1))
+            self.slices.append(current)
+        # Double hashing: the i-th position is h1 + i * h2
+        digest = hash(key) & _HASH_MASK
+        h1 = digest & 0xffffffff
+        h2 = (digest >> 32) | 1
+        bits = current.bits
+        num_bits = current.num_bits
+        for i in range(current.num_hashes):
+            position = (h1 + i * h2) % num_bits
+            bits[position >> 3] |= 1 << (position & 7)
+        current.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        digest = hash(key) & _HASH_MASK
+        h1 = digest & 0xffffffff
+        h2 = (digest >> 32) | 1
+        for slice_ in self.slices:
+            bits = slice_.bits
+            num_bits = slice_.num_bits
+            # Most keys that aren't in the filter miss on the first positions
+            for i in range(slice_.num_hashes):
+                position = (h1 + i * h2) % num_bits
+                if not bits[position >> 3] & (1 << (position & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def size_in_bytes(self) -> int:
+        return sum(len(slice_.bits) for slice_ in self.slices)
+
+
+def build_key_filter(file_path: str, delim: str, key_cols: List[int],
+                     lower_case: bool = False, quoted: bool = True,
+                     error_rate: float = DEFAULT_ERROR_RATE,
+                     capacity: Optional[int] = None) -> BloomFilter:
+    """Bloom filter of the keys of a delimited file, built like the keys of
+    file_ops_common.key_getter. Reads the columnar cache of the file if it is
+    fresh, and then sizes the filter for its number of rows"""
+    if capacity is None:
+        cache = ingest.load_cache(file_path, delim, quoted)
+        if cache is not None:
+            capacity = cache.num_rows + 1
+            cache.close()
+        else:
+            capacity = DEFAULT_CAPACITY
+    key_filter = BloomFilter(capacity, error_rate)
+    for key, _, _ in ingest.iter_keyed_rows(file_path, delim, key_cols, lower_case, quoted,
+                                            key_cols):
+        key_filter.add(key)
+    return key_filter
@@ -7,7 +7,8 @@
 import csv
 import codecs
 import io
-from typing import Iterator, List, TextIO, Any
+from itertools import chain, islice
+from typing import Any, Iterable, Iterator, List, Optional, TextIO
 
 
 class UTF8Recoder:
@@ -28,17 +29,37 @@ class UnicodeReader:
     """
     A CSV reader which will iterate over lines in the CSV file "f",
     which is encoded in the given encoding.
+
+    With the default dialect, lines are simply split on the delimiter, and
+    only the lines holding a quote character go through csv.reader, so the
+    rows are the same. With quoted=False, every line is split and quote
+    characters are kept as is.
     """
 
-    def __init__(self, f: TextIO, dialect: csv.Dialect = csv.excel, encoding: str = "utf-8", **kwds: Any) -> None:
-        self.reader = csv.reader(f, dialect=dialect, **kwds)
+    def __init__(self, f: Iterable[str], dialect: csv.Dialect = csv.excel, encoding: str = "utf-8",
+                 quoted: bool = True, **kwds: Any) -> None:
+        if dialect is csv.excel and set(kwds) <= {'delimiter'}:
+            delimiter = kwds.get('delimiter', dialect.delimiter)
+            self.rows = _split_rows(iter(f), delimiter, dialect.quotechar if quoted else None)
+        else:
+            self.rows = csv.reader(f, dialect=dialect, **kwds)
 
     def __next__(self) -> List[str]:
-        row = next(self.reader)
-        return [str(s) for s in row]
+        return next(self.rows)
 
-    def __iter__(self) -> 'UnicodeReader':
-        return self
+    def __iter__(self) -> Iterator[List[str]]:
+        return self.rows
+
+
+def _split_rows(lines: Iterator[str], delimiter: str, quotechar: Optional[str]) -> Iterator[List[str]]:
+    """ Split the lines on the delimiter. Lines holding quotechar are parsed by
+    csv.reader instead, which pulls more lines for quoted line breaks """
+    for line in lines:
+        if quotechar is not None and quotechar in line:
+            yield next(csv.reader(chain([line], lines), delimiter=delimiter))
+            continue
+        line = line.rstrip('\r\n')
+        yield line.split(delimiter) if line else []
 
 
 class UnicodeWriter:
@@ -63,3 +84,58 @@ class UnicodeWriter:
     def writerows(self, rows: Iterator[List[str]]) -> None:
         for row in rows:
             self.writerow(row)
+
+
+# Number of rows formatted before the buffer is written to the output stream
+DEFAULT_BATCH_ROWS = 4096
+
+
+class _Chunks(list):
+    """ List of formatted lines, that csv.writer can write to """
+    write = list.append
+
+
+class BufferedWriter:
+    """
+    A CSV writer which formats rows into a buffer, and writes it to the
+    stream "f" in batches of rows. The output is the same as UnicodeWriter.
+    Call flush() after writerow(), writerows() flushes when it is done.
+    writerows() writes the first row right away, and doubles the batches up
+    to batch_rows from there, so that a few rows found in a long scan are
+    still written as they come.
+    """
+
+    def __init__(self, f: TextIO, dialect: csv.Dialect = csv.excel, encoding: str = "utf-8",
+                 batch_rows: int = DEFAULT_BATCH_ROWS, **kwds: Any) -> None:
+        self.chunks = _Chunks()
+        self.writer = csv.writer(self.chunks, dialect=dialect, **kwds)
+        self.stream = f
+        self.batch_rows = batch_rows
+
+    def writerow(self, row: List[str]) -> None:
+        self.writer.writerow(row)
+        if len(self.chunks) >= self.batch_rows:
+            self.flush()
+
+    def writerows(self, rows: Iterable[List[str]]) -> None:
+        rows = iter(rows)
+        batch_rows = 1
+        while True:
+            batch = list(islice(rows, batch_rows))
+            if not batch:
+                break
+            self.writer.writerows(batch)
+            self.flush()
+            batch_rows = min(batch_rows * 2, self.batch_rows)
+        self.flush()
+
+    def flush(self) -> None:
+        if self.chunks:
+            self.stream.write(''.join(self.chunks))
+            self.chunks.clear()
+
+    def __enter__(self) -> 'BufferedWriter':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.flush()
@@ -1,7 +1,8 @@
 #!/usr/bin/python3
 #
 # Output the diff of 2 files, based on certain columns in the files
-# Loads the keys in memory, so only works on small/medium sized files
+# Loads the keys in memory by default, so only works on small/medium sized
+# files. Use --algorithm=sort for an external sort-merge anti-join on big files.
 # It outputs the entire line from the left file
 #
 # Usage:
@@ -11,60 +12,304 @@ import os
 import sys
 import csv
 import argparse
+import functools
 from collections import OrderedDict
-from typing import List, Dict, Any
+from typing import Callable, Iterator, List, Dict, Any, Optional, Tuple, Union
 
-from . import csv_unicode, file_ops_common
+from . import bloom_filter as bloom, csv_unicode, file_ops_common, hash_index, ingest, \
+    partitioned_join, sort_merge
 
 
-def process_file_diff(left_file: str, right_file: str, left_columns: str = '0',
-                     right_columns: str = '0', left_delim: str = '\t',
-                     right_delim: str = '\t', lower_case: bool = False) -> List[List[str]]:
-    """Process the diff between two files based on specified columns.
+def iter_file_diff(left_file: str, right_file: Union[str, List[str]], left_columns: str = '0',
+                   right_columns: Union[str, List[str]] = '0', left_delim: str = '\t',
+                   right_delim: Union[str, List[str]] = '\t', lower_case: bool = False,
+                   algorithm: str = 'hash',
+                   memory_limit: int = sort_merge.DEFAULT_MEMORY_LIMIT,
+                   build_side: str = 'left', jobs: int = 1,
+                   preserve_order: bool = True,
+                   compact_keys: bool = False, quoted: bool = True,
+                   bloom_filter: bool = False, presorted: bool = False,
+                   check_order: bool = True) -> Iterator[List[str]]:
+    """Stream the diff between two files based on specified columns.
+
+    With the "hash" algorithm nothing can be output before the right file has
+    been read, but the remaining rows are then yielded one by one instead of
+    being copied into a result list.
+
+    right_file can also be a list of files, for the left rows whose key is in
+    none of them. right_columns and right_delim are then either lists with an
+    item per right file, or strings used for all of them. This is only
+    supported by the default "hash" algorithm with the left file as build
+    side, without the other join options.
     
     Args:
         left_file: Path to the left file
-        right_file: Path to the right file
+        right_file: Path to the right file, or list of paths
         left_columns: Comma-separated string of column indices for left file
         right_columns: Comma-separated string of column indices for right file
         left_delim: Delimiter for left file
         right_delim: Delimiter for right file
         lower_case: Whether to ignore case when comparing
+        algorithm: "hash" to load the left keys in memory, or "sort" for an
+            external sort-merge anti-join whose output is in key order
+        memory_limit: Memory budget in bytes for the "sort" algorithm
+        build_side: File loaded in memory by the "hash" algorithm: "left" or
+            "right". When the right file is loaded, the left file is streamed
+            and its rows are output in file order instead of being grouped by
+            key. "auto" loads the left file, so that the output order doesn't
+            depend on the sizes of the files
+        jobs: Number of processes for the "hash" algorithm. With more than
+            1, both files are hash partitioned by key and joined in parallel
+        preserve_order: With jobs, restore the single process output order
+            instead of outputting the rows partition by partition
+        compact_keys: Keep only a 64-bit hash of each left key and the byte
+            offset of its row in memory, re-reading the output rows from the
+            left file. The output is the same
+        quoted: Whether fields may be quoted. Otherwise every line is split
+            on the delimiter, keeping quote characters as is
+        bloom_filter: For the "hash" algorithm with the left file as build
+            side, first read the right keys into a Bloom filter. Left rows
+            whose key isn't in it are output as soon as they are read, and
+            only the others are kept in memory and output at the end. The
+            right file is read twice. With compact_keys, only the digests &
+            offsets of those rows are kept
+        presorted: Both files are already sorted by key. They are streamed
+            through a merge anti-join, like the "sort" algorithm without
+            sorting
+        check_order: With presorted, raise a ValueError as soon as a key is
+            out of order
+
+    Files with a fresh columnar cache (see ingest.py) are read from it,
+    except with jobs or compact_keys, which need the left file's byte offsets.
+    When the right file has a fresh hash index for the right key columns
+    (see hash_index.py), the "hash" algorithm streams the left file and
+    probes the index instead of loading either file in memory, unless jobs
+    is more than 1. build_side, compact_keys and bloom_filter are then moot.
         
     Returns:
-        List of rows that are in left_file but not in right_file
+        Iterator over the rows that are in left_file but not in right_file
     """
     left_key_cols = [int(col) for col in left_columns.split(',')]
+    if not isinstance(right_file, str):
+        if (algorithm != 'hash' or build_side != 'left' or jobs > 1 or compact_keys or
+                bloom_filter or presorted):
+            raise ValueError('Several right files are only supported by the "hash" algorithm'
+                             ' with the left build side, without the other join options')
+        right_specs = file_ops_common.right_file_specs(right_file, right_columns, right_delim)
+        yield from _multi_diff(left_file, right_specs, left_key_cols, left_delim, lower_case,
+                               quoted)
+        return
+
     right_key_cols = [int(col) for col in right_columns.split(',')]
 
+    if algorithm == 'sort' or presorted:
+        left = ingest.iter_keyed_rows(left_file, left_delim, left_key_cols, lower_case, quoted)
+        right = ingest.iter_keyed_rows(right_file, right_delim, right_key_cols, lower_case,
+                                       quoted, right_key_cols)
+        if not presorted:
+            left = sort_merge.external_sort(left, memory_limit)
+            right = sort_merge.external_sort(right, memory_limit)
+        elif check_order:
+            left = sort_merge.check_sorted(left, left_file)
+            right = sort_merge.check_sorted(right, right_file)
+        yield from sort_merge.merge_anti_join(left, right)
+        return
+
+    if jobs > 1:
+        file_ops_common.require_uncompressed('--jobs', left_file, right_file)
+        yield from partitioned_join.iter_partitioned_diff(
+            left_file, right_file, left_key_cols, right_key_cols, left_delim,
+            right_delim, lower_case, jobs, preserve_order, quoted=quoted)
+        return
+
+    # Unlike for the intersection, the build side changes the output order,
+    # so "auto" keeps the left one
+    group_by_key = build_side != 'right'
+    right_index = hash_index.load_index(right_file, right_key_cols, right_delim, lower_case,
+                                        quoted)
+    if right_index is not None:
+        with right_index:
+            yield from _indexed_diff(left_file, right_index, left_key_cols, left_delim,
+                                     lower_case, group_by_key, quoted)
+        return
+
+    if not group_by_key:
+        # Streaming anti-join: only the right keys are kept in memory
+        right_keys = set(key for key, _, _ in ingest.iter_keyed_rows(
+            right_file, right_delim, right_key_cols, lower_case, quoted, right_key_cols))
+        for key, _, cols in ingest.iter_keyed_rows(
+                left_file, left_delim, left_key_cols, lower_case, quoted):
+            if key not in right_keys:
+                yield cols
+        return
+
+    get_left_key = file_ops_common.key_getter(left_key_cols, lower_case)
+    get_right_key = file_ops_common.key_getter(right_key_cols, lower_case)
+
+    if compact_keys:
+        file_ops_common.require_uncompressed('--compact-keys', left_file)
+
+    right_filter = None
+    if bloom_filter:
+        right_filter = bloom.build_key_filter(right_file, right_delim, right_key_cols,
+                                              lower_case, quoted)
+
+    if compact_keys:
+        yield from _compact_diff(left_file, right_file, left_delim, right_delim,
+                                 get_left_key, get_right_key, quoted, right_filter)
+        return
+
     # We use an ordered dict to maintain the original order of the lines
     all_keys: Dict[str, List[List[str]]] = OrderedDict()
 
     # Go through the left file and collect the keys
-    with open(left_file, 'r', encoding='utf-8') as f:
-        for cols in csv_unicode.UnicodeReader(f, delimiter=left_delim):
-            key = file_ops_common.get_key(cols, left_key_cols)
-            if lower_case:
-                key = key.lower()
-            if key not in all_keys:
-                all_keys[key] = []
-            all_keys[key].append(cols)
+    for cols in ingest.iter_file_rows(left_file, left_delim, quoted):
+        key = get_left_key(cols)
+        if right_filter is not None and key not in right_filter:
+            yield cols  # Definitely not in the right file
+            continue
+        if key not in all_keys:
+            all_keys[key] = []
+        all_keys[key].append(cols)
 
     # Go through the right file and remove those keys from all_keys
-    with open(right_file, 'r', encoding='utf-8') as f:
-        for cols in csv_unicode.UnicodeReader(f, delimiter=right_delim):
-            key = file_ops_common.get_key(cols, right_key_cols)
-            if lower_case:
-                key = key.lower()
-            if key in all_keys:
-                all_keys.pop(key, None)
-
-    # Return the remaining rows
-    result = []
-    for key in all_keys:
-        for line in all_keys[key]:
-            result.append(line)
-    return result
+    for cols in ingest.iter_file_rows(right_file, right_delim, quoted, right_key_cols):
+        all_keys.pop(get_right_key(cols), None)
+
+    # Output the remaining rows
+    for lines in all_keys.values():
+        yield from lines
+
+
+def _multi_diff(left_file: str, right_specs: List[Tuple[str, List[int], str]],
+                left_key_cols: List[int], left_delim: str, lower_case: bool,
+                quoted: bool = True) -> Iterator[List[str]]:
+    """Left rows whose key is in none of the right files.
+
+    The left rows are loaded once, and the keys of every right file are
+    removed from the same table in turn, instead of diffing the result of
+    each diff against the next file.
+    """
+    get_left_key = file_ops_common.key_getter(left_key_cols, lower_case)
+
+    all_keys: Dict[str, List[List[str]]] = OrderedDict()
+    for cols in ingest.iter_file_rows(left_file, left_delim, quoted):
+        key = get_left_key(cols)
+        if key not in all_keys:
+            all_keys[key] = []
+        all_keys[key].append(cols)
+
+    for path, key_cols, delim in right_specs:
+        if not all_keys:
+            break
+        get_right_key = file_ops_common.key_getter(key_cols, lower_case)
+        for cols in ingest.iter_file_rows(path, delim, quoted, key_cols):
+            all_keys.pop(get_right_key(cols), None)
+
+    for lines in all_keys.values():
+        yield from lines
+
+
+def _compact_diff(left_file: str, right_file: str, left_delim: str, right_delim: str,
+                  get_left_key: Callable[[List[str]], str],
+                  get_right_key: Callable[[List[str]], str],
+                  quoted: bool = True,
+                  right_filter: Optional[bloom.BloomFilter] = None) -> Iterator[List[str]]:
+    """Hash anti-join keeping only key digests and row offsets of the left file.
+
+    When a right key hits a digest, the left rows sharing it are re-read and
+    only those with the same real key are removed, so digest collisions never
+    drop rows from the output. With right_filter, the left rows whose key
+    isn't in it are output as they are read, and only the others are indexed.
+    """
+    if right_filter is None:
+        all_keys = file_ops_common.load_offset_index(left_file, left_delim, get_left_key,
+                                                     quoted)
+    else:
+        all_keys = {}
+        for offset, cols in file_ops_common.iter_offset_rows(left_file, left_delim, quoted):
+            key = get_left_key(cols)
+            if key in right_filter:
+                file_ops_common.add_offset(all_keys, file_ops_common.hash_key(key), offset)
+            else:
+                yield cols  # Definitely not in the right file
+
+    with open(left_file, 'rb') as left:
+        for cols in ingest.iter_file_rows(right_file, right_delim, quoted):
+            key = get_right_key(cols)
+            digest = file_ops_common.hash_key(key)
+            offsets = all_keys.get(digest)
+            if offsets is None:
+                continue
+            if not isinstance(offsets, list):
+                offsets = [offsets]
+            remaining = [offset for offset in offsets
+                         if get_left_key(file_ops_common.read_row_at(
+                             left, offset, left_delim, quoted)) != key]
+            if remaining:
+                all_keys[digest] = remaining
+            else:
+                del all_keys[digest]
+
+        # Output the remaining rows, re-reading them from the left file
+        for offsets in all_keys.values():
+            if not isinstance(offsets, list):
+                offsets = [offsets]
+            for offset in offsets:
+                yield file_ops_common.read_row_at(left, offset, left_delim, quoted)
+
+
+def _indexed_diff(left_file: str, right_index: hash_index.HashIndex,
+                  left_key_cols: List[int], left_delim: str, lower_case: bool,
+                  group_by_key: bool, quoted: bool = True) -> Iterator[List[str]]:
+    """Probe the hash index of the right file with the left file.
+
+    The lookups of the most recent keys are cached. Only the left rows to
+    output are kept in memory, and only when they are grouped by key like
+    the left build side does. Otherwise they are output in left file order.
+    """
+    get_left_key = file_ops_common.key_getter(left_key_cols, lower_case)
+    in_right = functools.lru_cache(maxsize=hash_index.LOOKUP_CACHE_ENTRIES)(
+        right_index.__contains__)
+
+    all_keys: Dict[str, List[List[str]]] = OrderedDict()
+    for cols in ingest.iter_file_rows(left_file, left_delim, quoted):
+        key = get_left_key(cols)
+        if in_right(key):
+            continue
+        if not group_by_key:
+            yield cols
+            continue
+        if key not in all_keys:
+            all_keys[key] = []
+        all_keys[key].append(cols)
+
+    for lines in all_keys.values():
+        yield from lines
+
+
+def process_file_diff(left_file: str, right_file: Union[str, List[str]],
+                     left_columns: str = '0', right_columns: Union[str, List[str]] = '0',
+                     left_delim: str = '\t', right_delim: Union[str, List[str]] = '\t',
+                     lower_case: bool = False,
+                     algorithm: str = 'hash',
+                     memory_limit: int = sort_merge.DEFAULT_MEMORY_LIMIT,
+                     build_side: str = 'left', jobs: int = 1,
+                     preserve_order: bool = True,
+                     compact_keys: bool = False, quoted: bool = True,
+                     bloom_filter: bool = False, presorted: bool = False,
+                     check_order: bool = True) -> List[List[str]]:
+    """Process the diff between two files based on specified columns.
+
+    See iter_file_diff for the arguments.
+        
+    Returns:
+        List of rows that are in left_file but not in right_file
+    """
+    return list(iter_file_diff(left_file, right_file, left_columns, right_columns,
+                               left_delim, right_delim, lower_case, algorithm, memory_limit,
+                               build_side, jobs, preserve_order, compact_keys, quoted,
+                               bloom_filter, presorted, check_order))
 
 
 def main() -> None:
@@ -77,20 +322,31 @@ def main() -> None:
                                       parents=[parent_argparser])
     args = argparser.parse_args()
 
-    result = process_file_diff(
+    right_file, right_columns = file_ops_common.right_files_args(args)
+    result = iter_file_diff(
         args.left_file,
-        args.right_file,
+        right_file,
         args.left_columns,
-        args.right_columns,
+        right_columns,
         args.left_delim,
         args.right_delim,
-        args.lower_case
+        args.lower_case,
+        args.algorithm,
+        args.memory_limit,
+        args.build_side,
+        args.jobs,
+        args.preserve_order,
+        args.compact_keys,
+        args.quoted,
+        args.bloom_filter,
+        args.presorted,
+        args.check_order
     )
 
-    # Output the results
-    output = csv_unicode.UnicodeWriter(sys.stdout, delimiter=args.left_delim)
-    for line in result:
-        output.writerow(line)
+    # Stream the results in batches
+    with file_ops_common.open_output(args.output) as f:
+        output = csv_unicode.BufferedWriter(f, delimiter=args.left_delim)
+        output.writerows(result)
 
 
 if __name__ == '__main__':
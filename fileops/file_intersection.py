@@ -2,7 +2,8 @@
 # Copyright 2013 Foursquare Labs Inc. All Rights Reserved.
 #
 # Output the intersection of 2 files, based on certain columns in the files
-# Loads the keys in memory, so only works on small/medium sized files
+# Loads the keys in memory by default, so only works on small/medium sized
+# files. Use --algorithm=sort for an external sort-merge join on big files.
 # It outputs the full lines from the left file, optionally adding lines from
 # the right file into it
 #
@@ -13,59 +14,342 @@ import os
 import sys
 import csv
 import argparse
-from typing import List, Dict, Any
+import functools
+from operator import itemgetter
+from typing import Iterator, List, Dict, Any, Optional, Tuple, Union
 
-from . import csv_unicode, file_ops_common
+from . import bloom_filter as bloom, csv_unicode, file_ops_common, hash_index, ingest, \
+    partitioned_join, sort_merge
 
 
-def process_file_intersection(left_file: str, right_file: str, left_columns: str = '0',
-                            right_columns: str = '0', left_delim: str = '\t',
-                            right_delim: str = '\t', lower_case: bool = False,
-                            insert_cols: str = '') -> List[List[str]]:
-    """Process the intersection between two files based on specified columns.
+def iter_file_intersection(left_file: str, right_file: Union[str, List[str]],
+                           left_columns: str = '0',
+                           right_columns: Union[str, List[str]] = '0', left_delim: str = '\t',
+                           right_delim: Union[str, List[str]] = '\t', lower_case: bool = False,
+                           insert_cols: str = '', algorithm: str = 'hash',
+                           memory_limit: int = sort_merge.DEFAULT_MEMORY_LIMIT,
+                           build_side: str = 'left', jobs: int = 1,
+                           preserve_order: bool = True,
+                           compact_keys: bool = False,
+                           quoted: bool = True,
+                           bloom_filter: bool = False,
+                           presorted: bool = False,
+                           check_order: bool = True) -> Iterator[List[str]]:
+    """Stream the intersection between two files based on specified columns.
+
+    Rows are yielded as soon as they are found while scanning the right file,
+    so the caller can start writing output before the whole job finishes.
+
+    right_file can also be a list of files, for the left rows whose key is in
+    all of them. right_columns and right_delim are then either lists with an
+    item per right file, or strings used for all of them. This is only
+    supported by the default "hash" algorithm with the left file as build
+    side, without insert_cols nor the other join options.
     
     Args:
         left_file: Path to the left file
-        right_file: Path to the right file
+        right_file: Path to the right file, or list of paths
         left_columns: Comma-separated string of column indices for left file
         right_columns: Comma-separated string of column indices for right file
         left_delim: Delimiter for left file
         right_delim: Delimiter for right file
         lower_case: Whether to ignore case when comparing
         insert_cols: Comma-separated string of column indices from right file to insert
+        algorithm: "hash" to load the left keys in memory, or "sort" for an
+            external sort-merge join whose output is in key order
+        memory_limit: Memory budget in bytes for the "sort" algorithm
+        build_side: File loaded in memory by the "hash" algorithm: "left",
+            "right" or "auto" to pick the smaller one. The output is the same
+        jobs: Number of processes for the "hash" algorithm. With more than
+            1, both files are hash partitioned by key and joined in parallel
+        preserve_order: With jobs, restore the single process output order
+            instead of outputting the rows partition by partition
+        compact_keys: Keep only a 64-bit hash of each left key and the byte
+            offset of its row in memory, re-reading matching rows from the
+            left file. The output is the same
+        quoted: Whether fields may be quoted. Otherwise every line is split
+            on the delimiter, keeping quote characters as is
+        bloom_filter: For the "hash" algorithm with the left file as build
+            side, first read the right keys into a Bloom filter, and only
+            keep the left rows that may match in memory. The right file is
+            read twice. The output is the same. With compact_keys, only the
+            digests & offsets of those rows are kept
+        presorted: Both files are already sorted by key. They are streamed
+            through a merge join, like the "sort" algorithm without sorting
+        check_order: With presorted, raise a ValueError as soon as a key is
+            out of order
+
+    Files with a fresh columnar cache (see ingest.py) are read from it,
+    except with jobs or compact_keys, which need the left file's byte offsets.
+    When the right file has a fresh hash index for the right key columns
+    (see hash_index.py), the "hash" algorithm streams the left file and
+    probes the index instead of loading either file in memory, unless jobs
+    is more than 1. build_side, compact_keys and bloom_filter are then moot.
         
     Returns:
-        List of rows that are in both files, with optional columns from right file
+        Iterator over the rows that are in both files, with optional columns
+        from right file
     """
     left_key_cols = [int(col) for col in left_columns.split(',')]
+    if not isinstance(right_file, str):
+        if (insert_cols or algorithm != 'hash' or build_side != 'left' or jobs > 1 or
+                compact_keys or bloom_filter or presorted):
+            raise ValueError('Several right files are only supported by the "hash" algorithm'
+                             ' with the left build side, without the other join options')
+        right_specs = file_ops_common.right_file_specs(right_file, right_columns, right_delim)
+        yield from _multi_intersection(left_file, right_specs, left_key_cols, left_delim,
+                                       lower_case, quoted)
+        return
+
     right_key_cols = [int(col) for col in right_columns.split(',')]
     insert_cols_list = [int(col) for col in insert_cols.split(',')] if insert_cols else []
+    # Only these columns of the right file are used
+    right_cols = right_key_cols + insert_cols_list
+
+    if algorithm == 'sort' or presorted:
+        left = ingest.iter_keyed_rows(left_file, left_delim, left_key_cols, lower_case, quoted)
+        right = ingest.iter_keyed_rows(right_file, right_delim, right_key_cols, lower_case,
+                                       quoted, right_cols)
+        if not presorted:
+            left = sort_merge.external_sort(left, memory_limit)
+            right = sort_merge.external_sort(right, memory_limit)
+        elif check_order:
+            left = sort_merge.check_sorted(left, left_file)
+            right = sort_merge.check_sorted(right, right_file)
+        yield from sort_merge.merge_join(left, right, insert_cols_list)
+        return
+
+    if jobs > 1:
+        file_ops_common.require_uncompressed('--jobs', left_file, right_file)
+        yield from partitioned_join.iter_partitioned_intersection(
+            left_file, right_file, left_key_cols, right_key_cols, left_delim,
+            right_delim, lower_case, insert_cols_list, jobs, preserve_order, quoted=quoted)
+        return
+
+    right_index = hash_index.load_index(right_file, right_key_cols, right_delim, lower_case,
+                                        quoted)
+    if right_index is not None:
+        with right_index:
+            yield from _indexed_intersection(left_file, right_index, left_key_cols, left_delim,
+                                             lower_case, insert_cols_list, quoted)
+        return
+
+    if file_ops_common.choose_build_side(left_file, right_file, build_side) == 'right':
+        yield from _right_build_intersection(left_file, right_file, left_key_cols,
+                                             right_key_cols, left_delim, right_delim,
+                                             lower_case, insert_cols_list, quoted)
+        return
+
+    if compact_keys:
+        file_ops_common.require_uncompressed('--compact-keys', left_file)
+
+    right_filter = None
+    if bloom_filter:
+        right_filter = bloom.build_key_filter(right_file, right_delim, right_key_cols,
+                                              lower_case, quoted)
+
+    if compact_keys:
+        yield from _compact_intersection(left_file, right_file, left_key_cols,
+                                         right_key_cols, left_delim, right_delim,
+                                         lower_case, insert_cols_list, quoted, right_filter)
+        return
+
+    get_left_key = file_ops_common.key_getter(left_key_cols, lower_case)
+    get_right_key = file_ops_common.key_getter(right_key_cols, lower_case)
 
     # Go through the left file and collect the keys
     all_keys: Dict[str, List[List[str]]] = {}
-    with open(left_file, 'r', encoding='utf-8') as f:
-        for cols in csv_unicode.UnicodeReader(f, delimiter=left_delim):
-            key = file_ops_common.get_key(cols, left_key_cols)
-            if lower_case:
-                key = key.lower()
-            if key not in all_keys:
-                all_keys[key] = []
-            all_keys[key].append(cols)
-
-    # Process right file and build result
-    result = []
-    with open(right_file, 'r', encoding='utf-8') as f:
-        for cols in csv_unicode.UnicodeReader(f, delimiter=right_delim):
-            key = file_ops_common.get_key(cols, right_key_cols)
-            if lower_case:
-                key = key.lower()
-            if key in all_keys:
-                for line in all_keys[key]:
-                    insert_values = [cols[i] for i in insert_cols_list]
-                    result.append(line + insert_values)
-                all_keys.pop(key)
-
-    return result
+    for cols in ingest.iter_file_rows(left_file, left_delim, quoted):
+        key = get_left_key(cols)
+        if right_filter is not None and key not in right_filter:
+            continue  # Not in the right file
+        if key not in all_keys:
+            all_keys[key] = []
+        all_keys[key].append(cols)
+
+    # Stream the right file and output the matches
+    for cols in ingest.iter_file_rows(right_file, right_delim, quoted, right_cols):
+        key = get_right_key(cols)
+        if key in all_keys:
+            insert_values = [cols[i] for i in insert_cols_list]
+            for line in all_keys.pop(key):
+                yield line + insert_values
+
+
+def _multi_intersection(left_file: str, right_specs: List[Tuple[str, List[int], str]],
+                        left_key_cols: List[int], left_delim: str, lower_case: bool,
+                        quoted: bool = True) -> Iterator[List[str]]:
+    """Left rows whose key is in every right file, grouped by key in the
+    order of the first left row of each key.
+
+    A single table holds the left rows by key, with the number of right files
+    the key has been found in so far. The right files are streamed one after
+    the other, counting a key once per file. After each file, the keys it
+    doesn't have are dropped, so the table shrinks as the files are read.
+    """
+    get_left_key = file_ops_common.key_getter(left_key_cols, lower_case)
+
+    # key -> [number of right files with the key, left rows]
+    all_keys: Dict[str, list] = {}
+    for cols in ingest.iter_file_rows(left_file, left_delim, quoted):
+        key = get_left_key(cols)
+        entry = all_keys.get(key)
+        if entry is None:
+            all_keys[key] = [0, [cols]]
+        else:
+            entry[1].append(cols)
+
+    for file_num, (path, key_cols, delim) in enumerate(right_specs):
+        get_right_key = file_ops_common.key_getter(key_cols, lower_case)
+        for cols in ingest.iter_file_rows(path, delim, quoted, key_cols):
+            entry = all_keys.get(get_right_key(cols))
+            if entry is not None and entry[0] == file_num:
+                entry[0] += 1
+        all_keys = {key: entry for key, entry in all_keys.items() if entry[0] > file_num}
+        if not all_keys:
+            return
+
+    for _, lines in all_keys.values():
+        yield from lines
+
+
+def _compact_intersection(left_file: str, right_file: str, left_key_cols: List[int],
+                          right_key_cols: List[int], left_delim: str, right_delim: str,
+                          lower_case: bool, insert_cols_list: List[int],
+                          quoted: bool = True,
+                          right_filter: Optional[bloom.BloomFilter] = None) -> Iterator[List[str]]:
+    """Hash join keeping only key digests and row offsets of the left file.
+
+    A left row costs a 64-bit int and an offset instead of its key string and
+    column list. Rows sharing a digest are re-read and their real key checked,
+    so digest collisions never produce wrong matches. With right_filter,
+    only the left rows whose key may be in the right file are indexed.
+    """
+    get_left_key = file_ops_common.key_getter(left_key_cols, lower_case)
+    get_right_key = file_ops_common.key_getter(right_key_cols, lower_case)
+
+    all_keys = file_ops_common.load_offset_index(left_file, left_delim, get_left_key, quoted,
+                                                 right_filter)
+
+    with open(left_file, 'rb') as left:
+        for cols in ingest.iter_file_rows(right_file, right_delim, quoted,
+                                          right_key_cols + insert_cols_list):
+            key = get_right_key(cols)
+            digest = file_ops_common.hash_key(key)
+            offsets = all_keys.get(digest)
+            if offsets is None:
+                continue
+
+            if not isinstance(offsets, list):
+                offsets = [offsets]
+            lines = []
+            remaining = []
+            for offset in offsets:
+                line = file_ops_common.read_row_at(left, offset, left_delim, quoted)
+                if get_left_key(line) == key:
+                    lines.append(line)
+                else:
+                    remaining.append(offset)  # A different key with the same digest
+            if remaining:
+                all_keys[digest] = remaining
+            else:
+                del all_keys[digest]
+
+            if lines:
+                insert_values = [cols[i] for i in insert_cols_list]
+                for line in lines:
+                    yield line + insert_values
+
+
+def _right_build_intersection(left_file: str, right_file: str, left_key_cols: List[int],
+                              right_key_cols: List[int], left_delim: str, right_delim: str,
+                              lower_case: bool, insert_cols_list: List[int],
+                              quoted: bool = True) -> Iterator[List[str]]:
+    """Hash the right file and probe it with the left file.
+
+    The output order matches the left-build join: rows come out in the order
+    the right file first mentions their key, and in left file order within a
+    key. Only the matching rows are held in memory to restore that order.
+    """
+    get_left_key = file_ops_common.key_getter(left_key_cols, lower_case)
+    get_right_key = file_ops_common.key_getter(right_key_cols, lower_case)
+
+    # key -> (row number of its first occurrence, values to insert)
+    right_keys: Dict[str, Tuple[int, List[str]]] = {}
+    for seq, cols in enumerate(ingest.iter_file_rows(right_file, right_delim, quoted,
+                                                     right_key_cols + insert_cols_list)):
+        key = get_right_key(cols)
+        if key not in right_keys:
+            right_keys[key] = (seq, [cols[i] for i in insert_cols_list])
+
+    matches = []
+    for cols in ingest.iter_file_rows(left_file, left_delim, quoted):
+        match = right_keys.get(get_left_key(cols))
+        if match is not None:
+            matches.append((match[0], cols + match[1]))
+
+    # The sort is stable, so left file order is kept within each key
+    matches.sort(key=itemgetter(0))
+    for _, line in matches:
+        yield line
+
+
+def _indexed_intersection(left_file: str, right_index: hash_index.HashIndex,
+                          left_key_cols: List[int], left_delim: str, lower_case: bool,
+                          insert_cols_list: List[int],
+                          quoted: bool = True) -> Iterator[List[str]]:
+    """Probe the hash index of the right file with the left file.
+
+    The lookups of the most recent keys are cached. Only the matching rows
+    are held in memory, to output them in the same order as
+    _right_build_intersection, the offset of the first right row of a key
+    standing for its row number.
+    """
+    get_left_key = file_ops_common.key_getter(left_key_cols, lower_case)
+
+    @functools.lru_cache(maxsize=hash_index.LOOKUP_CACHE_ENTRIES)
+    def lookup(key: str) -> Optional[Tuple[int, List[str]]]:
+        """Offset of the first right row of key and its values to insert, or None."""
+        row = right_index.first_row(key)
+        return None if row is None else (row[0], [row[1][i] for i in insert_cols_list])
+
+    matches = []
+    for cols in ingest.iter_file_rows(left_file, left_delim, quoted):
+        match = lookup(get_left_key(cols))
+        if match is not None:
+            matches.append((match[0], cols + match[1]))
+
+    # The sort is stable, so left file order is kept within each key
+    matches.sort(key=itemgetter(0))
+    for _, line in matches:
+        yield line
+
+
+def process_file_intersection(left_file: str, right_file: Union[str, List[str]],
+                            left_columns: str = '0',
+                            right_columns: Union[str, List[str]] = '0', left_delim: str = '\t',
+                            right_delim: Union[str, List[str]] = '\t', lower_case: bool = False,
+                            insert_cols: str = '', algorithm: str = 'hash',
+                            memory_limit: int = sort_merge.DEFAULT_MEMORY_LIMIT,
+                            build_side: str = 'left', jobs: int = 1,
+                            preserve_order: bool = True,
+                            compact_keys: bool = False,
+                            quoted: bool = True,
+                            bloom_filter: bool = False,
+                            presorted: bool = False,
+                            check_order: bool = True) -> List[List[str]]:
+    """Process the intersection between two files based on specified columns.
+
+    See iter_file_intersection for the arguments.
+        
+    Returns:
+        List of rows that are in both files, with optional columns from right file
+    """
+    return list(iter_file_intersection(left_file, right_file, left_columns, right_columns,
+                                       left_delim, right_delim, lower_case, insert_cols,
+                                       algorithm, memory_limit, build_side, jobs,
+                                       preserve_order, compact_keys, quoted, bloom_filter,
+                                       presorted, check_order))
 
 
 def main() -> None:
@@ -83,21 +367,32 @@ def main() -> None:
                           ' only consider the 1st match row')
     args = argparser.parse_args()
 
-    result = process_file_intersection(
+    right_file, right_columns = file_ops_common.right_files_args(args)
+    result = iter_file_intersection(
         args.left_file,
-        args.right_file,
+        right_file,
         args.left_columns,
-        args.right_columns,
+        right_columns,
         args.left_delim,
         args.right_delim,
         args.lower_case,
-        args.insert_cols
+        args.insert_cols,
+        args.algorithm,
+        args.memory_limit,
+        args.build_side,
+        args.jobs,
+        args.preserve_order,
+        args.compact_keys,
+        args.quoted,
+        args.bloom_filter,
+        args.presorted,
+        args.check_order
     )
 
-    # Output the results
-    output = csv_unicode.UnicodeWriter(sys.stdout, delimiter=args.left_delim)
-    for line in result:
-        output.writerow(line)
+    # Stream the results in batches as they are found
+    with file_ops_common.open_output(args.output) as f:
+        output = csv_unicode.BufferedWriter(f, delimiter=args.left_delim)
+        output.writerows(result)
 
 
 if __name__ == '__main__':
@@ -9,10 +9,31 @@ import os
 import sys
 import csv
 import argparse
-from typing import List, Union, TextIO
+import bz2
+import gzip
+import hashlib
+import io
+import lzma
+import queue
+import shutil
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+from operator import itemgetter
+from typing import IO, Any, BinaryIO, Callable, Container, Dict, Iterator, List, Optional, Tuple, Union, TextIO
 
 from . import csv_unicode
 
+# Magic bytes at the start of compressed files, and the module opening them
+COMPRESSIONS = [('gzip', b'\x1f\x8b', gzip), ('bz2', b'BZh', bz2),
+                ('xz', b'\xfd7zXZ\x00', lzma)]
+# Output files are compressed according to their extension
+COMPRESSION_EXTENSIONS = {'.gz': gzip, '.bz2': bz2, '.xz': lzma}
+# Size of the decompressed chunks, and number of chunks decompressed ahead
+_DECOMPRESS_CHUNK_SIZE = 1 << 20
+_DECOMPRESS_QUEUE_CHUNKS = 8
+
 
 def set_ops_parser() -> argparse.ArgumentParser:
     ''' Common arguments for the file_diff and the file_intersection scripts '''
@@ -22,6 +43,10 @@ def set_ops_parser() -> argparse.ArgumentParser:
 
     parser.add_argument('left_file', help='Left input file')
     parser.add_argument('right_file', help='Right input file')
+    parser.add_argument('more_right_files', nargs='*', metavar='more_right_file',
+                        help='More right files, all compared to the left file in a'
+                        ' single pass over each file. Only for the "hash" algorithm,'
+                        ' without the other join options')
     parser.add_argument('-i', '--ignore_case', dest='lower_case',
                         action='store_true', help='Ignore the case for the key'
                         ' columns')
@@ -30,20 +55,341 @@ def set_ops_parser() -> argparse.ArgumentParser:
                         'intersect on. E.g. "0,1,5"')
     parser.add_argument('-r', '--right-columns', dest='right_columns',
                         default='0', help='List of column numbers from the right file to'
-                        'intersect on. E.g. "0,1,5"')
+                        'intersect on. E.g. "0,1,5". With more right files, a list per'
+                        ' file can be given, separated with ";". E.g. "0,1;2,3"')
     parser.add_argument('--left-delim', dest='left_delim', default='\t',
                         help='Delimiter for the left file. E.g. ","')
     parser.add_argument('--right-delim', dest='right_delim', default='\t',
                         help='Delimiter for the right file. E.g. ","')
+    parser.add_argument('--algorithm', dest='algorithm', default='hash',
+                        choices=['hash', 'sort'],
+                        help='"hash" loads the left file keys in memory. "sort" does an'
+                        ' external sort of both files and a streaming merge, using at'
+                        ' most --memory-limit of memory. Its output is in key order')
+    parser.add_argument('--sorted', dest='presorted', action='store_true',
+                        help='Both files are already sorted by their key columns, compared'
+                        ' as strings like LC_ALL=C sort does. Stream them through a merge'
+                        ' join holding only the current key in memory. The output is in'
+                        ' key order. With --ignore_case, the files must be sorted by'
+                        ' their lower-cased keys')
+    parser.add_argument('--no-sort-check', dest='check_order', action='store_false',
+                        help='With --sorted, don\'t check that the keys are in order.'
+                        ' By default, unsorted input fails with an error')
+    parser.add_argument('--memory-limit', dest='memory_limit', type=parse_size,
+                        default='256M', help='Memory budget for the "sort" algorithm.'
+                        ' E.g. "512M", "4G"')
+    parser.add_argument('--build-side', dest='build_side', default='left',
+                        choices=['left', 'right', 'auto'],
+                        help='Which file the "hash" algorithm loads in memory. "auto"'
+                        ' picks the smaller file. The intersection output is the same either'
+                        ' way. The difference outputs its rows in left file order with'
+                        ' "right", instead of grouped by key, and "auto" always loads the'
+                        ' left file')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of processes for the "hash" algorithm. With more'
+                        ' than 1, both files are hash partitioned by key and the'
+                        ' partitions are joined in parallel. Assumes one row per line')
+    parser.add_argument('--unordered', dest='preserve_order', action='store_false',
+                        help='With --jobs, output the rows partition by partition'
+                        ' instead of restoring the single process output order')
+    parser.add_argument('--compact-keys', dest='compact_keys', action='store_true',
+                        help='For the "hash" algorithm, keep only a 64-bit hash of each'
+                        ' left key and the byte offset of its row in memory, and'
+                        ' re-read the rows from the left file when needed')
+    parser.add_argument('--bloom-filter', dest='bloom_filter', action='store_true',
+                        help='For the "hash" algorithm, first read the right file keys'
+                        ' into a Bloom filter, and only keep in memory the left rows'
+                        ' that may match. Best when few rows match. Can be combined with'
+                        ' --compact-keys. The difference then outputs the rows that'
+                        ' can\'t match first, in left file order, and the others grouped'
+                        ' by key at the end')
+    parser.add_argument('--no-quoting', dest='quoted', action='store_false',
+                        help='The files have no quoted fields: split every line on the'
+                        ' delimiter, keeping quote characters as is. By default, only'
+                        ' the lines holding a quote character are parsed as CSV')
+    parser.add_argument('--output', dest='output', default=None,
+                        help='Output file instead of the standard output. It is compressed'
+                        ' if it ends with .gz, .bz2 or .xz')
 
     return parser
 
+def choose_build_side(left_file: str, right_file: str, build_side: str = 'auto') -> str:
+    ''' Resolve the side of a hash join to load in memory.
+
+    "auto" picks whichever file is smaller on disk, preferring the left one on
+    ties since that is the historical behaviour. '''
+    if build_side != 'auto':
+        return build_side
+    if os.path.getsize(right_file) < os.path.getsize(left_file):
+        return 'right'
+    return 'left'
+
+def right_files_args(args: argparse.Namespace) -> Tuple[Union[str, List[str]], Union[str, List[str]]]:
+    ''' The right_file & right_columns arguments of the set operations, from
+    the arguments of set_ops_parser. right_file is a list when there are more
+    right files, and right_columns too when it holds a ";" separated list per
+    file. Otherwise the same columns are used for all the right files '''
+    if not args.more_right_files:
+        return args.right_file, args.right_columns
+    right_files = [args.right_file] + args.more_right_files
+    if ';' not in args.right_columns:
+        return right_files, args.right_columns
+    return right_files, args.right_columns.split(';')
+
+def right_file_specs(right_files: List[str], right_columns: Union[str, List[str]],
+                     right_delims: Union[str, List[str]]) -> List[Tuple[str, List[int], str]]:
+    ''' (path, key columns, delimiter) of several right files. A single
+    columns or delimiter string applies to all of them '''
+    if isinstance(right_columns, str):
+        right_columns = [right_columns] * len(right_files)
+    if isinstance(right_delims, str):
+        right_delims = [right_delims] * len(right_files)
+    if not len(right_files) == len(right_columns) == len(right_delims):
+        raise ValueError('Got %d right files, but %d lists of columns and %d delimiters'
+                         % (len(right_files), len(right_columns), len(right_delims)))
+    return [(path, [int(col) for col in columns.split(',')], delim)
+            for path, columns, delim in zip(right_files, right_columns, right_delims)]
+
+_SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+def parse_size(size: str) -> int:
+    ''' Parse a human readable byte size like "512M" into a number of bytes '''
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in _SIZE_SUFFIXES:
+        return int(float(size[:-1]) * _SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
 KEY_DELIMITER='\t'
 def get_key(cols: List[str], key_cols: List[int]) -> str:
-    key = cols[key_cols[0]]
-    for i in range(1, len(key_cols)):
-        key += KEY_DELIMITER + cols[key_cols[i]]
-    return key
+    return KEY_DELIMITER.join([cols[i] for i in key_cols])
+
+def key_getter(key_cols: List[int], lower_case: bool = False) -> Callable[[List[str]], str]:
+    ''' Build a function returning the same key as get_key, optionally lower
+    cased. Meant for hot loops: the columns are fetched with a single
+    itemgetter call and joined once, rather than concatenated one by one.
+    The key stays a single str, which takes less memory than a tuple of
+    the column values. '''
+    getter = itemgetter(*key_cols)
+    if len(key_cols) == 1:
+        if lower_case:
+            return lambda cols: getter(cols).lower()
+        return getter
+    if lower_case:
+        return lambda cols: KEY_DELIMITER.join(getter(cols)).lower()
+    return lambda cols: KEY_DELIMITER.join(getter(cols))
 
 def split_key(key: str) -> List[str]:
     return key.split(KEY_DELIMITER)
+
+def hash_key(key: str) -> int:
+    ''' 64-bit digest of a key, stable across processes and runs. Equal
+    digests don't guarantee equal keys, so callers verify matches '''
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(),
+                          'little')
+
+def iter_keyed_rows(file_path: str, delim: str, key_cols: List[int],
+                    lower_case: bool = False,
+                    quoted: bool = True) -> Iterator[Tuple[str, int, List[str]]]:
+    ''' Yield (key, row number, cols) for every row of a delimited file '''
+    get_row_key = key_getter(key_cols, lower_case)
+    with open_input(file_path, 'r', encoding='utf-8') as f:
+        for seq, cols in enumerate(csv_unicode.UnicodeReader(f, delimiter=delim,
+                                                             quoted=quoted)):
+            yield get_row_key(cols), seq, cols
+
+def _iter_decoded_lines(f: BinaryIO, offsets: deque) -> Iterator[str]:
+    ''' Yield the decoded lines of a binary file, recording their start offset '''
+    pos = f.tell()
+    for line in f:
+        offsets.append(pos)
+        pos += len(line)
+        yield line.decode('utf-8')
+
+def iter_offset_rows(file_path: str, delim: str,
+                     quoted: bool = True) -> Iterator[Tuple[int, List[str]]]:
+    ''' Yield (byte offset, cols) for every row of a delimited file. The offset
+    can be passed to read_row_at to parse the row again later '''
+    offsets: deque = deque()
+    with open(file_path, 'rb') as f:
+        # The csv reader only pulls the lines of the row it is parsing, so the
+        # offsets recorded since the previous row are those of the current row
+        for cols in csv_unicode.UnicodeReader(_iter_decoded_lines(f, offsets), delimiter=delim,
+                                              quoted=quoted):
+            yield offsets[0], cols
+            offsets.clear()
+
+def add_offset(index: Dict[int, Union[int, List[int]]], digest: int, offset: int) -> None:
+    ''' Add the byte offset of a row to an index built by load_offset_index '''
+    offsets = index.get(digest)
+    if offsets is None:
+        index[digest] = offset
+    elif isinstance(offsets, list):
+        offsets.append(offset)
+    else:
+        index[digest] = [offsets, offset]
+
+def load_offset_index(file_path: str, delim: str,
+                      get_row_key: Callable[[List[str]], str],
+                      quoted: bool = True, key_filter: Optional[Container[str]] = None
+                      ) -> Dict[int, Union[int, List[int]]]:
+    ''' Map the hash_key digest of every row key to the byte offset of the row,
+    or to the list of offsets when several rows share a digest. The digests
+    are in order of first occurrence in the file. With key_filter, only the
+    rows whose key is in it are indexed '''
+    index: Dict[int, Union[int, List[int]]] = {}
+    for offset, cols in iter_offset_rows(file_path, delim, quoted):
+        key = get_row_key(cols)
+        if key_filter is None or key in key_filter:
+            add_offset(index, hash_key(key), offset)
+    return index
+
+def read_row_at(f: BinaryIO, offset: int, delim: str, quoted: bool = True) -> List[str]:
+    ''' Parse the row starting at a byte offset of a file opened in binary mode '''
+    f.seek(offset)
+    return next(csv_unicode.UnicodeReader(_iter_decoded_lines(f, deque()), delimiter=delim,
+                                          quoted=quoted))
+
+def split_line_ranges(file_path: str, num_ranges: int) -> List[Tuple[int, int]]:
+    ''' Split a file into up to num_ranges (start, end) byte ranges of similar
+    size. A range owns the lines that start inside it, see iter_range_rows '''
+    file_size = os.path.getsize(file_path)
+    step = max(1, -(-file_size // max(1, num_ranges)))
+    return [(start, min(start + step, file_size)) for start in range(0, file_size, step)]
+
+def iter_range_lines(file_path: str, start: int, end: int) -> Iterator[str]:
+    ''' Yield the decoded lines of a file that start within [start, end) '''
+    with open(file_path, 'rb') as f:
+        if start > 0:
+            # The line straddling start belongs to the previous range
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode('utf-8')
+
+def iter_range_rows(file_path: str, delim: str, start: int, end: int,
+                    quoted: bool = True) -> Iterator[List[str]]:
+    ''' Yield the parsed rows of the lines starting within [start, end).
+    Assumes that quoted fields don't contain line breaks '''
+    return csv_unicode.UnicodeReader(iter_range_lines(file_path, start, end), delimiter=delim,
+                                     quoted=quoted)
+
+def detect_compression(file_path: str) -> Optional[str]:
+    ''' Name of the compression of a file from its magic bytes: "gzip", "bz2",
+    "xz", or None for an uncompressed file '''
+    with open(file_path, 'rb') as f:
+        head = f.read(6)
+    for name, magic, _ in COMPRESSIONS:
+        if head.startswith(magic):
+            return name
+    return None
+
+def require_uncompressed(feature: str, *file_paths: str) -> None:
+    ''' Raise a ValueError if one of the files is compressed. For the modes
+    seeking into their input files '''
+    for file_path in file_paths:
+        if detect_compression(file_path) is not None:
+            raise ValueError('%s needs an uncompressed file, %s is compressed'
+                             % (feature, file_path))
+
+class _BackgroundReader(io.RawIOBase):
+    ''' Raw binary stream of a compressed file, decompressed in chunks by a
+    background thread into a bounded queue. Decompression releases the GIL,
+    so it overlaps with the parsing of the previous chunks '''
+
+    def __init__(self, file_path: str, module: Any) -> None:
+        super().__init__()
+        self.chunks: queue.Queue = queue.Queue(_DECOMPRESS_QUEUE_CHUNKS)
+        self.stopped = threading.Event()
+        self.pending = memoryview(b'')
+        self.eof = False
+        self.thread = threading.Thread(target=self._decompress, args=(file_path, module),
+                                       daemon=True)
+        self.thread.start()
+
+    def _decompress(self, file_path: str, module: Any) -> None:
+        try:
+            with module.open(file_path, 'rb') as f:
+                while True:
+                    chunk = f.read(_DECOMPRESS_CHUNK_SIZE)
+                    if not self._put(chunk) or not chunk:
+                        return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item: Any) -> bool:
+        ''' Queue an item, unless the reader gets closed meanwhile '''
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        if not self.pending:
+            if self.eof:
+                return 0
+            item = self.chunks.get()
+            if isinstance(item, Exception):
+                self.eof = True
+                raise item
+            if not item:
+                self.eof = True
+                return 0
+            self.pending = memoryview(item)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self) -> None:
+        self.stopped.set()
+        super().close()
+
+def open_input(file_path: str, mode: str = 'r', encoding: Optional[str] = None,
+               errors: Optional[str] = None) -> IO:
+    ''' Open an input file for reading like open(), transparently
+    decompressing gzip, bz2 & xz files detected by their magic bytes.
+    Compressed files are decompressed by a background thread, and can't be
+    seeked '''
+    compression = detect_compression(file_path)
+    if compression is None:
+        return open(file_path, mode, encoding=encoding, errors=errors)
+    module = next(module for name, _, module in COMPRESSIONS if name == compression)
+    f = io.BufferedReader(_BackgroundReader(file_path, module))
+    if 'b' in mode:
+        return f
+    return io.TextIOWrapper(f, encoding=encoding, errors=errors)
+
+@contextmanager
+def open_output(file_path: Optional[str]) -> Iterator[TextIO]:
+    ''' Context manager opening a text output file, compressed according to
+    its extension (.gz, .bz2 or .xz). The standard output when file_path is
+    None, which is left open '''
+    if file_path is None:
+        yield sys.stdout
+        return
+    module = COMPRESSION_EXTENSIONS.get(os.path.splitext(file_path)[1])
+    if module is None:
+        f = open(file_path, 'w', encoding='utf-8', newline='')
+    else:
+        f = module.open(file_path, 'wt', encoding='utf-8', newline='')
+    with f:
+        yield f
+
+def decompress_to_temp(file_path: str, temp_dir: Optional[str] = None) -> str:
+    ''' Decompress a compressed file into a new temporary file, for the
+    modes that need random access. Returns the path of the temporary file,
+    which the caller removes '''
+    fd, temp_path = tempfile.mkstemp(prefix='fileops-', dir=temp_dir)
+    with open_input(file_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+        shutil.copyfileobj(src, dst, _DECOMPRESS_CHUNK_SIZE)
+    return temp_path
@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+#
+# Reconcile 2 files, based on certain columns in the files: output the rows
+# only in the left file, the rows only in the right file and the matched rows
+# together, reading each file once. It is the same as running file_diff.py
+# both ways and file_intersection.py, with a single hash table of the left
+# keys. Loads the left file in memory, so only works on small/medium sized
+# left files.
+#
+# Usage:
+#   python file_reconcile.py [options] left_file right_file
+
+import argparse
+import sys
+from collections import OrderedDict
+from contextlib import ExitStack
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from . import csv_unicode, file_ops_common, ingest
+
+LEFT_ONLY = 'left_only'
+RIGHT_ONLY = 'right_only'
+MATCHED = 'matched'
+BUCKETS = (LEFT_ONLY, RIGHT_ONLY, MATCHED)
+
+
+def iter_file_reconcile(left_file: str, right_file: str, left_columns: str = '0',
+                        right_columns: str = '0', left_delim: str = '\t',
+                        right_delim: str = '\t', lower_case: bool = False,
+                        insert_cols: str = '',
+                        quoted: bool = True) -> Iterator[Tuple[str, List[str]]]:
+    """Stream the full outer diff of two files based on specified columns.
+
+    The left rows are loaded in memory by key, and the right file is
+    streamed: right rows whose key isn't in the left file are output right
+    away, in right file order. Left rows are output as matched on the first
+    right row with their key, followed by its insert_cols like
+    file_intersection does. The left rows that are never matched are output
+    at the end, grouped by key like file_diff does.
+
+    Args:
+        left_file: Path to the left file
+        right_file: Path to the right file
+        left_columns: Comma-separated string of column indices for left file
+        right_columns: Comma-separated string of column indices for right file
+        left_delim: Delimiter for left file
+        right_delim: Delimiter for right file
+        lower_case: Whether to ignore case when comparing
+        insert_cols: Comma-separated string of column indices from right file
+            to insert into the matched rows
+        quoted: Whether fields may be quoted. Otherwise every line is split
+            on the delimiter, keeping quote characters as is
+
+    Returns:
+        Iterator over (bucket, row), where bucket is one of LEFT_ONLY,
+        RIGHT_ONLY or MATCHED
+    """
+    get_left_key = file_ops_common.key_getter(
+        [int(col) for col in left_columns.split(',')], lower_case)
+    get_right_key = file_ops_common.key_getter(
+        [int(col) for col in right_columns.split(',')], lower_case)
+    insert_cols_list = [int(col) for col in insert_cols.split(',')] if insert_cols else []
+
+    # Left rows by key. The rows of a key are dropped once it is matched,
+    # leaving None so that the next right rows with that key are skipped
+    all_keys: Dict[str, Optional[List[List[str]]]] = OrderedDict()
+    for cols in ingest.iter_file_rows(left_file, left_delim, quoted):
+        key = get_left_key(cols)
+        if key not in all_keys:
+            all_keys[key] = []
+        all_keys[key].append(cols)
+
+    for cols in ingest.iter_file_rows(right_file, right_delim, quoted):
+        key = get_right_key(cols)
+        if key not in all_keys:
+            yield RIGHT_ONLY, cols
+            continue
+        lines = all_keys[key]
+        if lines is not None:
+            insert_values = [cols[i] for i in insert_cols_list]
+            for line in lines:
+                yield MATCHED, line + insert_values
+            all_keys[key] = None
+
+    for lines in all_keys.values():
+        if lines is not None:
+            for line in lines:
+                yield LEFT_ONLY, line
+
+
+def process_file_reconcile(left_file: str, right_file: str, left_columns: str = '0',
+                           right_columns: str = '0', left_delim: str = '\t',
+                           right_delim: str = '\t', lower_case: bool = False,
+                           insert_cols: str = '',
+                           quoted: bool = True) -> Dict[str, List[List[str]]]:
+    """Process the full outer diff of two files based on specified columns.
+
+    See iter_file_reconcile for the arguments.
+
+    Returns:
+        Dict of the rows of each bucket: LEFT_ONLY, RIGHT_ONLY and MATCHED
+    """
+    result: Dict[str, List[List[str]]] = {bucket: [] for bucket in BUCKETS}
+    for bucket, row in iter_file_reconcile(left_file, right_file, left_columns,
+                                           right_columns, left_delim, right_delim,
+                                           lower_case, insert_cols, quoted):
+        result[bucket].append(row)
+    return result
+
+
+def main() -> None:
+    """Reconcile 2 files, based on certain columns in the files. Reads each file
+    once, and writes the rows only in the left file, the rows only in the right
+    file and the matched rows (the left rows, optionally adding columns from the
+    right file) to separate files. The number of rows of each is output to the
+    standard error. Loads the left file in memory, so only works on small/medium
+    sized left files"""
+
+    argparser = argparse.ArgumentParser(description=main.__doc__,
+                                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    argparser.add_argument('left_file', help='Left input file')
+    argparser.add_argument('right_file', help='Right input file')
+    argparser.add_argument('-i', '--ignore_case', dest='lower_case',
+                           action='store_true', help='Ignore the case for the key'
+                           ' columns')
+    argparser.add_argument('-l', '--left-columns', dest='left_columns',
+                           default='0', help='List of column numbers from the left file to'
+                           ' match on. E.g. "0,1,5"')
+    argparser.add_argument('-r', '--right-columns', dest='right_columns',
+                           default='0', help='List of column numbers from the right file to'
+                           ' match on. E.g. "0,1,5"')
+    argparser.add_argument('--left-delim', dest='left_delim', default='\t',
+                           help='Delimiter for the left file. E.g. ","')
+    argparser.add_argument('--right-delim', dest='right_delim', default='\t',
+                           help='Delimiter for the right file. E.g. ","')
+    argparser.add_argument('--insert-cols', dest='insert_cols', default='',
+                           help='Columns from the right file to insert into the matched'
+                           ' rows. If there are multiple rows matching from the right file,'
+                           ' we only consider the 1st match row')
+    argparser.add_argument('--no-quoting', dest='quoted', action='store_false',
+                           help='The files have no quoted fields: split every line on the'
+                           ' delimiter, keeping quote characters as is')
+    argparser.add_argument('--left-only', dest=LEFT_ONLY, default=None,
+                           help='Output file of the rows only in the left file')
+    argparser.add_argument('--right-only', dest=RIGHT_ONLY, default=None,
+                           help='Output file of the rows only in the right file')
+    argparser.add_argument('--matched', dest=MATCHED, default=None,
+                           help='Output file of the matched left rows')
+    args = argparser.parse_args()
+
+    result = iter_file_reconcile(
+        args.left_file,
+        args.right_file,
+        args.left_columns,
+        args.right_columns,
+        args.left_delim,
+        args.right_delim,
+        args.lower_case,
+        args.insert_cols,
+        args.quoted
+    )
+
+    # Buckets without an output file are only counted. Output files ending
+    # with .gz, .bz2 or .xz are compressed
+    counts = {bucket: 0 for bucket in BUCKETS}
+    with ExitStack() as stack:
+        outputs = {}
+        for bucket in BUCKETS:
+            path = getattr(args, bucket)
+            if path is not None:
+                f = stack.enter_context(file_ops_common.open_output(path))
+                delim = args.right_delim if bucket == RIGHT_ONLY else args.left_delim
+                outputs[bucket] = stack.enter_context(
+                    csv_unicode.BufferedWriter(f, delimiter=delim))
+        for bucket, row in result:
+            counts[bucket] += 1
+            output = outputs.get(bucket)
+            if output is not None:
+                output.writerow(row)
+
+    for bucket in BUCKETS:
+        sys.stderr.write('%s\t%d\n' % (bucket, counts[bucket]))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,28 +5,166 @@ This module provides a Searcher class that performs binary search within a sorte
 to find lines that start with a given string. It assumes the file is in UTF-8 encoding
 and the lines are sorted.
 
+With use_mmap=True, the file is memory-mapped and searched as raw bytes, and only the
+returned lines are decoded. UTF-8 preserves code point order, so both modes agree.
+In both modes, an up to date sparse index built by sparse_index.py is loaded when the
+file is opened, and narrows down every search to a few lines.
+
+For skewed lookup traffic, Searcher can keep a bounded LRU cache of the results of
+recent searches, and in mmap mode a cache of the lines probed by the top levels of the
+binary search, which every search from scratch goes through. Both are cleared when the
+file changes on disk.
+
+Compressed files (gzip, bz2 or xz) are decompressed into a temporary file when opened,
+since binary search needs random access.
+
 Example:
     searcher = Searcher('file_path')
     results = searcher.find('test string')
 """
 
+import argparse
+import mmap
+import os
 import sys
-from typing import List, Optional, Tuple
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from . import file_ops_common, sparse_index
+
+# Initial step, in bytes, when galloping from one probe to the next in find_many
+_GALLOP_STEP = 4096
+# Number of leading bytes of a probed line kept in the probe cache
+_PROBE_HEAD_BYTES = 256
+
+DEFAULT_RESULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_PROBE_CACHE_BYTES = 1024 * 1024
+
+
+class _LRUCache:
+    """Least recently used cache bounded in number of entries and bytes."""
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()  # key -> (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any:
+        """Return the cached value, or None on a miss."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        """Cache a value of approximately size bytes, evicting old entries as needed."""
+        if size > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self.entries[key] = (value, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    def info(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries), 'bytes': self.size}
 
 
 class Searcher:
     """Binary search for lines starting with a given string in a sorted file."""
 
-    def __init__(self, file_path: str) -> None:
-        """Initialize with the path to the file to search."""
+    def __init__(self, file_path: str, use_mmap: bool = False, use_index: bool = True,
+                 result_cache_entries: int = 0,
+                 result_cache_bytes: int = DEFAULT_RESULT_CACHE_BYTES,
+                 probe_cache_entries: int = 0,
+                 probe_cache_bytes: int = DEFAULT_PROBE_CACHE_BYTES) -> None:
+        """Initialize with the path to the file to search.
+
+        Args:
+            file_path: Path to the sorted file
+            use_mmap: Memory-map the file and binary search on raw bytes
+            use_index: Use the sparse index sidecar of the file if it is up
+                to date
+            result_cache_entries: Number of search results to cache, 0 to disable
+            result_cache_bytes: Maximum size of the cached search results
+            probe_cache_entries: Number of binary search probes to cache, 0 to
+                disable. Needs use_mmap, or raises ValueError
+            probe_cache_bytes: Maximum size of the cached probes
+        """
         self.file_path = file_path
+        self.use_mmap = use_mmap
+        self.use_index = use_index
         self.file = None
+        self.mmap = None
+        self.index = None
+        self.file_signature = None
+        self.decompressed_path: Optional[str] = None
+        self.result_cache = (_LRUCache(result_cache_entries, result_cache_bytes)
+                             if result_cache_entries > 0 else None)
+        self.probe_cache = (_LRUCache(probe_cache_entries, probe_cache_bytes)
+                            if probe_cache_entries > 0 else None)
+        if self.probe_cache is not None and not use_mmap:
+            raise ValueError('The probe cache needs use_mmap=True')
 
     def __enter__(self) -> 'Searcher':
         """Context manager entry."""
-        self.file = open(self.file_path, 'r', encoding='utf-8', errors='replace')
+        self._open()
         return self
 
+    def _open(self) -> None:
+        """Open the file, and start from empty caches."""
+        stat = os.stat(self.file_path)
+        self.file_signature = (stat.st_size, stat.st_mtime_ns)
+        for cache in (self.result_cache, self.probe_cache):
+            if cache is not None:
+                cache.clear()
+
+        search_path = self.file_path
+        if file_ops_common.detect_compression(self.file_path) is not None:
+            self.decompressed_path = file_ops_common.decompress_to_temp(self.file_path)
+            search_path = self.decompressed_path
+
+        if self.use_mmap:
+            self.file = open(search_path, 'rb')
+            # Empty files can't be mapped, and have nothing to find anyway
+            self.file.seek(0, 2)
+            if self.file.tell() > 0:
+                self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.file = open(search_path, 'r', encoding='utf-8', errors='replace')
+        if self.use_index and self.decompressed_path is None:
+            self.index = sparse_index.load_index(self.file_path)
+
+    def _check_for_changes(self) -> None:
+        """Reopen the file and drop the caches if the file changed on disk."""
+        stat = os.stat(self.file_path)
+        if (stat.st_size, stat.st_mtime_ns) != self.file_signature:
+            self.close()
+            self._open()
+
+    def cache_info(self) -> Dict[str, Dict[str, int]]:
+        """Hits, misses, entries and bytes of the enabled caches."""
+        info = {}
+        if self.result_cache is not None:
+            info['results'] = self.result_cache.info()
+        if self.probe_cache is not None:
+            info['probes'] = self.probe_cache.info()
+        return info
+
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
         """Context manager exit."""
         self.close()
@@ -40,11 +178,13 @@ class Searcher:
         Returns:
             Tuple of (start position of line, line without newline)
         """
-        self.file.seek(pos)
-
-        # If we're not at the start of the file, read until next newline
+        # If we're not at the start of the file, read until the end of the
+        # line holding the byte before pos, so that a line starting at pos is kept
         if pos > 0:
+            self.file.seek(pos - 1)
             self.file.readline()
+        else:
+            self.file.seek(0)
 
         # Get position of complete line
         line_pos = self.file.tell()
@@ -66,26 +206,34 @@ class Searcher:
             return 0
         return -1 if a < b else 1
 
-    def _find_first_match(self, search_string: str, verbose: bool) -> Optional[int]:
+    def _find_first_match(self, search_string: str, verbose: bool,
+                          left: int = 0) -> Tuple[Optional[int], int]:
         """Binary search to find the first matching line.
         
         Args:
             search_string: String to search for
             verbose: Whether to print debug information
+            left: Position at or before the start of the first line >= search_string
             
         Returns:
-            Position of first match, or None if no match found
+            Tuple of (position of first match, or None if no match found,
+            position at or before the first line >= search_string, as narrowed
+            down by the search). Searches for greater strings can start from
+            the latter.
         """
         self.file.seek(0, 2)  # Seek to end
         file_size = self.file.tell()
 
         if file_size == 0:
-            return None
+            return None, 0
 
-        left = 0
         right = file_size
-        match_pos = None
+        if self.index is not None:
+            index_left, right = self.index.bounds(search_string.encode('utf-8'), file_size)
+            left = max(left, index_left)
+        lower_bound = left
 
+        # Search for the first line that is >= search_string
         while left < right:
             mid = (left + right) // 2
             pos, line = self._read_line_at_pos(mid)
@@ -93,37 +241,114 @@ class Searcher:
             if verbose:
                 print(f"Searching at position {mid}, found line: {line}")
 
-            if not line:  # Handle EOF
+            if pos < file_size and self._compare_strings(line, search_string) < 0:
+                # Line is less than search string
+                lower_bound = pos
+                left = pos + len(line.encode('utf-8')) + 1  # Skip current line
+            else:  # Line matches or is greater than search string, or EOF
                 right = mid
-                continue
 
-            cmp_result = self._compare_strings(line, search_string)
+        pos, line = self._read_line_at_pos(left)
+        match_pos = pos if pos < file_size and line.startswith(search_string) else None
+        return match_pos, lower_bound
 
-            if cmp_result == 0:  # Match found
-                # Found a match, but need to check if there are matches before this
-                match_pos = pos
-
-                # Try to read the previous line
-                if pos > 0:
-                    self.file.seek(pos - 1)
-                    self.file.readline()  # Read and discard partial line
-                    prev_line = self.file.readline().rstrip('\n')
-
-                    if prev_line.startswith(search_string):
-                        # There might be matches before this one
-                        right = mid
-                        continue
+    def _line_start_after(self, pos: int) -> int:
+        """Start offset of the first line starting at or after pos in the mmap."""
+        if pos == 0:
+            return 0
+        newline = self.mmap.find(b'\n', pos - 1)
+        return len(self.mmap) if newline < 0 else newline + 1
+
+    def _line_end(self, start: int) -> int:
+        """Offset of the newline ending the line starting at start in the mmap."""
+        newline = self.mmap.find(b'\n', start)
+        return len(self.mmap) if newline < 0 else newline
+
+    def _line_is_before(self, start: int, prefix: bytes) -> bool:
+        """Whether the line starting at start in the mmap sorts before prefix."""
+        # Comparing the first len(prefix) bytes of the line orders it the
+        # same way as the whole line, as long as we stop at its newline
+        end = self.mmap.find(b'\n', start, start + len(prefix))
+        if end < 0:
+            end = start + len(prefix)
+        return self.mmap[start:end] < prefix
+
+    def _lower_bound_mmap(self, prefix: bytes, left: int, right: int, verbose: bool) -> int:
+        """Binary search [left, right) of the mmap for the first line >= prefix.
 
-                # No matches before this one, we can stop
-                return match_pos
+        Args:
+            prefix: Encoded prefix to search for
+            left: Offset known to be at or before the line we look for
+            right: Offset known to be after the start of the line before it
+            verbose: Whether to print debug information
 
-            if cmp_result < 0:  # Line is less than search string
-                left = pos + len(line.encode('utf-8')) + 1  # Skip current line
-            else:  # Line is greater than search string
+        Returns:
+            Start offset of the first line >= prefix, or the file size
+        """
+        file_size = len(self.mmap)
+        while left < right:
+            mid = (left + right) // 2
+            start, head = self._probe(mid)
+            if verbose:
+                print(f"Searching at position {mid}, found line at {start}")
+            if start >= file_size or not self._probed_line_is_before(start, head, prefix):
                 right = mid
+            else:
+                # No line starting at or before start can be a match
+                left = start + 1
+        return self._line_start_after(left)
+
+    def _probe(self, pos: int) -> Tuple[int, Optional[bytes]]:
+        """Start of the first line at or after pos, and the head of that line
+        when the probe cache is enabled."""
+        if self.probe_cache is None:
+            return self._line_start_after(pos), None
+
+        probe = self.probe_cache.get(pos)
+        if probe is None:
+            start = self._line_start_after(pos)
+            end = self.mmap.find(b'\n', start, start + _PROBE_HEAD_BYTES)
+            head = self.mmap[start:end if end >= 0 else start + _PROBE_HEAD_BYTES]
+            probe = (start, head)
+            self.probe_cache.put(pos, probe, len(head) + 100)
+        return probe
+
+    def _probed_line_is_before(self, start: int, head: Optional[bytes], prefix: bytes) -> bool:
+        """Like _line_is_before, using the cached head of the line when it is long enough."""
+        if head is None or (len(head) == _PROBE_HEAD_BYTES and len(prefix) > len(head)):
+            return self._line_is_before(start, prefix)
+        return head[:len(prefix)] < prefix
+
+    def _scan_mmap(self, prefix: bytes, start: int) -> List[str]:
+        """Decode the lines starting with prefix from offset start onwards."""
+        matches = []
+        file_size = len(self.mmap)
+        while start < file_size:
+            end = self._line_end(start)
+            line = self.mmap[start:end]
+            if not line.startswith(prefix):
+                break
+            matches.append(line.decode('utf-8', errors='replace'))
+            start = end + 1
+        return matches
+
+    def _find_mmap(self, prefix: bytes, verbose: bool) -> List[str]:
+        """Binary search the mmap for the lines starting with prefix.
 
-        # If we found a match during the search, return it
-        return match_pos
+        Searches for the first line that is >= prefix, then scans forward
+        while lines start with it. Only the matching lines are decoded.
+        """
+        if self.mmap is None:
+            return []
+        left, right = self._search_bounds(prefix)
+        start = self._lower_bound_mmap(prefix, left, right, verbose)
+        return self._scan_mmap(prefix, start)
+
+    def _search_bounds(self, prefix: bytes) -> Tuple[int, int]:
+        """Initial binary search range for prefix, narrowed by the index if any."""
+        if self.index is None:
+            return 0, len(self.mmap)
+        return self.index.bounds(prefix, len(self.mmap))
 
     def find(self, search_string: str, verbose: bool = False) -> List[str]:
         """Find all lines that start with the given string using binary search.
@@ -135,13 +360,43 @@ class Searcher:
         Returns:
             List of matching lines
         """
+        if self.result_cache is None and self.probe_cache is None:
+            return self._find(search_string, verbose)
+
+        self._check_for_changes()
+        if self.result_cache is None:
+            return self._find(search_string, verbose)
+        matches = self.result_cache.get(search_string)
+        if matches is None:
+            matches = self._find(search_string, verbose)
+            self._cache_result(search_string, matches)
+        return list(matches)
+
+    def _cache_result(self, search_string: str, matches: List[str]) -> None:
+        size = 100 + len(search_string) + sum(60 + len(match) for match in matches)
+        self.result_cache.put(search_string, matches, size)
+
+    def _find(self, search_string: str, verbose: bool) -> List[str]:
+        """Uncached find."""
+        if self.use_mmap:
+            return self._find_mmap(search_string.encode('utf-8'), verbose)
+        return self._find_text(search_string, verbose)[0]
+
+    def _find_text(self, search_string: str, verbose: bool,
+                   left: int = 0) -> Tuple[List[str], int]:
+        """Find in text mode, starting from left (see _find_first_match).
+
+        Returns:
+            Tuple of (matching lines, position to start the search for the
+            next greater string from)
+        """
         matches = []
 
         # Find first match using binary search
-        first_match_pos = self._find_first_match(search_string, verbose)
+        first_match_pos, lower_bound = self._find_first_match(search_string, verbose, left)
 
         if first_match_pos is None:
-            return matches
+            return matches, lower_bound
 
         # Scan forward to collect all matches
         self.file.seek(first_match_pos)
@@ -155,13 +410,96 @@ class Searcher:
             elif self._compare_strings(line, search_string) > 0:
                 break  # Stop if we've passed possible matches
 
-        return matches
+        return matches, lower_bound
+
+    def find_many(self, search_strings: Iterable[str],
+                  verbose: bool = False) -> Dict[str, List[str]]:
+        """Find the lines starting with each of the given strings.
+
+        The probes are searched in sorted order, and each search starts where
+        the previous one ended instead of from the start of the file. In mmap
+        mode, the first line matching a probe is a lower bound for all the
+        later ones, so each search gallops forward from there (or starts from
+        the sparse index bounds). In text mode, the binary search starts from
+        the last line found to sort before the previous probe.
+
+        Args:
+            search_strings: Strings to search for at the start of lines
+            verbose: Whether to print debug information
+
+        Returns:
+            Dict mapping each search string to its list of matching lines
+        """
+        unique_strings = set(search_strings)
+        if self.result_cache is None and self.probe_cache is None:
+            return self._find_many(unique_strings, verbose)
+
+        self._check_for_changes()
+        if self.result_cache is None:
+            return self._find_many(unique_strings, verbose)
+        results = {}
+        missing = set()
+        for search_string in unique_strings:
+            matches = self.result_cache.get(search_string)
+            if matches is None:
+                missing.add(search_string)
+            else:
+                results[search_string] = list(matches)
+        for search_string, matches in self._find_many(missing, verbose).items():
+            self._cache_result(search_string, matches)
+            results[search_string] = list(matches)
+        return results
+
+    def _find_many(self, unique_strings: Iterable[str], verbose: bool) -> Dict[str, List[str]]:
+        """Uncached find_many."""
+        if not self.use_mmap:
+            # Python orders strings by code point, like the lines of the file
+            results = {}
+            lower_bound = 0
+            for search_string in sorted(unique_strings):
+                results[search_string], lower_bound = self._find_text(search_string, verbose,
+                                                                      lower_bound)
+            return results
+        if self.mmap is None:
+            return {search_string: [] for search_string in unique_strings}
+
+        file_size = len(self.mmap)
+        results = {}
+        lower_bound = 0
+        for prefix, search_string in sorted((s.encode('utf-8'), s) for s in unique_strings):
+            if self.index is not None:
+                left, right = self._search_bounds(prefix)
+                lower_bound = self._lower_bound_mmap(prefix, max(left, lower_bound), right,
+                                                     verbose)
+                results[search_string] = self._scan_mmap(prefix, lower_bound)
+                continue
+
+            # Gallop: double the step until we pass a line >= prefix
+            left = lower_bound
+            step = _GALLOP_STEP
+            while left + step < file_size:
+                start = self._line_start_after(left + step)
+                if start >= file_size or not self._line_is_before(start, prefix):
+                    break
+                left = start + 1
+                step *= 2
+            lower_bound = self._lower_bound_mmap(prefix, left, min(left + step, file_size),
+                                                 verbose)
+            results[search_string] = self._scan_mmap(prefix, lower_bound)
+        return results
 
     def close(self) -> None:
         """Close the file."""
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.index = None
         if self.file:
             self.file.close()
             self.file = None
+        if self.decompressed_path is not None:
+            os.remove(self.decompressed_path)
+            self.decompressed_path = None
 
     def __del__(self) -> None:
         """Ensure the file is closed when the object is destroyed."""
@@ -170,14 +508,32 @@ class Searcher:
 
 def main() -> None:
     """Command-line interface for the file searcher."""
-    if len(sys.argv) != 3:
-        print('Usage: python file_searcher.py filename search_string')
-        sys.exit(-1)
-
-    with Searcher(sys.argv[1]) as searcher:
-        results = searcher.find(sys.argv[2])
-        for result in results:
-            print(result)
+    argparser = argparse.ArgumentParser(
+        description='Search within a sorted file for lines starting with a string.')
+    argparser.add_argument('filename', help='Sorted, UTF-8 encoded input file')
+    argparser.add_argument('search_string', nargs='?', default='-',
+                           help='Prefix to search for. If omitted or "-", prefixes are read'
+                           ' from stdin, one per line, and every match is output as'
+                           ' "prefix<TAB>line" in the order of the prefixes')
+    argparser.add_argument('--mmap', dest='use_mmap', action='store_true',
+                           help='Memory-map the file and search on raw bytes')
+    argparser.add_argument('--output', dest='output', default=None,
+                           help='Output file instead of the standard output. It is'
+                           ' compressed if it ends with .gz, .bz2 or .xz')
+    args = argparser.parse_args()
+
+    with Searcher(args.filename, use_mmap=args.use_mmap) as searcher, \
+            file_ops_common.open_output(args.output) as output:
+        if args.search_string != '-':
+            for result in searcher.find(args.search_string):
+                output.write(result + '\n')
+            return
+
+        prefixes = [line.rstrip('\n') for line in sys.stdin]
+        results = searcher.find_many(prefixes)
+        for prefix in prefixes:
+            for result in results[prefix]:
+                output.write(prefix + '\t' + result + '\n')
 
 
 if __name__ == '__main__':
@@ -5,12 +5,41 @@
 #      FROM file1.txt
 #      WHERE col0 NOT IN ("c") AND col1 IN ("a","b")
 #      GROUP BY col0, col1
-# Currently supported aggregate operations: SUM & COUNT
+# Currently supported aggregate operations: SUM, COUNT, MIN, MAX, AVG,
+# approximate COUNT DISTINCT & percentiles
 #
 
 import os, sys, csv, argparse
-from . import csv_unicode, file_ops_common
+import hashlib, heapq, operator, re, tempfile, zlib
 from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress, islice
+from operator import itemgetter
+import json
+from . import aggregate_states, csv_unicode, file_ops_common, ingest, select_numpy, sort_merge
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Number of temp files the aggregates are hash partitioned into when spilling
+SPILL_PARTITIONS = 64
+# Partitions still too big to re-aggregate in memory are partitioned again,
+# up to that many times
+_MAX_SPILL_DEPTH = 8
+# Rough memory used by a group in the aggregates table, and by each of its values
+_GROUP_OVERHEAD = 400
+_VALUE_OVERHEAD = 100
+# Number of rows aggregated between two checks of the aggregates table size
+_SPILL_CHECK_ROWS = 4096
+# Number of rows parsed at a time, then fed to every query of a multi query scan
+_MULTI_QUERY_BATCH_ROWS = 4096
+
+# Comparison operators of the HAVING clauses, longest first
+HAVING_OPS = OrderedDict([('>=', operator.ge), ('<=', operator.le), ('!=', operator.ne),
+                          ('>', operator.gt), ('<', operator.lt), ('=', operator.eq)])
+_HAVING_CLAUSE = re.compile(r'^(\d+)(%s)(.+)$' % '|'.join(re.escape(op) for op in HAVING_OPS))
 
 
 def print_query(args, select_cols, aggregate_cols, where_filters):
@@ -27,12 +56,16 @@ def print_query(args, select_cols, aggregate_cols, where_filters):
       ', '.join(['%s(col%s)' % (args.agg_function, col) for col in aggregate_cols]) +
       '\nFROM ' + args.file +
       '\nWHERE ' + ' AND '.join(where_print) +
-      '\nGROUP BY ' + select_cols_print + '\n\n')
+      '\nGROUP BY ' + select_cols_print +
+      ('\nHAVING ' + ' AND '.join(
+          '%s(col%s) %s %s' % ((args.agg_function,) + _HAVING_CLAUSE.match(clause).groups())
+          for clause in args.having_clauses) if args.having_clauses else '') +
+      ('\nORDER BY ' + args.order_by if args.order_by else '') +
+      ('\nLIMIT %d' % args.limit if args.limit is not None else '') + '\n\n')
 
-def process_select_operations(input_file_path: str, select_cols_str: str,
-                              aggregate_cols_str: str, agg_function: str,
-                              where_clauses_list: list, delimiter_char: str) -> list:
-    # Parse the where clause
+def parse_where_clauses(where_clauses_list):
+    ''' Parse clauses like "1=a,b" and "3!=c" into a dict of the form:
+    Column number -> {'op': 'IN' or 'NOT IN', 'vals': list of values} '''
     where_filters = {}
     if where_clauses_list:
         for clause in where_clauses_list:
@@ -48,76 +81,631 @@ def process_select_operations(input_file_path: str, select_cols_str: str,
                   'op' : 'IN',
                   'vals' : clause_parts[1].split(',')
                 }
+    return where_filters
+
+def compile_where(where_filters):
+    ''' Compile the parsed where filters into a function telling whether a
+    row matches them, with frozensets of values. None when there's no filter '''
+    in_filters = [(col_num, frozenset(filtr['vals']))
+                  for col_num, filtr in where_filters.items() if filtr['op'] == 'IN']
+    not_in_filters = [(col_num, frozenset(filtr['vals']))
+                      for col_num, filtr in where_filters.items() if filtr['op'] == 'NOT IN']
+    if not in_filters and not not_in_filters:
+        return None
+    if len(in_filters) == 1 and not not_in_filters:
+        (col_num, vals), = in_filters
+        return lambda cols: cols[col_num] in vals
+    if len(not_in_filters) == 1 and not in_filters:
+        (col_num, vals), = not_in_filters
+        return lambda cols: cols[col_num] not in vals
+
+    def matches(cols):
+        for col_num, vals in in_filters:
+            if cols[col_num] not in vals:
+                return False
+        for col_num, vals in not_in_filters:
+            if cols[col_num] in vals:
+                return False
+        return True
+    return matches
+
+def compile_line_filter(where_filters):
+    ''' Compile the IN where filters into a function telling whether a raw
+    line may match them: it needs to contain one of the values of every IN
+    filter. Rows are only valid if fields aren't quoted & span a single line.
+    None when there's no IN filter '''
+    patterns = []
+    for filtr in where_filters.values():
+        if filtr['op'] == 'IN' and '' not in filtr['vals']:
+            patterns.append(re.compile('|'.join(re.escape(val) for val in
+                                                sorted(set(filtr['vals'])))))
+    if not patterns:
+        return None
+    if len(patterns) == 1:
+        return patterns[0].search
+    return lambda line: all(pattern.search(line) for pattern in patterns)
+
+def _iter_input_rows(input_file_path, delimiter_char, line_filter=None, quoted=True):
+    ''' Yield the parsed rows of the input file after its header. Lines not
+    passing line_filter are skipped without being parsed '''
+    with file_ops_common.open_input(input_file_path, 'r') as infile:
+        if line_filter is None:
+            reader = csv_unicode.UnicodeReader(infile, delimiter=delimiter_char, quoted=quoted)
+            next(reader, None)  # Skip header row
+        else:
+            next(infile, None)  # Skip header row
+            reader = csv_unicode.UnicodeReader(filter(line_filter, infile),
+                                               delimiter=delimiter_char, quoted=quoted)
+        yield from reader
+
+def parse_having_clauses(having_clauses_list):
+    ''' Parse clauses like "2>100" and "3<=0.5" into a list of
+    (aggregate column number, comparison function, number) '''
+    having_filters = []
+    for clause in having_clauses_list or []:
+        match = _HAVING_CLAUSE.match(clause)
+        if not match:
+            raise ValueError('Invalid HAVING clause: ' + clause)
+        having_filters.append((int(match.group(1)), HAVING_OPS[match.group(2)],
+                               float(match.group(3))))
+    return having_filters
+
+def parse_order_by(order_by_str, select_cols, aggregate_cols):
+    ''' Parse an ORDER BY like "2:desc,0" into a list of
+    (is aggregate, column number or position in the key, descending).
+    A column is ordered by its aggregate value if it is an aggregate column,
+    otherwise by its value in the key '''
+    order_by = []
+    for term in order_by_str.split(',') if order_by_str else []:
+        col, _, direction = term.partition(':')
+        col_num = int(col)
+        if direction not in ('', 'asc', 'desc'):
+            raise ValueError('Invalid ORDER BY direction: ' + direction)
+        if col_num in aggregate_cols:
+            order_by.append((True, col_num, direction == 'desc'))
+        elif col_num in select_cols:
+            order_by.append((False, select_cols.index(col_num), direction == 'desc'))
+        else:
+            raise ValueError('ORDER BY column %d is neither selected nor aggregated'
+                             % col_num)
+    return order_by
+
+def parse_having_and_order_by(having_clauses_list, order_by_str, select_cols,
+                              aggregate_cols):
+    ''' Parse the HAVING clauses & ORDER BY of a query, and check that the
+    HAVING columns are aggregated. Returns (having filters, order by) '''
+    having_filters = parse_having_clauses(having_clauses_list)
+    for col_num, _, _ in having_filters:
+        if col_num not in aggregate_cols:
+            raise ValueError('HAVING column %d is not aggregated' % col_num)
+    return having_filters, parse_order_by(order_by_str, select_cols, aggregate_cols)
+
+def _aggregate_value(value):
+    if isinstance(value, aggregate_states.AggregateState):
+        return value.result()
+    return value
+
+class _Descending(object):
+    ''' Wraps a key value to sort it in descending order '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+def _sort_key(order_by):
+    ''' Sort key function of (key, values) groups for the parsed ORDER BY '''
+    def sort_key(group):
+        key, values = group
+        key_cols = None
+        sort_values = []
+        for is_aggregate, col, descending in order_by:
+            if is_aggregate:
+                value = _aggregate_value(values[col])
+                # Empty aggregates, like the AVG of no value, come last
+                sort_values.append(value is None)
+                if value is not None and descending:
+                    value = -value
+                sort_values.append(value if value is not None else 0)
+            else:
+                if key_cols is None:
+                    key_cols = file_ops_common.split_key(key)
+                sort_values.append(_Descending(key_cols[col]) if descending else key_cols[col])
+        return sort_values
+    return sort_key
+
+def _select_groups(groups, having_filters, order_by, limit):
+    ''' Apply the HAVING filters, ORDER BY & LIMIT to the (key, values) groups.
+    With a LIMIT, the groups are ordered in a heap of LIMIT groups, and ties
+    keep their order of first occurrence '''
+    if having_filters:
+        groups = ((key, values) for key, values in groups
+                  if all(_aggregate_value(values[col_num]) is not None and
+                         compare(_aggregate_value(values[col_num]), number)
+                         for col_num, compare, number in having_filters))
+    if order_by and limit is not None:
+        return heapq.nsmallest(limit, groups, key=_sort_key(order_by))
+    if order_by:
+        return sorted(groups, key=_sort_key(order_by))
+    if limit is not None:
+        return islice(groups, limit)
+    return groups
 
+def iter_select_operations(input_file_path: str, select_cols_str: str,
+                           aggregate_cols_str: str, agg_function: str,
+                           where_clauses_list: list, delimiter_char: str,
+                           engine: str = 'python', jobs: int = 1,
+                           memory_limit: int = 0, having_clauses_list: list = None,
+                           order_by_str: str = '', limit: int = None,
+                           prefilter: bool = None, quoted: bool = True):
+    ''' Run the query and yield the output rows one at a time.
+    engine is either "python", or "numpy" for the vectorized engine of
+    select_numpy.py, which gives the same output.
+    With jobs > 1, the "python" engine aggregates ranges of the file in that
+    many processes. It assumes one row per line, and SUMs may differ in the
+    last digits since the values are added up in a different order.
+    With a memory_limit in bytes, the single process "python" engine spills
+    partial aggregates to disk when there are too many groups to fit.
+    having_clauses_list filters the groups on their aggregate values, e.g.
+    "2>=100", and order_by_str orders them, e.g. "2:desc,0". Only the first
+    limit groups are output.
+    With quoted=False, lines are split on the delimiter without looking for
+    quoted fields, and unless prefilter is False, lines that don't contain
+    any of the values of an IN where clause are skipped before being parsed.
+    A quoted field can hold a value spelled differently or span lines, so
+    prefilter=True with quoted fields raises a ValueError.
+    When the file has a fresh columnar cache (see ingest.py), it is read
+    instead of the file, in a single process '''
+    if prefilter is None:
+        prefilter = not quoted
+    elif prefilter and quoted:
+        raise ValueError('The prefilter needs unquoted fields (quoted=False)')
+    where_filters = parse_where_clauses(where_clauses_list)
     select_cols = [int(col) for col in select_cols_str.split(',')]
     aggregate_cols = [int(col) for col in aggregate_cols_str.split(',')]
+    having_filters, order_by = parse_having_and_order_by(having_clauses_list, order_by_str,
+                                                         select_cols, aggregate_cols)
 
+    groups = _iter_groups(input_file_path, select_cols, aggregate_cols, agg_function,
+                          where_filters, delimiter_char, engine, jobs, memory_limit,
+                          prefilter, quoted)
+    for key, values in _select_groups(groups, having_filters, order_by, limit):
+        yield _output_row(key, values)
+
+def _iter_groups(input_file_path, select_cols, aggregate_cols, agg_function, where_filters,
+                 delimiter_char, engine, jobs, memory_limit, prefilter, quoted=True):
+    ''' Run the aggregation, and yield the (key, values) groups in order of
+    first occurrence of the keys '''
+    cache = ingest.load_cache(input_file_path, delimiter_char, quoted)
+    if cache is not None:
+        with cache:
+            needed_cols = set(select_cols) | set(aggregate_cols) | set(where_filters)
+            if cache.has_columns(needed_cols):
+                if engine == 'numpy':
+                    yield from select_numpy.iter_groups_cached(
+                        cache, select_cols, aggregate_cols, agg_function, where_filters)
+                    return
+                if memory_limit:
+                    yield from _spilling_aggregates(cache.iter_rows(needed_cols), select_cols,
+                                                    aggregate_cols, agg_function,
+                                                    where_filters, memory_limit)
+                    return
+                aggregates = _aggregate_cached(cache, select_cols, aggregate_cols,
+                                               agg_function, where_filters)
+                yield from aggregates.items()
+                return
+
+    line_filter = compile_line_filter(where_filters) if prefilter else None
+    if engine == 'numpy':
+        yield from select_numpy.iter_groups_numpy(
+            input_file_path, select_cols, aggregate_cols, agg_function,
+            where_filters, delimiter_char, line_filter=line_filter, quoted=quoted)
+        return
+
+    if jobs > 1:
+        if memory_limit:
+            # The partial aggregates of every range are merged in memory
+            raise ValueError('A memory limit can\'t be used with several jobs')
+        aggregates = _parallel_aggregates(input_file_path, select_cols, aggregate_cols,
+                                          agg_function, where_filters, delimiter_char, jobs,
+                                          prefilter, quoted)
+    elif memory_limit:
+        rows = _iter_input_rows(input_file_path, delimiter_char, line_filter, quoted)
+        yield from _spilling_aggregates(rows, select_cols, aggregate_cols,
+                                        agg_function, where_filters, memory_limit)
+        return
+    else:
+        # Go through the input file and do the aggregation
+        rows = _iter_input_rows(input_file_path, delimiter_char, line_filter, quoted)
+        aggregates = _aggregate_rows(rows, select_cols, aggregate_cols,
+                                     agg_function, where_filters)
+
+    # Output the remaining keys
+    yield from aggregates.items()
+
+def _output_row(key, values):
+    op_cols = file_ops_common.split_key(key)
+    # We output the aggregate column in the order they are in the input file
+    for col, value in sorted(values.items()):
+        op_cols += [str(value)]
+    return op_cols
+
+def _aggregate_rows(rows, select_cols, aggregate_cols, agg_function, where_filters,
+                    aggregates=None):
+    ''' Filter & aggregate the rows, into aggregates if given. Returns the aggregates '''
     # The structure where we save the aggregated values
     # It is a nested dictionary for the form:
     # Select Keys -> Aggregate Column -> Aggregate value
+    if aggregates is None:
+        aggregates = {}
+    if agg_function in aggregate_states.NUMERIC_FUNCTIONS:
+        new_state = None
+    else:
+        try:
+            new_state = aggregate_states.state_factory(agg_function)
+        except ValueError as e:
+            sys.stderr.write(str(e))
+            sys.exit(-1)
+
+    # Where filters
+    matches = compile_where(where_filters)
+    if matches is not None:
+        rows = filter(matches, rows)
+
+    for cols in rows:
+        # Generate the key from the select columns
+        key = file_ops_common.get_key(cols, select_cols)
+        if key not in aggregates: aggregates[key] = defaultdict(int)
+
+        # Go over each aggregate column and add it to the final structure
+        for col_num in aggregate_cols:
+            if agg_function == 'sum':
+                aggregates[key][col_num] += float(cols[col_num])
+            elif agg_function == 'count':
+                aggregates[key][col_num] += 1
+            else:
+                state = aggregates[key].get(col_num)
+                if state is None:
+                    state = aggregates[key][col_num] = new_state()
+                state.add(cols[col_num])
+    return aggregates
+
+def _aggregate_cached(cache, select_cols, aggregate_cols, agg_function, where_filters):
+    ''' _aggregate_rows over the columnar cache of the input file. The where
+    filters and the grouping work on the dictionary codes & numbers of the
+    columns, which are only turned into text for the output keys '''
+    if agg_function in aggregate_states.NUMERIC_FUNCTIONS:
+        new_state = None
+    else:
+        try:
+            new_state = aggregate_states.state_factory(agg_function)
+        except ValueError as e:
+            sys.stderr.write(str(e))
+            sys.exit(-1)
+
+    # Where filters, as the sets of codes or numbers matching their values
+    rows = range(cache.num_rows)
+    for col_num, filtr in where_filters.items():
+        column = cache.column(col_num)
+        items = column.matching(filtr['vals'])
+        matches = map(items.__contains__, map(column.data.__getitem__, rows))
+        if filtr['op'] != 'IN':
+            matches = map(operator.not_, matches)
+        rows = list(compress(rows, matches))
+
+    # Group the rows on the tuples of codes & numbers of the select columns
+    select_columns = [cache.column(col_num) for col_num in select_cols]
+    keys = zip(*[map(column.data.__getitem__, rows) for column in select_columns])
+    aggregate_columns = [(col_num, cache.column(col_num)) for col_num in aggregate_cols]
+    groups = {}
+    for row, key in zip(rows, keys):
+        values = groups.get(key)
+        if values is None:
+            values = groups[key] = defaultdict(int)
+        for col_num, column in aggregate_columns:
+            if agg_function == 'sum':
+                value = column.data[row]
+                values[col_num] += float(column.dictionary[value]
+                                         if column.dictionary is not None else value)
+            elif agg_function == 'count':
+                values[col_num] += 1
+            else:
+                state = values.get(col_num)
+                if state is None:
+                    state = values[col_num] = new_state()
+                state.add(column.text(column.data[row]))
+
+    # Different codes may still make the same key, like in _aggregate_rows
     aggregates = {}
+    for key, values in groups.items():
+        texts = [column.text(item) for column, item in zip(select_columns, key)]
+        merge_aggregates(aggregates, {file_ops_common.KEY_DELIMITER.join(texts): values})
+    return aggregates
 
-    # Go through the input file and do the aggregation
-    with open(input_file_path, 'r') as infile:
-        reader = csv_unicode.UnicodeReader(infile, delimiter=delimiter_char)
-        next(reader, None)  # Skip header row
-        for cols in reader:
-            # Where filters
-            skip = False
-            for col_num, filtr in where_filters.items():
-                if ((filtr['op'] == 'IN' and cols[col_num] not in filtr['vals']) or
-                    (filtr['op'] == 'NOT IN' and cols[col_num] in filtr['vals'])):
-                    skip = True
-                    break
-            if skip:
+def _merge_values(values, partial_values):
+    ''' Merge the partial aggregate values of a key. SUM & COUNT simply add
+    up, the other aggregate states are merged '''
+    for col_num, value in partial_values.items():
+        if col_num not in values:
+            values[col_num] = value
+        elif isinstance(value, aggregate_states.AggregateState):
+            values[col_num].merge(value)
+        else:
+            values[col_num] += value
+
+def merge_aggregates(aggregates, partial):
+    ''' Merge partial aggregates into aggregates. Keys new to aggregates are
+    appended in their partial order '''
+    for key, partial_values in partial.items():
+        if key not in aggregates:
+            aggregates[key] = partial_values
+        else:
+            _merge_values(aggregates[key], partial_values)
+    return aggregates
+
+def _spilling_aggregates(rows, select_cols, aggregate_cols, agg_function, where_filters,
+                         memory_limit, num_partitions=SPILL_PARTITIONS, temp_dir=None):
+    ''' Aggregate with bounded memory. Whenever the aggregates table grows past
+    memory_limit, its partial aggregates are hash partitioned by key to temp
+    files and the table is emptied. Each partition is then re-aggregated on
+    its own, partitioning it again if it still holds too many keys, and the
+    partitions are merged back in order of first occurrence of the keys.
+    Yields (key, values) '''
+    group_size = _GROUP_OVERHEAD + _VALUE_OVERHEAD * len(set(aggregate_cols))
+    max_groups = max(1, memory_limit // group_size)
+
+    with tempfile.TemporaryDirectory(prefix='fileops-agg-', dir=temp_dir) as spill_dir:
+        writers = {}
+        spill_round = 0
+        aggregates = {}
+        while True:
+            batch = list(islice(rows, _SPILL_CHECK_ROWS))
+            _aggregate_rows(batch, select_cols, aggregate_cols, agg_function,
+                            where_filters, aggregates)
+            if not batch and not writers:
+                # Everything fit in memory
+                yield from aggregates.items()
+                return
+            if batch and len(aggregates) <= max_groups:
                 continue
 
-            # Generate the key from the select columns
-            key = file_ops_common.get_key(cols, select_cols)
-            if key not in aggregates: aggregates[key] = defaultdict(int)
-
-            # Go over each aggregate column and add it to the final structure
-            for col_num in aggregate_cols:
-                if agg_function == 'sum':
-                    aggregates[key][col_num] += float(cols[col_num])
-                elif agg_function == 'count':
-                    aggregates[key][col_num] += 1
-                else:
-                    sys.stderr.write('Invalid aggregate function: ' + agg_function)
-                    sys.exit(-1)
-    
-    output_rows = []
-    # Output the remaining keys
-    for key in aggregates:
-        op_cols = file_ops_common.split_key(key)
-        # We output the aggregate column in the order they are in the input file
-        for col, value in sorted(aggregates[key].items()):
-            op_cols += [str(value)]
-        output_rows.append(op_cols)
-    return output_rows
+            # (spill round, position in the table) sorts the keys of the
+            # partial aggregates in order of first occurrence in the file
+            _spill(((key, (spill_round, position), values)
+                    for position, (key, values) in enumerate(aggregates.items())),
+                   0, num_partitions, os.path.join(spill_dir, 'part'), writers)
+            aggregates = {}
+            spill_round += 1
+            if not batch:
+                break
+
+        results = []
+        for writer, num_records in writers.values():
+            writer.close()
+            _merge_partition(writer.file.name, num_records, max_groups, num_partitions, 1,
+                             results)
+
+        results = sort_merge.reduce_runs(results, spill_dir)
+        for _, key, values in heapq.merge(*[sort_merge.read_records(path) for path in results],
+                                          key=itemgetter(0)):
+            yield key, values
+
+def _spill_partition(key, depth, num_partitions):
+    ''' Partition of a key when spilling at a depth. Every depth hashes the
+    keys differently, so the keys of a partition spilled again spread out '''
+    if not depth:
+        return zlib.crc32(key.encode('utf-8')) % num_partitions
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8,
+                             salt=depth.to_bytes(8, 'little')).digest()
+    return int.from_bytes(digest, 'little') % num_partitions
+
+def _spill(records, depth, num_partitions, path_prefix, writers):
+    ''' Hash partition (key, order, values) records to temp files. writers
+    maps a partition to [RecordWriter, number of records], and the files are
+    only created for the partitions that get records '''
+    for record in records:
+        partition = _spill_partition(record[0], depth, num_partitions)
+        writer = writers.get(partition)
+        if writer is None:
+            writer = writers[partition] = [
+                sort_merge.RecordWriter('%s-%04d' % (path_prefix, partition)), 0]
+        writer[0].write(record)
+        writer[1] += 1
+
+def _merge_partition(path, num_records, max_groups, num_partitions, depth, results):
+    ''' Re-aggregate a spilled partition into a temp file of (order, key,
+    values) records sorted by order, whose path is appended to results.
+    Whenever more than max_groups keys are held, they are partitioned to
+    temp files again, as many as needed for the records of the partition,
+    and those are merged the same way '''
+    fan_out = min(num_partitions, max(2, -(-num_records // max_groups)))
+    # key -> [first occurrence, values]
+    merged = {}
+    writers = {}
+    for key, order, values in sort_merge.read_records(path):
+        entry = merged.get(key)
+        if entry is None:
+            merged[key] = [order, values]
+        else:
+            entry[0] = min(entry[0], order)
+            _merge_values(entry[1], values)
+        if len(merged) > max_groups and depth < _MAX_SPILL_DEPTH:
+            _spill(((spilled_key, spilled_order, spilled_values)
+                    for spilled_key, (spilled_order, spilled_values) in merged.items()),
+                   depth, fan_out, path, writers)
+            merged = {}
+    os.unlink(path)
+
+    if writers:
+        _spill(((key, order, values) for key, (order, values) in merged.items()),
+               depth, fan_out, path, writers)
+        del merged
+        for writer, sub_records in writers.values():
+            writer.close()
+            _merge_partition(writer.file.name, sub_records, max_groups, num_partitions,
+                             depth + 1, results)
+        return
+
+    result_path = path + '-sorted'
+    sort_merge.write_records(result_path, sorted((order, key, values)
+                                                 for key, (order, values) in merged.items()))
+    results.append(result_path)
+
+def _aggregate_range(input_file_path, start, end, select_cols, aggregate_cols,
+                     agg_function, where_filters, delimiter_char, prefilter, quoted):
+    ''' Worker: aggregate the lines starting within [start, end) of the file '''
+    lines = file_ops_common.iter_range_lines(input_file_path, start, end)
+    if start == 0:
+        next(lines, None)  # Skip header row
+    line_filter = compile_line_filter(where_filters) if prefilter else None
+    if line_filter is not None:
+        lines = filter(line_filter, lines)
+    rows = csv_unicode.UnicodeReader(lines, delimiter=delimiter_char, quoted=quoted)
+    return _aggregate_rows(rows, select_cols, aggregate_cols, agg_function, where_filters)
+
+def _parallel_aggregates(input_file_path, select_cols, aggregate_cols, agg_function,
+                         where_filters, delimiter_char, jobs, prefilter=False, quoted=True):
+    ''' Map-reduce aggregation: the file is split into line aligned byte ranges
+    that are aggregated by a pool of processes, and the partial aggregates are
+    merged in file order, so the keys keep their order of first occurrence '''
+    file_ops_common.require_uncompressed('--jobs', input_file_path)
+    ranges = file_ops_common.split_line_ranges(input_file_path, jobs)
+    aggregates = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_aggregate_range, input_file_path, start, end, select_cols,
+                               aggregate_cols, agg_function, where_filters, delimiter_char,
+                               prefilter, quoted)
+                   for start, end in ranges]
+        for future in futures:
+            merge_aggregates(aggregates, future.result())
+    return aggregates
+
+def process_select_operations(input_file_path: str, select_cols_str: str,
+                              aggregate_cols_str: str, agg_function: str,
+                              where_clauses_list: list, delimiter_char: str,
+                              engine: str = 'python', jobs: int = 1,
+                              memory_limit: int = 0, having_clauses_list: list = None,
+                              order_by_str: str = '', limit: int = None,
+                              prefilter: bool = None, quoted: bool = True) -> list:
+    return list(iter_select_operations(input_file_path, select_cols_str,
+                                       aggregate_cols_str, agg_function,
+                                       where_clauses_list, delimiter_char, engine, jobs,
+                                       memory_limit, having_clauses_list, order_by_str,
+                                       limit, prefilter, quoted))
+
+# Keys of a query spec, with their defaults. They are the same as the
+# command line options
+QUERY_SPEC_DEFAULTS = OrderedDict([
+    ('select_cols', '0'), ('aggregate_cols', '1'), ('aggregate_function', 'sum'),
+    ('where_clauses', None), ('having', None), ('order_by', ''), ('limit', None),
+    ('output', None)])
+
+def load_query_specs(spec_path):
+    ''' Load a list of query specs from a JSON file, or a YAML one (.yaml or
+    .yml) if PyYAML is installed. Each spec is an object with keys from
+    QUERY_SPEC_DEFAULTS. Returns the specs with the defaults filled in, and
+    the aggregate functions checked and lower cased '''
+    with open(spec_path, 'r', encoding='utf-8') as f:
+        if spec_path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError('YAML query specs require PyYAML. Install it with:'
+                                  ' pip install fileops[yaml]')
+            specs = yaml.safe_load(f)
+        else:
+            specs = json.load(f)
+    if not isinstance(specs, list):
+        raise ValueError('The query specs should be a list')
+
+    queries = []
+    for num, spec in enumerate(specs, 1):
+        unknown = set(spec) - set(QUERY_SPEC_DEFAULTS)
+        if unknown:
+            raise ValueError('Unknown query spec keys: ' + ', '.join(sorted(unknown)))
+        query = OrderedDict(QUERY_SPEC_DEFAULTS)
+        query.update(spec)
+        try:
+            query['aggregate_function'] = aggregate_states.check_function(
+                str(query['aggregate_function']))
+        except argparse.ArgumentTypeError as e:
+            raise ValueError('Query spec %d: %s' % (num, e))
+        queries.append(query)
+    return queries
+
+def multi_select_operations(input_file_path, queries, delimiter_char, quoted=True):
+    ''' Run several queries in a single scan of the input file. queries are
+    specs like the ones of load_query_specs. Each row is parsed once and fed
+    to the filters & aggregates of every query. The rows come from the
+    columnar cache of the file when it is fresh. Returns a list with an
+    iterator over the output rows of each query '''
+    parsed = []
+    for query in queries:
+        select_cols = [int(col) for col in str(query['select_cols']).split(',')]
+        aggregate_cols = [int(col) for col in str(query['aggregate_cols']).split(',')]
+        having_filters, order_by = parse_having_and_order_by(query['having'],
+                                                             query['order_by'],
+                                                             select_cols, aggregate_cols)
+        parsed.append((select_cols, aggregate_cols, query['aggregate_function'],
+                       parse_where_clauses(query['where_clauses']), having_filters,
+                       order_by, query['limit'], {}))
+
+    cache = ingest.load_cache(input_file_path, delimiter_char, quoted)
+    needed_cols = set()
+    for select_cols, aggregate_cols, _, where_filters, _, _, _, _ in parsed:
+        needed_cols |= set(select_cols) | set(aggregate_cols) | set(where_filters)
+    if cache is not None and not cache.has_columns(needed_cols):
+        cache.close()
+        cache = None
+
+    with cache or file_ops_common.open_input(input_file_path, 'r') as infile:
+        if cache is not None:
+            reader = cache.iter_rows(needed_cols)
+        else:
+            reader = csv_unicode.UnicodeReader(infile, delimiter=delimiter_char, quoted=quoted)
+            next(reader, None)  # Skip header row
+        while True:
+            rows = list(islice(reader, _MULTI_QUERY_BATCH_ROWS))
+            if not rows:
+                break
+            for (select_cols, aggregate_cols, agg_function, where_filters,
+                 _, _, _, aggregates) in parsed:
+                _aggregate_rows(rows, select_cols, aggregate_cols, agg_function,
+                                where_filters, aggregates)
+
+    return [(_output_row(key, values)
+             for key, values in _select_groups(aggregates.items(), having_filters,
+                                               order_by, limit))
+            for _, _, _, _, having_filters, order_by, limit, aggregates in parsed]
+
+def process_multi_select_operations(input_file_path, queries, delimiter_char, quoted=True):
+    return [list(rows) for rows in multi_select_operations(input_file_path, queries,
+                                                           delimiter_char, quoted)]
 
 def main():
     ''' Do SQL-like operations on a delimited text file'''
 
     args = parse_args()
 
+    if args.queries:
+        queries = load_query_specs(args.queries)
+        for query in queries:
+            if not query['output']:
+                sys.stderr.write('Every query spec needs an "output" file\n')
+                sys.exit(-1)
+        results = multi_select_operations(args.file, queries, args.delim, args.quoted)
+        for query, output_rows in zip(queries, results):
+            with file_ops_common.open_output(query['output']) as f:
+                output = csv_unicode.BufferedWriter(f, delimiter=args.delim)
+                output.writerows(output_rows)
+        return
+
     # Parse the where clause for print_query
-    where_filters = {}
-    if args.where_clauses:
-        for clause in args.where_clauses:
-            if '!=' in clause:
-                clause_parts = clause.split('!=')
-                where_filters[int(clause_parts[0])] = {
-                  'op' : 'NOT IN',
-                  'vals' : clause_parts[1].split(',')
-                }
-            elif '=' in clause:
-                clause_parts = clause.split('=')
-                where_filters[int(clause_parts[0])] = {
-                  'op' : 'IN',
-                  'vals' : clause_parts[1].split(',')
-                }
-    
+    where_filters = parse_where_clauses(args.where_clauses)
+
     select_cols_int = [int(col) for col in args.select_cols.split(',')]
     aggregate_cols_int = [int(col) for col in args.aggregate_cols.split(',')]
 
@@ -126,13 +714,16 @@ def main():
         # but parsed lists/dicts for select_cols, aggregate_cols, and where_filters
         print_query(args, select_cols_int, aggregate_cols_int, where_filters)
 
-    output_rows = process_select_operations(args.file, args.select_cols,
-                                            args.aggregate_cols, args.agg_function,
-                                            args.where_clauses, args.delim)
+    output_rows = iter_select_operations(args.file, args.select_cols,
+                                         args.aggregate_cols, args.agg_function,
+                                         args.where_clauses, args.delim, args.engine,
+                                         args.jobs, args.memory_limit, args.having_clauses,
+                                         args.order_by, args.limit, args.prefilter,
+                                         args.quoted)
 
-    output = csv_unicode.UnicodeWriter(sys.stdout, delimiter=args.delim)
-    for row in output_rows:
-        output.writerow(row)
+    with file_ops_common.open_output(args.output) as f:
+        output = csv_unicode.BufferedWriter(f, delimiter=args.delim)
+        output.writerows(output_rows)
 
 
 class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter,
@@ -141,7 +732,7 @@ class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter,
 
 def parse_args():
     desc = 'Do SQL-like operations on a delimited files. Currently supported '
-    'aggregate operations: SUM & COUNT.'
+    'aggregate operations: SUM, COUNT, MIN, MAX, AVG, COUNT DISTINCT & percentiles.'
 
     epilog = '''Example:
 
@@ -168,9 +759,57 @@ GROUP BY col0, col1'''
     parser.add_argument('-d', '--delim', dest='delim', default='\t',
                         help='Delimiter for the input & output files. E.g. ",".')
     parser.add_argument('-f', '--aggregate_function', dest='agg_function',
-                        choices=['sum', 'count'],
+                        type=aggregate_states.check_function,
                         default='sum',
-                        help='Aggregate function. Needs to be either "sum" or "count".')
+                        help='Aggregate function. One of "sum", "count", "min", "max", "avg",'
+                        ' "count_distinct" (approximate, HyperLogLog), "median" or a'
+                        ' percentile like "p95" (approximate, KLL sketch). The "numpy"'
+                        ' engine only supports "sum" & "count".')
+    parser.add_argument('-e', '--engine', dest='engine', default='python',
+                        choices=['python', 'numpy'],
+                        help='Execution engine. "numpy" reads the file in large chunks and'
+                        ' filters & aggregates them with vectorized NumPy operations.'
+                        ' It requires NumPy and gives the same output.')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of processes for the "python" engine. The file is split'
+                        ' in that many ranges of lines which are aggregated in parallel.'
+                        ' Assumes that quoted fields don\'t contain line breaks.')
+    parser.add_argument('-m', '--memory-limit', dest='memory_limit',
+                        type=file_ops_common.parse_size, default=None,
+                        help='Approximate memory budget for the aggregates of the "python"'
+                        ' engine, e.g. "2G". Past it, partial aggregates are spilled to'
+                        ' temp files and re-aggregated at the end. Can\'t be used with'
+                        ' --jobs.')
+    parser.add_argument('--having', dest='having_clauses', action='append',
+                        help='HAVING clause on an aggregate column, which can be repeated.'
+                        ' E.g. "2>=100" keeps the groups whose aggregate of col2 is at least'
+                        ' 100. Operators: =, !=, <, <=, >, >=.')
+    parser.add_argument('-o', '--order-by', dest='order_by', default='',
+                        help='ORDER BY columns, each optionally followed by ":desc". E.g.'
+                        ' "2:desc,0". Aggregate columns are ordered by their aggregate'
+                        ' value, select columns by their value.')
+    parser.add_argument('-l', '--limit', dest='limit', type=int, default=None,
+                        help='Only output that many groups. With --order-by, the top groups'
+                        ' are kept in a bounded heap instead of sorting all of them.')
+    parser.add_argument('-p', '--prefilter', dest='prefilter', action='store_true',
+                        default=None,
+                        help='Skip the lines that contain none of the values of an IN where'
+                        ' clause before parsing them. Needs --no-quoting, which turns it'
+                        ' on by default.')
+    parser.add_argument('--no-quoting', dest='quoted', action='store_false',
+                        help='The input has no quoted fields: split every line on the'
+                        ' delimiter, keeping quote characters as is. By default, only the'
+                        ' lines holding a quote character are parsed as CSV.')
+    parser.add_argument('--output', dest='output', default=None,
+                        help='Output file instead of the standard output. It is compressed'
+                        ' if it ends with .gz, .bz2 or .xz.')
+    parser.add_argument('-q', '--queries', dest='queries', default=None,
+                        help='JSON (or YAML, with PyYAML) file with a list of queries to run'
+                        ' in a single scan of the input file, e.g. [{"select_cols": "0",'
+                        ' "aggregate_cols": "2", "aggregate_function": "sum",'
+                        ' "where_clauses": ["1=a"], "output": "out.txt"}]. Other keys:'
+                        ' "having", "order_by" & "limit". Outputs ending with .gz, .bz2'
+                        ' or .xz are compressed. The other query options are ignored.')
     parser.add_argument('-v', '--verbose', action='store_true', dest='verbose')
     parser.add_argument(
         '-w', '--where-clauses', dest='where_clauses', nargs='*',
@@ -181,8 +820,19 @@ GROUP BY col0, col1'''
         If present, this should be the last argument in your command!''')
 
     args = parser.parse_args()
-
-    args.agg_function = args.agg_function.lower()
+    if args.jobs > 1 and args.memory_limit:
+        parser.error('--memory-limit can\'t be used with --jobs')
+    if args.prefilter and args.quoted:
+        parser.error('--prefilter needs --no-quoting')
+    if not args.queries:
+        # Report bad clauses like the other bad arguments, and before
+        # print_query prints them
+        try:
+            parse_having_and_order_by(args.having_clauses, args.order_by,
+                                      [int(col) for col in args.select_cols.split(',')],
+                                      [int(col) for col in args.aggregate_cols.split(',')])
+        except ValueError as e:
+            parser.error(str(e))
 
     return args
 
@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+"""Persistent hash index of the rows of a delimited file, by key.
+
+Indexing a file records, for a set of key columns, the 64-bit digest of the
+key of every row and the byte offset of the row, in a sidecar file next to it
+(``<file>.<key columns>.hidx``). The entries are grouped in hash buckets, so
+a lookup reads a couple of entries and then parses the matching rows only.
+
+The sidecar is memory-mapped when it is opened, so a join against an indexed
+file starts without reading it. Its header records the size and modification
+time of the source file, the key columns, case folding, delimiter and quoting
+the index was built with, so a stale or mismatching index is ignored. When a
+fresh index of the right file exists for the key columns, the "hash" algorithm
+of file_intersection.py and file_diff.py probes it instead of loading either
+file in memory, caching the lookups of the most recent keys only.
+
+Example:
+    python -m fileops.hash_index -d , -k 0,2 reference.csv
+"""
+
+import argparse
+import json
+import mmap
+import os
+import sys
+from array import array
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from . import file_ops_common
+
+INDEX_SUFFIX = '.hidx'
+INDEX_VERSION = 1
+
+# Typecode of the bucket starts, digests and offsets
+_ENTRY_TYPE = 'Q'
+_ENTRY_SIZE = 8
+
+# Number of recent keys whose lookup result the joins probing an index keep
+LOOKUP_CACHE_ENTRIES = 1 << 16
+
+
+def index_path_for(file_path: str, key_cols: List[int], lower_case: bool = False) -> str:
+    """Path of the sidecar index of a delimited file for a key. A file can
+    have an index for each set of key columns."""
+    return '%s.%s%s%s' % (file_path, '_'.join(str(col) for col in key_cols),
+                          '.i' if lower_case else '', INDEX_SUFFIX)
+
+
+def _file_signature(file_path: str) -> dict:
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class HashIndex:
+    """Memory-mapped hash index of a file, with the file open to read the rows.
+
+    Usable as a context manager, which closes it.
+
+    Attributes:
+        file_path: Path to the indexed file
+        num_rows: Number of rows of the file
+    """
+
+    def __init__(self, file_path: str, index_file: BinaryIO, header: dict,
+                 data_offset: int) -> None:
+        self.file_path = file_path
+        self.num_rows = header['rows']
+        self._delim = header['delimiter']
+        self._quoted = header['quoted']
+        self._get_key = file_ops_common.key_getter(header['key_cols'], header['lower_case'])
+        self._mask = header['buckets'] - 1
+
+        self._map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_RANDOM'):
+            # Lookups touch a few scattered pages, reading ahead is wasted
+            self._map.madvise(mmap.MADV_RANDOM)
+        view = memoryview(self._map)
+        start = data_offset
+        sizes = (header['buckets'] + 1, self.num_rows, self.num_rows)
+        self._views = [view]
+        for size in sizes:
+            end = start + size * _ENTRY_SIZE
+            self._views.append(view[start:end].cast(_ENTRY_TYPE))
+            start = end
+        self._buckets, self._digests, self._offsets = self._views[1:]
+        self._file = open(file_path, 'rb')
+
+    def __enter__(self) -> 'HashIndex':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Unmap the index and close the indexed file."""
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._map.close()
+        self._file.close()
+
+    def candidates(self, key: str) -> List[int]:
+        """Offsets of the rows whose key has the same digest as key, in file
+        order. Different keys can share a digest, see iter_rows."""
+        digest = file_ops_common.hash_key(key)
+        bucket = digest & self._mask
+        digests = self._digests
+        offsets = self._offsets
+        return [offsets[i] for i in range(self._buckets[bucket], self._buckets[bucket + 1])
+                if digests[i] == digest]
+
+    def iter_rows(self, key: str) -> Iterator[Tuple[int, List[str]]]:
+        """Yield (byte offset, cols) of the rows whose key is key, in file order.
+        The key is built like file_ops_common.key_getter builds it."""
+        for offset in self.candidates(key):
+            cols = file_ops_common.read_row_at(self._file, offset, self._delim, self._quoted)
+            if self._get_key(cols) == key:
+                yield offset, cols
+
+    def first_row(self, key: str) -> Optional[Tuple[int, List[str]]]:
+        """(byte offset, cols) of the first row whose key is key, or None."""
+        return next(self.iter_rows(key), None)
+
+    def __contains__(self, key: str) -> bool:
+        return self.first_row(key) is not None
+
+
+def build_index(file_path: str, key_cols: List[int], delim: str = '\t',
+                lower_case: bool = False, quoted: bool = True,
+                index_path: Optional[str] = None) -> HashIndex:
+    """Build the hash index of a delimited file and write its sidecar.
+
+    Args:
+        file_path: Path to the delimited file. It can't be compressed, since
+            its rows are read at their byte offset
+        key_cols: Key columns of the rows
+        delim: Delimiter of the file
+        lower_case: Whether the keys are lower cased
+        quoted: Whether fields may be quoted
+        index_path: Path of the sidecar (defaults to index_path_for(...))
+
+    Returns:
+        The index, opened
+    """
+    file_ops_common.require_uncompressed('A hash index', file_path)
+    signature = _file_signature(file_path)
+    get_row_key = file_ops_common.key_getter(key_cols, lower_case)
+
+    digests = array(_ENTRY_TYPE)
+    offsets = array(_ENTRY_TYPE)
+    for offset, cols in file_ops_common.iter_offset_rows(file_path, delim, quoted):
+        digests.append(file_ops_common.hash_key(get_row_key(cols)))
+        offsets.append(offset)
+    num_rows = len(digests)
+
+    # A power of 2 of buckets, about 1 row each
+    num_buckets = 1
+    while num_buckets < num_rows:
+        num_buckets <<= 1
+    mask = num_buckets - 1
+
+    # Counting sort of the entries by bucket, keeping file order within a bucket
+    starts = array(_ENTRY_TYPE, bytes(_ENTRY_SIZE * (num_buckets + 1)))
+    for digest in digests:
+        starts[(digest & mask) + 1] += 1
+    for bucket in range(num_buckets):
+        starts[bucket + 1] += starts[bucket]
+    positions = starts[:-1]
+    bucket_digests = array(_ENTRY_TYPE, bytes(_ENTRY_SIZE * num_rows))
+    bucket_offsets = array(_ENTRY_TYPE, bytes(_ENTRY_SIZE * num_rows))
+    for digest, offset in zip(digests, offsets):
+        bucket = digest & mask
+        position = positions[bucket]
+        bucket_digests[position] = digest
+        bucket_offsets[position] = offset
+        positions[bucket] = position + 1
+    del digests, offsets, positions
+
+    header = dict(signature, version=INDEX_VERSION, byteorder=sys.byteorder,
+                  key_cols=key_cols, lower_case=lower_case, delimiter=delim, quoted=quoted,
+                  rows=num_rows, buckets=num_buckets)
+    # The header line is padded so that the arrays after it are aligned
+    header_line = json.dumps(header).encode('utf-8')
+    data_offset = -(-(len(header_line) + 1) // _ENTRY_SIZE) * _ENTRY_SIZE
+
+    index_path = index_path or index_path_for(file_path, key_cols, lower_case)
+    # Write to a temporary file first so readers never see a partial index
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header_line.ljust(data_offset - 1) + b'\n')
+        for entries in (starts, bucket_digests, bucket_offsets):
+            entries.tofile(f)
+    os.replace(tmp_path, index_path)
+    return load_index(file_path, key_cols, delim, lower_case, quoted, index_path)
+
+
+def load_index(file_path: str, key_cols: List[int], delim: str = '\t',
+               lower_case: bool = False, quoted: bool = True,
+               index_path: Optional[str] = None) -> Optional[HashIndex]:
+    """Open the hash index of a file.
+
+    Args:
+        file_path: Path to the delimited file
+        key_cols: Key columns of the lookups
+        delim: Delimiter the file is read with
+        lower_case: Whether the lookup keys are lower cased
+        quoted: Whether fields may be quoted
+        index_path: Path of the sidecar (defaults to index_path_for(...))
+
+    Returns:
+        The index, or None if there is none, or it is stale or was built
+        with other options
+    """
+    index_path = index_path or index_path_for(file_path, key_cols, lower_case)
+    try:
+        with open(index_path, 'rb') as f:
+            header = json.loads(f.readline())
+            if (header.get('version') != INDEX_VERSION or
+                    header.get('byteorder') != sys.byteorder or
+                    header.get('key_cols') != list(key_cols) or
+                    header.get('lower_case') != lower_case or
+                    header.get('delimiter') != delim or header.get('quoted') != quoted or
+                    {k: header.get(k) for k in ('size', 'mtime_ns')} != _file_signature(file_path)):
+                return None
+            return HashIndex(file_path, f, header, f.tell())
+    except (OSError, ValueError):
+        return None
+
+
+def main() -> None:
+    """Command-line interface to build or refresh hash indexes."""
+    argparser = argparse.ArgumentParser(
+        description='Build the hash index of delimited files by key, next to them.'
+        ' file_intersection.py and file_diff.py then probe the index of the right file'
+        ' instead of loading the files, as long as the file is unchanged. Indexes that are'
+        ' up to date are left alone.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    argparser.add_argument('files', nargs='+', help='UTF-8 encoded delimited files')
+    argparser.add_argument('-k', '--key-columns', dest='key_columns', default='0',
+                           help='List of the key column numbers. E.g. "0,1,5"')
+    argparser.add_argument('-i', '--ignore_case', dest='lower_case', action='store_true',
+                           help='Index the lower-cased keys, for --ignore_case joins')
+    argparser.add_argument('-d', '--delim', dest='delim', default='\t',
+                           help='Delimiter of the files. Joins must use the same one'
+                           ' to read the index')
+    argparser.add_argument('--no-quoting', dest='quoted', action='store_false',
+                           help='The files have no quoted fields: split every line on the'
+                           ' delimiter. Joins must use the same option to read the index')
+    argparser.add_argument('-f', '--force', action='store_true',
+                           help='Rebuild the indexes even if they are up to date')
+    args = argparser.parse_args()
+
+    key_cols = [int(col) for col in args.key_columns.split(',')]
+    for file_path in args.files:
+        if not args.force:
+            index = load_index(file_path, key_cols, args.delim, args.lower_case, args.quoted)
+            if index is not None:
+                index.close()
+                sys.stderr.write('%s: index is up to date\n' % file_path)
+                continue
+        index = build_index(file_path, key_cols, args.delim, args.lower_case, args.quoted)
+        sys.stderr.write('%s: indexed %d rows\n' % (file_path, index.num_rows))
+        index.close()
+
+
+if __name__ == '__main__':
+    main()
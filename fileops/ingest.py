@@ -0,0 +1,447 @@
+#!/usr/bin/python3
+"""Columnar binary cache of delimited files, for repeated queries.
+
+Ingesting a file parses it once and stores its columns in a sidecar directory
+next to it (``<file>.cols``):
+
+* Columns whose values are all integers, or all floats, written the way
+  Python prints them are stored as arrays of int64 or float64.
+* The other columns are dictionary encoded: their distinct values are stored
+  once, and the rows hold the uint32 code of their value.
+
+The column files are memory-mapped when they are read. A manifest records the
+size and modification time of the source file, and the delimiter & quoting it
+was parsed with, so a stale or mismatching cache is ignored. When a fresh cache
+exists, file_select_ops.py, file_intersection.py and file_diff.py read it
+instead of parsing the file again. The first row is kept in the manifest, so a
+header row doesn't turn the numeric columns into text.
+
+Example:
+    python -m fileops.ingest -d , big_file.csv
+"""
+
+import argparse
+import json
+import mmap
+import os
+import shutil
+import sys
+from array import array
+from typing import Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from . import csv_unicode, file_ops_common
+
+CACHE_SUFFIX = '.cols'
+CACHE_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+# Typecodes of the column files
+_CODE_TYPE = 'I'
+_VALUE_TYPES = {'int': 'q', 'float': 'd'}
+_LENGTH_TYPE = 'I'
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+# Values buffered per column before being appended to its file
+_WRITE_ROWS = 1 << 16
+
+
+def cache_path_for(file_path: str) -> str:
+    """Path of the sidecar cache directory of a delimited file."""
+    return file_path + CACHE_SUFFIX
+
+
+def _file_signature(file_path: str) -> dict:
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _is_int(value: str) -> bool:
+    try:
+        number = int(value)
+    except ValueError:
+        return False
+    return str(number) == value and _INT64_MIN <= number <= _INT64_MAX
+
+
+def _is_float(value: str) -> bool:
+    try:
+        number = float(value)
+    except ValueError:
+        return False
+    # NaN is left out, since it isn't equal to itself, and so is -0.0, since
+    # it is equal to 0.0 while its text isn't
+    return (number == number and repr(number) == value and
+            not (number == 0 and value.startswith('-')))
+
+
+def _column_kind(kind: Optional[str], value: str) -> str:
+    """Kind of a column of the given kind once value is added to it. A value
+    is only stored as a number if it is printed back as the same text"""
+    if kind is None:
+        return 'int' if _is_int(value) else 'float' if _is_float(value) else 'str'
+    if kind == 'int' and not _is_int(value) or kind == 'float' and not _is_float(value):
+        return 'str'
+    return kind
+
+
+def _iter_file(file_path: str, delim: str, quoted: bool) -> Iterator[List[str]]:
+    with file_ops_common.open_input(file_path, 'r', encoding='utf-8') as f:
+        yield from csv_unicode.UnicodeReader(f, delimiter=delim, quoted=quoted)
+
+
+def ingest(file_path: str, delim: str = '\t', quoted: bool = True,
+           cache_path: Optional[str] = None) -> 'ColumnarCache':
+    """Parse a delimited file and write its columnar cache.
+
+    The file is read twice: once to find the kind of every column, and once
+    to write the columns. Only the dictionaries of the text columns are held
+    in memory.
+
+    Args:
+        file_path: Path to the delimited file, which may be compressed
+        delim: Delimiter of the file
+        quoted: Whether fields may be quoted
+        cache_path: Path of the sidecar (defaults to cache_path_for(file_path))
+
+    Returns:
+        The written cache
+    """
+    signature = _file_signature(file_path)
+
+    # First pass: column kinds, and row widths
+    kinds: List[Optional[str]] = []
+    num_rows = 0
+    min_width = max_width = 0
+    rows = _iter_file(file_path, delim, quoted)
+    first_row = next(rows, None)
+    for row in rows:
+        width = len(row)
+        if width > len(kinds):
+            kinds.extend([None] * (width - len(kinds)))
+        for col, value in enumerate(row):
+            if kinds[col] != 'str':
+                kinds[col] = _column_kind(kinds[col], value)
+        min_width = width if not num_rows else min(min_width, width)
+        max_width = max(max_width, width)
+        num_rows += 1
+    ragged = min_width != max_width
+
+    cache_path = cache_path or cache_path_for(file_path)
+    # Write to a temporary directory first so readers never see a partial cache
+    tmp_path = cache_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.mkdir(tmp_path)
+
+    # Second pass: write the columns. Short rows are padded with a value of
+    # the column's kind, and cut back to their length when read
+    files = []
+    buffers = []
+    dictionaries = []
+    appenders = []
+    padding = []
+    for col, kind in enumerate(kinds):
+        files.append(open(os.path.join(tmp_path, '%d.col' % col), 'wb'))
+        if kind == 'str':
+            codes = array(_CODE_TYPE)
+            dictionary = {}
+
+            def append_code(value, codes=codes, dictionary=dictionary):
+                code = dictionary.get(value)
+                if code is None:
+                    code = dictionary[value] = len(dictionary)
+                codes.append(code)
+            buffers.append(codes)
+            dictionaries.append(dictionary)
+            appenders.append(append_code)
+            padding.append('')
+        else:
+            values = array(_VALUE_TYPES[kind])
+            parse = int if kind == 'int' else float
+            buffers.append(values)
+            dictionaries.append(None)
+            appenders.append(lambda value, values=values, parse=parse:
+                             values.append(parse(value)))
+            padding.append('0')
+    lengths = array(_LENGTH_TYPE) if ragged else None
+    lengths_file = open(os.path.join(tmp_path, 'lengths'), 'wb') if ragged else None
+
+    def flush():
+        for f, buffer in zip(files, buffers):
+            buffer.tofile(f)
+            del buffer[:]
+        if ragged:
+            lengths.tofile(lengths_file)
+            del lengths[:]
+
+    try:
+        rows = _iter_file(file_path, delim, quoted)
+        next(rows, None)
+        for row_num, row in enumerate(rows, 1):
+            if ragged:
+                lengths.append(len(row))
+                if len(row) < max_width:
+                    row = row + padding[len(row):]
+            for append, value in zip(appenders, row):
+                append(value)
+            if row_num % _WRITE_ROWS == 0:
+                flush()
+        flush()
+    finally:
+        for f in files:
+            f.close()
+        if ragged:
+            lengths_file.close()
+
+    columns = []
+    for col, (kind, dictionary) in enumerate(zip(kinds, dictionaries)):
+        if kind == 'str':
+            with open(os.path.join(tmp_path, '%d.dict' % col), 'w', encoding='utf-8') as f:
+                json.dump(list(dictionary), f, ensure_ascii=False)
+            columns.append({'kind': kind, 'typecode': _CODE_TYPE, 'size': len(dictionary)})
+        else:
+            columns.append({'kind': kind, 'typecode': _VALUE_TYPES[kind]})
+    manifest = dict(signature, version=CACHE_VERSION, delimiter=delim, quoted=quoted,
+                    byteorder=sys.byteorder, first_row=first_row, rows=num_rows,
+                    min_width=min_width, ragged=ragged, columns=columns)
+    with open(os.path.join(tmp_path, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.rename(tmp_path, cache_path)
+    return ColumnarCache(cache_path, manifest)
+
+
+def _map_array(path: str, typecode: str, num_items: int) -> Sequence:
+    if not num_items:
+        return array(typecode)  # Empty files can't be mapped
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode)
+
+
+class Column:
+    """A column of a cache: one code or value per row, memory-mapped.
+
+    Attributes:
+        kind: "int", "float" or "str" for dictionary encoded columns
+        typecode: array typecode of the items of data
+        data: Sequence of the code or value of every row
+        dictionary: Values of the codes of a "str" column, else None
+    """
+
+    def __init__(self, kind: str, typecode: str, data: Sequence,
+                 dictionary: Optional[List[str]]) -> None:
+        self.kind = kind
+        self.typecode = typecode
+        self.data = data
+        self.dictionary = dictionary
+
+    def text(self, item) -> str:
+        """Text of a code or value of the column, as it was in the file."""
+        if self.dictionary is not None:
+            return self.dictionary[item]
+        return str(item) if self.kind == 'int' else repr(item)
+
+    def texts(self) -> Iterable[str]:
+        """Text of every row of the column."""
+        if self.dictionary is not None:
+            return map(self.dictionary.__getitem__, self.data)
+        return map(str if self.kind == 'int' else repr, self.data)
+
+    def matching(self, values: Iterable[str]) -> Set:
+        """Codes or values of the column whose text is one of values."""
+        if self.dictionary is not None:
+            values = set(values)
+            return {code for code, text in enumerate(self.dictionary) if text in values}
+        is_kind, parse = (_is_int, int) if self.kind == 'int' else (_is_float, float)
+        return {parse(value) for value in values if is_kind(value)}
+
+
+class ColumnarCache:
+    """Reader of the columnar cache of a file. Columns are mapped on first use.
+
+    Attributes:
+        first_row: Parsed first row of the file, None if the file is empty
+        num_rows: Number of rows after the first one
+        num_cols: Number of columns of the widest row after the first one
+        min_width: Number of columns of the narrowest row after the first one
+    """
+
+    def __init__(self, cache_path: str, manifest: dict) -> None:
+        self.cache_path = cache_path
+        self.manifest = manifest
+        self.first_row = manifest['first_row']
+        self.num_rows = manifest['rows']
+        self.num_cols = len(manifest['columns'])
+        self.min_width = manifest['min_width']
+        self._columns = {}
+        self._lengths = None
+
+    def __enter__(self) -> 'ColumnarCache':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Unmap the columns. Sequences from the cache are invalid afterwards."""
+        views = [column.data for column in self._columns.values()] + [self._lengths]
+        for view in views:
+            if isinstance(view, memoryview):
+                try:
+                    view.release()
+                except BufferError:
+                    pass  # Still exported, e.g. to NumPy: unmapped once unused
+        self._columns = {}
+        self._lengths = None
+
+    def column(self, col: int) -> Column:
+        """Column number col. Raises IndexError past the widest row."""
+        column = self._columns.get(col)
+        if column is None:
+            spec = self.manifest['columns'][col]
+            dictionary = None
+            if spec['kind'] == 'str':
+                with open(os.path.join(self.cache_path, '%d.dict' % col),
+                          encoding='utf-8') as f:
+                    dictionary = json.load(f)
+            data = _map_array(os.path.join(self.cache_path, '%d.col' % col),
+                              spec['typecode'], self.num_rows)
+            column = self._columns[col] = Column(spec['kind'], spec['typecode'], data,
+                                                 dictionary)
+        return column
+
+    def has_columns(self, cols: Iterable[int]) -> bool:
+        """Whether every row after the first one has all of the columns."""
+        return all(col < self.min_width for col in cols)
+
+    def iter_rows(self, cols: Optional[Iterable[int]] = None) -> Iterator[List[str]]:
+        """Yield the parsed rows after the first one.
+
+        Args:
+            cols: Only fill in these columns, leaving the others empty. Rows
+                are cut to their length in the file, like when parsing it
+
+        Returns:
+            Iterator over the rows, as lists of strings
+        """
+        cols = sorted(set(range(self.num_cols) if cols is None else cols))
+        cols = [col for col in cols if col < self.num_cols]
+        if not cols:
+            rows = ([] for _ in range(self.num_rows))
+        elif cols == list(range(len(cols))):
+            rows = map(list, zip(*[self.column(col).texts() for col in cols]))
+        else:
+            template = [''] * (cols[-1] + 1)
+
+            def fill(texts: Tuple[str, ...]) -> List[str]:
+                row = template[:]
+                for col, text in zip(cols, texts):
+                    row[col] = text
+                return row
+            rows = map(fill, zip(*[self.column(col).texts() for col in cols]))
+
+        if not self.manifest['ragged']:
+            yield from rows
+            return
+        if self._lengths is None:
+            self._lengths = _map_array(os.path.join(self.cache_path, 'lengths'),
+                                       _LENGTH_TYPE, self.num_rows)
+        for row, length in zip(rows, self._lengths):
+            yield row[:length] if length < len(row) else row
+
+
+def load_cache(file_path: str, delim: str, quoted: bool = True,
+               cache_path: Optional[str] = None) -> Optional[ColumnarCache]:
+    """Open the columnar cache of a file.
+
+    Args:
+        file_path: Path to the delimited file
+        delim: Delimiter the file is read with
+        quoted: Whether fields may be quoted
+        cache_path: Path of the sidecar (defaults to cache_path_for(file_path))
+
+    Returns:
+        The cache, or None if there is none, or it is stale or was parsed
+        with another delimiter or quoting
+    """
+    cache_path = cache_path or cache_path_for(file_path)
+    try:
+        with open(os.path.join(cache_path, MANIFEST_NAME), encoding='utf-8') as f:
+            manifest = json.load(f)
+        if (manifest.get('version') != CACHE_VERSION or
+                manifest.get('byteorder') != sys.byteorder or
+                manifest.get('delimiter') != delim or manifest.get('quoted') != quoted or
+                {k: manifest.get(k) for k in ('size', 'mtime_ns')} != _file_signature(file_path)):
+            return None
+    except (OSError, ValueError):
+        return None
+    return ColumnarCache(cache_path, manifest)
+
+
+def iter_file_rows(file_path: str, delim: str, quoted: bool = True,
+                   cols: Optional[List[int]] = None) -> Iterator[List[str]]:
+    """Yield the parsed rows of a delimited file, like csv_unicode.UnicodeReader.
+
+    The rows come from the columnar cache of the file when it is fresh.
+
+    Args:
+        file_path: Path to the delimited file
+        delim: Delimiter of the file
+        quoted: Whether fields may be quoted
+        cols: Columns the caller uses. The other columns of the rows read
+            from the cache are left empty, which makes them cheaper to build
+    """
+    cache = load_cache(file_path, delim, quoted)
+    if cache is None:
+        yield from _iter_file(file_path, delim, quoted)
+        return
+    with cache:
+        if cache.first_row is not None:
+            yield cache.first_row
+        yield from cache.iter_rows(cols)
+
+
+def iter_keyed_rows(file_path: str, delim: str, key_cols: List[int],
+                    lower_case: bool = False, quoted: bool = True,
+                    cols: Optional[List[int]] = None) -> Iterator[Tuple[str, int, List[str]]]:
+    """file_ops_common.iter_keyed_rows, reading the columnar cache when it is
+    fresh. See iter_file_rows for cols."""
+    get_row_key = file_ops_common.key_getter(key_cols, lower_case)
+    for seq, row in enumerate(iter_file_rows(file_path, delim, quoted, cols)):
+        yield get_row_key(row), seq, row
+
+
+def main() -> None:
+    """Command-line interface to ingest delimited files."""
+    argparser = argparse.ArgumentParser(
+        description='Parse delimited files once and cache their columns in a binary,'
+        ' memory-mapped layout next to them. file_select_ops.py, file_intersection.py and'
+        ' file_diff.py then read the cache instead of the file, as long as the file is'
+        ' unchanged. Caches that are up to date are left alone.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    argparser.add_argument('files', nargs='+', help='UTF-8 encoded delimited files')
+    argparser.add_argument('-d', '--delim', dest='delim', default='\t',
+                           help='Delimiter of the files. Queries must use the same one'
+                           ' to read the cache')
+    argparser.add_argument('--no-quoting', dest='quoted', action='store_false',
+                           help='The files have no quoted fields: split every line on the'
+                           ' delimiter. Queries must use the same option to read the cache')
+    argparser.add_argument('-f', '--force', action='store_true',
+                           help='Rebuild the caches even if they are up to date')
+    args = argparser.parse_args()
+
+    for file_path in args.files:
+        if not args.force:
+            cache = load_cache(file_path, args.delim, args.quoted)
+            if cache is not None:
+                cache.close()
+                sys.stderr.write('%s: cache is up to date\n' % file_path)
+                continue
+        cache = ingest(file_path, args.delim, args.quoted)
+        sys.stderr.write('%s: cached %d rows of %d columns\n' % (file_path, cache.num_rows,
+                                                                 cache.num_cols))
+
+
+if __name__ == '__main__':
+    main()
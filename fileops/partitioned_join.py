@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+#
+# Parallel partitioned hash join for file_intersection.py and file_diff.py
+#
+# Both files are split into line aligned byte ranges, and every range is hash
+# partitioned by key into bucket files by a worker process. Each pair of
+# left/right buckets is then joined independently in a process pool, and the
+# per bucket results are merged back into the single process output order.
+# Each worker only holds one left bucket in memory.
+#
+
+import heapq
+import os
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from operator import itemgetter
+from typing import Iterator, List, Optional, Tuple
+
+from . import file_ops_common, sort_merge
+
+
+def _bucket_path(work_dir: str, side: str, range_num: int, bucket: int) -> str:
+    return os.path.join(work_dir, '%s-%04d-%04d' % (side, range_num, bucket))
+
+
+def _partition_range(file_path: str, delim: str, key_cols: List[int], lower_case: bool,
+                     start: int, end: int, range_num: int, num_buckets: int,
+                     work_dir: str, side: str, quoted: bool = True) -> None:
+    """Hash partition the rows of one byte range of a file into bucket files.
+
+    Rows are numbered (range_num, row number within the range), which sorts
+    in file order across ranges.
+    """
+    get_row_key = file_ops_common.key_getter(key_cols, lower_case)
+    writers = [sort_merge.RecordWriter(_bucket_path(work_dir, side, range_num, bucket))
+               for bucket in range(num_buckets)]
+    try:
+        rows = file_ops_common.iter_range_rows(file_path, delim, start, end, quoted)
+        for seq, cols in enumerate(rows):
+            key = get_row_key(cols)
+            bucket = zlib.crc32(key.encode('utf-8')) % num_buckets
+            writers[bucket].write((key, (range_num, seq), cols))
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def _read_bucket(work_dir: str, side: str, num_ranges: int, bucket: int) -> Iterator[Tuple]:
+    """Stream the records of a bucket in file order."""
+    for range_num in range(num_ranges):
+        yield from sort_merge.read_records(_bucket_path(work_dir, side, range_num, bucket))
+
+
+def _load_left_bucket(work_dir: str, num_ranges: int, bucket: int) -> dict:
+    all_keys: dict = {}
+    for key, seq, cols in _read_bucket(work_dir, 'left', num_ranges, bucket):
+        if key not in all_keys:
+            all_keys[key] = []
+        all_keys[key].append((seq, cols))
+    return all_keys
+
+
+def _intersect_bucket(work_dir: str, num_left_ranges: int, num_right_ranges: int,
+                      bucket: int, insert_cols: List[int]) -> str:
+    """Join one bucket and write ((right seq, left seq), row) results to a file."""
+    all_keys = _load_left_bucket(work_dir, num_left_ranges, bucket)
+
+    # The right rows are read in file order, so the results are written
+    # already sorted by (right seq, left seq)
+    path = os.path.join(work_dir, 'result-%04d' % bucket)
+    writer = sort_merge.RecordWriter(path)
+    try:
+        for key, right_seq, cols in _read_bucket(work_dir, 'right', num_right_ranges, bucket):
+            if key in all_keys:
+                insert_values = [cols[i] for i in insert_cols]
+                for left_seq, line in all_keys.pop(key):
+                    writer.write(((right_seq, left_seq), line + insert_values))
+    finally:
+        writer.close()
+    return path
+
+
+def _diff_bucket(work_dir: str, num_left_ranges: int, num_right_ranges: int,
+                 bucket: int) -> str:
+    """Diff one bucket and write ((first seq of key, left seq), row) results to a file."""
+    all_keys = _load_left_bucket(work_dir, num_left_ranges, bucket)
+    for key, _, _ in _read_bucket(work_dir, 'right', num_right_ranges, bucket):
+        all_keys.pop(key, None)
+
+    # Keys are kept in order of first occurrence, so the results are
+    # written already sorted
+    path = os.path.join(work_dir, 'result-%04d' % bucket)
+    sort_merge.write_records(path, (((lines[0][0], seq), line)
+                                    for lines in all_keys.values() for seq, line in lines))
+    return path
+
+
+def _iter_partitioned(left_file: str, right_file: str, left_key_cols: List[int],
+                      right_key_cols: List[int], left_delim: str, right_delim: str,
+                      lower_case: bool, insert_cols: Optional[List[int]], jobs: int,
+                      preserve_order: bool, temp_dir: Optional[str],
+                      quoted: bool) -> Iterator[List[str]]:
+    """Run a partitioned intersection, or a diff when insert_cols is None."""
+    num_buckets = jobs
+    left_ranges = file_ops_common.split_line_ranges(left_file, jobs)
+    right_ranges = file_ops_common.split_line_ranges(right_file, jobs)
+
+    with tempfile.TemporaryDirectory(prefix='fileops-join-', dir=temp_dir) as work_dir:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            partitions = [
+                pool.submit(_partition_range, file_path, delim, key_cols, lower_case,
+                            start, end, range_num, num_buckets, work_dir, side, quoted)
+                for side, file_path, delim, key_cols, ranges in (
+                    ('left', left_file, left_delim, left_key_cols, left_ranges),
+                    ('right', right_file, right_delim, right_key_cols, right_ranges))
+                for range_num, (start, end) in enumerate(ranges)]
+            for future in partitions:
+                future.result()
+
+            if insert_cols is None:
+                joins = [pool.submit(_diff_bucket, work_dir, len(left_ranges),
+                                     len(right_ranges), bucket)
+                         for bucket in range(num_buckets)]
+            else:
+                joins = [pool.submit(_intersect_bucket, work_dir, len(left_ranges),
+                                     len(right_ranges), bucket, insert_cols)
+                         for bucket in range(num_buckets)]
+            results = [future.result() for future in joins]
+
+        streams = [sort_merge.read_records(path) for path in results]
+        if preserve_order:
+            merged = heapq.merge(*streams, key=itemgetter(0))
+        else:
+            merged = chain(*streams)
+        for _, row in merged:
+            yield row
+
+
+def iter_partitioned_intersection(left_file: str, right_file: str, left_key_cols: List[int],
+                                  right_key_cols: List[int], left_delim: str, right_delim: str,
+                                  lower_case: bool, insert_cols: List[int], jobs: int,
+                                  preserve_order: bool = True,
+                                  temp_dir: Optional[str] = None,
+                                  quoted: bool = True) -> Iterator[List[str]]:
+    """Intersection of two files using a pool of jobs processes.
+
+    Args:
+        left_file: Path to the left file
+        right_file: Path to the right file
+        left_key_cols: Key column indices for the left file
+        right_key_cols: Key column indices for the right file
+        left_delim: Delimiter for left file
+        right_delim: Delimiter for right file
+        lower_case: Whether to ignore case when comparing
+        insert_cols: Column indices from the right file to insert
+        jobs: Number of processes, which is also the number of partitions
+        preserve_order: Output the rows in the same order as the single process
+            hash join. Otherwise, rows are output partition by partition, each
+            partition being in that order
+        temp_dir: Directory for the partition files (defaults to the system one)
+        quoted: Whether fields may be quoted
+
+    Returns:
+        Iterator over the rows that are in both files
+    """
+    return _iter_partitioned(left_file, right_file, left_key_cols, right_key_cols,
+                             left_delim, right_delim, lower_case, insert_cols, jobs,
+                             preserve_order, temp_dir, quoted)
+
+
+def iter_partitioned_diff(left_file: str, right_file: str, left_key_cols: List[int],
+                          right_key_cols: List[int], left_delim: str, right_delim: str,
+                          lower_case: bool, jobs: int, preserve_order: bool = True,
+                          temp_dir: Optional[str] = None,
+                          quoted: bool = True) -> Iterator[List[str]]:
+    """Diff of two files using a pool of jobs processes.
+
+    See iter_partitioned_intersection for the arguments.
+
+    Returns:
+        Iterator over the rows that are in left_file but not in right_file
+    """
+    return _iter_partitioned(left_file, right_file, left_key_cols, right_key_cols,
+                             left_delim, right_delim, lower_case, None, jobs,
+                             preserve_order, temp_dir, quoted)
@@ -0,0 +1,242 @@
+#!/usr/bin/python
+#
+# Vectorized engine for file_select_ops.py, using NumPy.
+#
+# The input is parsed in large chunks of rows, and the columns used by the
+# query are turned into NumPy arrays. WHERE clauses become boolean masks, the
+# GROUP BY keys are factorized into integer codes with np.unique, and SUM &
+# COUNT are computed per code with np.bincount. The output is the same as the
+# row by row engine of file_select_ops.py, including the order of the groups.
+# The columns of a file ingested with ingest.py are used as arrays directly.
+#
+
+import sys
+from itertools import islice
+
+from . import csv_unicode, file_ops_common
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_CHUNK_ROWS = 1 << 18
+
+
+def _factorize(keys, group_codes):
+    ''' Map every key of a chunk to its group code, giving new codes to new
+    keys in order of first occurrence, like the row by row engine does '''
+    uniques, first_index, inverse = np.unique(keys, return_index=True,
+                                              return_inverse=True)
+    local_to_global = np.empty(len(uniques), dtype=np.int64)
+    for local_code in np.argsort(first_index, kind='stable'):
+        key = str(uniques[local_code])
+        code = group_codes.get(key)
+        if code is None:
+            code = group_codes[key] = len(group_codes)
+        local_to_global[local_code] = code
+    return local_to_global[inverse.ravel()]
+
+
+def _column(rows, col_num):
+    ''' Array of a column of the rows, and the mask of the rows too short to
+    have it, or None when they all have it '''
+    try:
+        return np.array([row[col_num] for row in rows], dtype=str), None
+    except IndexError:
+        short = np.array([len(row) <= col_num for row in rows], dtype=bool)
+        return np.array([row[col_num] if col_num < len(row) else '' for row in rows],
+                        dtype=str), short
+
+
+def _aggregate_chunk(rows, select_cols, aggregate_cols, agg_function,
+                     where_filters, group_codes, totals):
+    columns = {}
+
+    def column(col_num, mask):
+        # Like the row engine, only the rows still matching need the column
+        if col_num not in columns:
+            columns[col_num], short = _column(rows, col_num)
+            if short is not None and (short & mask).any():
+                raise IndexError('list index out of range')
+        return columns[col_num]
+
+    # Where filters, in the order the row engine checks them
+    mask = np.ones(len(rows), dtype=bool)
+    for op in ('IN', 'NOT IN'):
+        for col_num, filtr in where_filters.items():
+            if filtr['op'] == op:
+                matches = np.isin(column(col_num, mask), np.array(filtr['vals'], dtype=str))
+                mask &= matches if op == 'IN' else ~matches
+    if not mask.any():
+        return
+    for col_num in select_cols + (aggregate_cols if agg_function == 'sum' else []):
+        column(col_num, mask)
+
+    # Generate the keys from the select columns
+    keys = columns[select_cols[0]][mask]
+    for col_num in select_cols[1:]:
+        keys = np.char.add(np.char.add(keys, file_ops_common.KEY_DELIMITER),
+                           columns[col_num][mask])
+    codes = _factorize(keys, group_codes)
+    num_groups = len(group_codes)
+
+    for col_num in sorted(set(aggregate_cols)):
+        # A column listed several times is aggregated several times per row
+        repeats = aggregate_cols.count(col_num)
+        previous = totals.get(col_num)
+        if agg_function == 'count':
+            counts = np.bincount(codes, minlength=num_groups) * repeats
+            if previous is not None:
+                counts[:len(previous)] += previous
+            totals[col_num] = counts
+        else:
+            values = columns[col_num][mask].astype(np.float64)
+            if repeats > 1:
+                values = np.repeat(values, repeats)
+                col_codes = np.repeat(codes, repeats)
+            else:
+                col_codes = codes
+            # np.bincount adds the weights one by one in array order. Starting
+            # with the previous totals keeps the floating point sums identical
+            # to adding the values row by row
+            if previous is not None:
+                col_codes = np.concatenate([np.arange(len(previous)), col_codes])
+                values = np.concatenate([previous, values])
+            totals[col_num] = np.bincount(col_codes, weights=values,
+                                          minlength=num_groups)
+
+
+def _check_engine(agg_function):
+    if np is None:
+        raise ImportError('The numpy engine requires NumPy. Install it with:'
+                          ' pip install fileops[numpy]')
+    if agg_function not in ('sum', 'count'):
+        sys.stderr.write('The numpy engine only supports sum & count, not: ' + agg_function)
+        sys.exit(-1)
+
+
+def iter_groups_numpy(input_file_path, select_cols, aggregate_cols, agg_function,
+                      where_filters, delimiter_char, chunk_rows=DEFAULT_CHUNK_ROWS,
+                      line_filter=None, quoted=True):
+    ''' Run the query with the parsed columns and where filters. Yields
+    (key, {aggregate column: value}) in order of first occurrence of the keys.
+    Lines not passing line_filter are skipped without being parsed '''
+    _check_engine(agg_function)
+
+    # Select Keys -> group code, in order of first occurrence
+    group_codes = {}
+    # Aggregate Column -> array of the aggregate value of each group code
+    totals = {}
+
+    with file_ops_common.open_input(input_file_path, 'r') as infile:
+        if line_filter is None:
+            reader = csv_unicode.UnicodeReader(infile, delimiter=delimiter_char, quoted=quoted)
+            next(reader, None)  # Skip header row
+        else:
+            next(infile, None)  # Skip header row
+            reader = csv_unicode.UnicodeReader(filter(line_filter, infile),
+                                               delimiter=delimiter_char, quoted=quoted)
+        while True:
+            rows = list(islice(reader, chunk_rows))
+            if not rows:
+                break
+            _aggregate_chunk(rows, select_cols, aggregate_cols, agg_function,
+                             where_filters, group_codes, totals)
+
+    to_python = int if agg_function == 'count' else float
+    for key, code in group_codes.items():
+        yield key, {col_num: to_python(totals[col_num][code]) for col_num in totals}
+
+
+def iter_groups_cached(cache, select_cols, aggregate_cols, agg_function, where_filters):
+    ''' iter_groups_numpy over the columnar cache of the input file, an
+    ingest.ColumnarCache. The where filters and the grouping work on the
+    dictionary codes & numbers of the columns, without parsing any text '''
+    _check_engine(agg_function)
+    if not cache.num_rows:
+        return
+
+    def column_array(col_num):
+        column = cache.column(col_num)
+        return column, np.frombuffer(column.data, dtype=column.typecode)
+
+    # Where filters
+    mask = np.ones(cache.num_rows, dtype=bool)
+    for col_num, filtr in where_filters.items():
+        column, data = column_array(col_num)
+        items = np.array(sorted(column.matching(filtr['vals'])), dtype=data.dtype)
+        matches = np.isin(data, items)
+        mask &= matches if filtr['op'] == 'IN' else ~matches
+    if not mask.any():
+        return
+
+    # Factorize the select columns one after the other, keeping the group
+    # codes below the number of rows
+    select_columns = []
+    codes = np.zeros(int(mask.sum()), dtype=np.int64)
+    for col_num in select_cols:
+        column, data = column_array(col_num)
+        data = data[mask]
+        uniques, inverse = np.unique(data, return_inverse=True)
+        _, codes = np.unique(codes * len(uniques) + inverse.ravel(), return_inverse=True)
+        codes = codes.ravel()
+        select_columns.append((column, data))
+
+    # Number the groups in order of first occurrence of their key. Different
+    # codes may still make the same key, like in the row by row engine
+    _, first_index, codes = np.unique(codes, return_index=True, return_inverse=True)
+    group_codes = {}
+    group_to_code = np.empty(len(first_index), dtype=np.int64)
+    for group in np.argsort(first_index, kind='stable'):
+        row = first_index[group]
+        key = file_ops_common.KEY_DELIMITER.join(column.text(data[row].item())
+                                                 for column, data in select_columns)
+        code = group_codes.get(key)
+        if code is None:
+            code = group_codes[key] = len(group_codes)
+        group_to_code[group] = code
+    codes = group_to_code[codes.ravel()]
+    num_groups = len(group_codes)
+
+    totals = {}
+    for col_num in sorted(set(aggregate_cols)):
+        # A column listed several times is aggregated several times per row
+        repeats = aggregate_cols.count(col_num)
+        if agg_function == 'count':
+            totals[col_num] = np.bincount(codes, minlength=num_groups) * repeats
+            continue
+        column, data = column_array(col_num)
+        data = data[mask]
+        if column.dictionary is not None:
+            # Only parse the values of the codes that are used
+            used = np.unique(data)
+            numbers = np.zeros(len(column.dictionary))
+            numbers[used] = [float(column.dictionary[code]) for code in used.tolist()]
+            values = numbers[data]
+        else:
+            values = data.astype(np.float64)
+        col_codes = codes
+        if repeats > 1:
+            values = np.repeat(values, repeats)
+            col_codes = np.repeat(codes, repeats)
+        totals[col_num] = np.bincount(col_codes, weights=values, minlength=num_groups)
+
+    to_python = int if agg_function == 'count' else float
+    for key, code in group_codes.items():
+        yield key, {col_num: to_python(totals[col_num][code]) for col_num in totals}
+
+
+def iter_select_operations_numpy(input_file_path, select_cols, aggregate_cols,
+                                 agg_function, where_filters, delimiter_char,
+                                 chunk_rows=DEFAULT_CHUNK_ROWS):
+    ''' Vectorized equivalent of file_select_ops.iter_select_operations, taking
+    the parsed columns and where filters. Yields the output rows '''
+    for key, values in iter_groups_numpy(input_file_path, select_cols, aggregate_cols,
+                                         agg_function, where_filters, delimiter_char,
+                                         chunk_rows):
+        op_cols = file_ops_common.split_key(key)
+        # We output the aggregate column in the order they are in the input file
+        for col_num in sorted(values):
+            op_cols.append(str(values[col_num]))
+        yield op_cols
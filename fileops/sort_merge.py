@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+#
+# External-memory sort and merge-join helpers for the file set operations
+# scripts like file_intersection.py, file_diff.py etc.
+#
+# Rows are buffered in memory until they pass a memory budget, at which point
+# the buffer is sorted and spilled to a temporary "run" file. The runs are then
+# k-way merged back into a single sorted stream, so peak memory stays bounded
+# no matter how big the input file is.
+#
+
+import heapq
+import os
+import pickle
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+# A sortable record: (key, sequence number in the source file, columns)
+SortRecord = Tuple[str, int, List[str]]
+
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+# Maximum number of runs merged at once, to bound the number of open files
+MAX_MERGE_FANIN = 64
+# Number of records pickled together in a run file
+_RUN_CHUNK_SIZE = 4096
+
+
+def _record_size(record: SortRecord) -> int:
+    """Rough estimate of the memory held by a record, in bytes."""
+    key, _, cols = record
+    return 200 + len(key) + sum(56 + len(col) for col in cols)
+
+
+class RecordWriter:
+    """Append records to a temporary file, pickled in chunks."""
+
+    def __init__(self, path: str) -> None:
+        self.file = open(path, 'wb')
+        self.chunk: List[Any] = []
+
+    def write(self, record: Any) -> None:
+        self.chunk.append(record)
+        if len(self.chunk) == _RUN_CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        pickle.dump(self.chunk, self.file, pickle.HIGHEST_PROTOCOL)
+        self.chunk = []
+
+    def close(self) -> None:
+        if self.chunk:
+            self._flush()
+        self.file.close()
+
+
+def write_records(path: str, records: Iterable[Any]) -> None:
+    """Write records to a temporary file, pickled in chunks."""
+    writer = RecordWriter(path)
+    try:
+        for record in records:
+            writer.write(record)
+    finally:
+        writer.close()
+
+
+def read_records(path: str) -> Iterator[Any]:
+    """Stream the records back from a file written by write_records."""
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                return
+            yield from chunk
+
+
+def _write_run(records: List[SortRecord], run_dir: str, run_num: int) -> str:
+    """Write the (already sorted) records to a new run file and return its path."""
+    path = os.path.join(run_dir, 'run-%06d' % run_num)
+    write_records(path, records)
+    return path
+
+
+def _merge_runs(runs: List[str], run_dir: str, run_num: int) -> str:
+    """Merge several run files into a single new run file."""
+    path = os.path.join(run_dir, 'run-%06d' % run_num)
+    write_records(path, heapq.merge(*[read_records(run) for run in runs]))
+    for run in runs:
+        os.unlink(run)
+    return path
+
+
+def reduce_runs(runs: List[str], run_dir: str) -> List[str]:
+    """Merge sorted run files in multiple passes if there are too many to
+    open at once. Returns the at most MAX_MERGE_FANIN remaining runs."""
+    run_num = len(runs)
+    while len(runs) > MAX_MERGE_FANIN:
+        merged = []
+        for i in range(0, len(runs), MAX_MERGE_FANIN):
+            merged.append(_merge_runs(runs[i:i + MAX_MERGE_FANIN], run_dir, run_num))
+            run_num += 1
+        runs = merged
+    return runs
+
+
+def external_sort(records: Iterable[SortRecord],
+                  memory_limit: int = DEFAULT_MEMORY_LIMIT,
+                  temp_dir: Optional[str] = None) -> Iterator[SortRecord]:
+    """Sort records by (key, sequence number) using bounded memory.
+
+    Args:
+        records: Iterable of (key, seq, cols) records
+        memory_limit: Approximate number of bytes of records to hold in memory.
+            Runs are spilled at half of it, since sorting and writing a run
+            takes about as much memory again
+        temp_dir: Directory for the temporary run files (defaults to the system one)
+
+    Returns:
+        Iterator over the records in sorted order
+    """
+    with tempfile.TemporaryDirectory(prefix='fileops-sort-', dir=temp_dir) as run_dir:
+        runs: List[str] = []
+        buffer: List[SortRecord] = []
+        buffered = 0
+        run_limit = memory_limit // 2
+        for record in records:
+            buffer.append(record)
+            buffered += _record_size(record)
+            if buffered >= run_limit:
+                buffer.sort()
+                runs.append(_write_run(buffer, run_dir, len(runs)))
+                buffer = []
+                buffered = 0
+
+        buffer.sort()
+        if not runs:
+            # Everything fit in memory, no need to go through the disk
+            yield from buffer
+            return
+        if buffer:
+            runs.append(_write_run(buffer, run_dir, len(runs)))
+        buffer = []
+
+        runs = reduce_runs(runs, run_dir)
+        yield from heapq.merge(*[read_records(run) for run in runs])
+
+
+def check_sorted(records: Iterable[SortRecord], name: str) -> Iterator[SortRecord]:
+    """Pass through records that should already be sorted by key.
+
+    Raises ValueError as soon as a key is smaller than the one before it, so
+    a merge over unsorted input fails instead of silently missing matches.
+    """
+    previous = None
+    for record in records:
+        if previous is not None and record[0] < previous:
+            raise ValueError('%s is not sorted by key: row %d has key %r after %r'
+                             % (name, record[1] + 1, record[0], previous))
+        previous = record[0]
+        yield record
+
+
+def merge_join(left: Iterator[SortRecord], right: Iterator[SortRecord],
+               insert_cols: List[int]) -> Iterator[List[str]]:
+    """Streaming inner join of two record streams sorted by key.
+
+    Every left row whose key appears on the right is output, followed by the
+    insert_cols taken from the first right row with that key.
+    """
+    left_groups = groupby(left, key=itemgetter(0))
+    right_groups = groupby(right, key=itemgetter(0))
+    left_key, left_group = next(left_groups, (None, None))
+    right_key, right_group = next(right_groups, (None, None))
+
+    while left_group is not None and right_group is not None:
+        if left_key < right_key:
+            left_key, left_group = next(left_groups, (None, None))
+        elif left_key > right_key:
+            right_key, right_group = next(right_groups, (None, None))
+        else:
+            right_cols = next(right_group)[-1]
+            insert_values = [right_cols[i] for i in insert_cols]
+            for record in left_group:
+                yield record[-1] + insert_values
+            left_key, left_group = next(left_groups, (None, None))
+            right_key, right_group = next(right_groups, (None, None))
+
+
+def merge_anti_join(left: Iterator[SortRecord],
+                    right: Iterator[SortRecord]) -> Iterator[List[str]]:
+    """Streaming anti-join of two record streams sorted by key.
+
+    Outputs every left row whose key does not appear on the right.
+    """
+    left_groups = groupby(left, key=itemgetter(0))
+    right_keys = (key for key, _ in groupby(right, key=itemgetter(0)))
+    right_key = next(right_keys, None)
+
+    for left_key, left_group in left_groups:
+        while right_key is not None and right_key < left_key:
+            right_key = next(right_keys, None)
+        if right_key is None or right_key != left_key:
+            for record in left_group:
+                yield record[-1]
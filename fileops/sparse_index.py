@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+"""Sparse offset index for the sorted files searched by file_searcher.
+
+The index records the byte offset and the first bytes of every Nth line of a
+sorted file, in a sidecar file next to it (``<file>.idx``). The header of the
+sidecar stores the size and modification time of the indexed file, so a stale
+index is detected and ignored. Searcher loads the index when it opens a file
+and binary searches it in memory, which narrows every lookup down to the few
+lines between two index entries.
+
+Example:
+    python -m fileops.sparse_index sorted_file.txt
+"""
+
+import argparse
+import bisect
+import json
+import os
+import struct
+import sys
+from typing import List, Optional, Tuple
+
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+DEFAULT_INTERVAL = 64
+DEFAULT_PREFIX_BYTES = 32
+
+# Offset of the line, and length of the key prefix that follows
+_ENTRY = struct.Struct('<QH')
+
+
+def index_path_for(file_path: str) -> str:
+    """Path of the sidecar index file of a sorted file."""
+    return file_path + INDEX_SUFFIX
+
+
+class SparseIndex:
+    """In-memory sparse index: key prefixes and offsets of every Nth line."""
+
+    def __init__(self, keys: List[bytes], offsets: List[int], prefix_bytes: int) -> None:
+        self.keys = keys
+        self.offsets = offsets
+        self.prefix_bytes = prefix_bytes
+
+    def bounds(self, prefix: bytes, file_size: int) -> Tuple[int, int]:
+        """Byte range of the file holding the first line >= prefix.
+
+        Args:
+            prefix: Encoded prefix to search for
+            file_size: Size of the indexed file
+
+        Returns:
+            (left, right) offsets such that the first line >= prefix starts
+            at or after left, and at or before right
+        """
+        # Keys are truncated, so only keys that differ from the truncated
+        # prefix tell whether their whole line is before or after it
+        truncated = prefix[:self.prefix_bytes]
+        first = bisect.bisect_left(self.keys, truncated)
+        last = bisect.bisect_right(self.keys, truncated)
+        left = self.offsets[first - 1] if first > 0 else 0
+        right = self.offsets[last] if last < len(self.offsets) else file_size
+        return left, right
+
+
+def _file_signature(file_path: str) -> dict:
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def build_index(file_path: str, interval: int = DEFAULT_INTERVAL,
+                prefix_bytes: int = DEFAULT_PREFIX_BYTES,
+                index_path: Optional[str] = None) -> SparseIndex:
+    """Build the sparse index of a sorted file and write its sidecar.
+
+    Args:
+        file_path: Path to the sorted file
+        interval: Index every interval-th line
+        prefix_bytes: Number of leading bytes of each indexed line to keep
+        index_path: Path of the sidecar (defaults to index_path_for(file_path))
+
+    Returns:
+        The built index
+    """
+    signature = _file_signature(file_path)
+    keys = []
+    offsets = []
+    with open(file_path, 'rb') as f:
+        offset = 0
+        for line_num, line in enumerate(f):
+            if line_num % interval == 0:
+                keys.append(line.rstrip(b'\n')[:prefix_bytes])
+                offsets.append(offset)
+            offset += len(line)
+
+    header = dict(signature, version=INDEX_VERSION, interval=interval,
+                  prefix_bytes=prefix_bytes, entries=len(offsets))
+    index_path = index_path or index_path_for(file_path)
+    # Write to a temporary file first so readers never see a partial index
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(json.dumps(header).encode('utf-8') + b'\n')
+        for key, offset in zip(keys, offsets):
+            f.write(_ENTRY.pack(offset, len(key)))
+            f.write(key)
+    os.replace(tmp_path, index_path)
+    return SparseIndex(keys, offsets, prefix_bytes)
+
+
+def load_index(file_path: str, index_path: Optional[str] = None) -> Optional[SparseIndex]:
+    """Load the sparse index of a sorted file.
+
+    Args:
+        file_path: Path to the sorted file
+        index_path: Path of the sidecar (defaults to index_path_for(file_path))
+
+    Returns:
+        The index, or None if there is no sidecar or it is stale
+    """
+    index_path = index_path or index_path_for(file_path)
+    try:
+        with open(index_path, 'rb') as f:
+            header = json.loads(f.readline())
+            if (header.get('version') != INDEX_VERSION or
+                    {k: header.get(k) for k in ('size', 'mtime_ns')} != _file_signature(file_path)):
+                return None
+            data = f.read()
+    except (OSError, ValueError):
+        return None
+
+    keys = []
+    offsets = []
+    pos = 0
+    for _ in range(header['entries']):
+        offset, key_len = _ENTRY.unpack_from(data, pos)
+        pos += _ENTRY.size
+        keys.append(data[pos:pos + key_len])
+        offsets.append(offset)
+        pos += key_len
+    return SparseIndex(keys, offsets, header['prefix_bytes'])
+
+
+def main() -> None:
+    """Command-line interface to build or refresh sparse indexes."""
+    argparser = argparse.ArgumentParser(
+        description='Build the sparse offset index of sorted files, for file_searcher.py.'
+        ' Indexes that are up to date are left alone.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    argparser.add_argument('files', nargs='+', help='Sorted, UTF-8 encoded input files')
+    argparser.add_argument('-n', '--interval', type=int, default=DEFAULT_INTERVAL,
+                           help='Index every Nth line')
+    argparser.add_argument('--prefix-bytes', type=int, default=DEFAULT_PREFIX_BYTES,
+                           help='Number of leading bytes of each indexed line to keep')
+    argparser.add_argument('-f', '--force', action='store_true',
+                           help='Rebuild the indexes even if they are up to date')
+    args = argparser.parse_args()
+
+    for file_path in args.files:
+        if not args.force and load_index(file_path) is not None:
+            sys.stderr.write('%s: index is up to date\n' % file_path)
+            continue
+        index = build_index(file_path, args.interval, args.prefix_bytes)
+        sys.stderr.write('%s: indexed %d lines\n' % (file_path, len(index.offsets)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import pickle
+import random
+import unittest
+
+from fileops import aggregate_states
+from fileops.aggregate_states import (AvgState, DistinctState, MaxState, MinState,
+                                      QuantileState, state_factory)
+
+
+class TestAggregateStates(unittest.TestCase):
+
+    def _split_merge(self, new_state, values, parts=3):
+        ''' Aggregate values in parts, merged after a pickle round trip '''
+        states = [new_state() for _ in range(parts)]
+        for i, value in enumerate(values):
+            states[i % parts].add(value)
+        merged = states[0]
+        for state in states[1:]:
+            merged.merge(pickle.loads(pickle.dumps(state)))
+        return merged
+
+    def test_min_max_avg(self):
+        values = ['3', '-1.5', '10', '2']
+        for new_state, expected in ((MinState, -1.5), (MaxState, 10.0), (AvgState, 3.375)):
+            state = new_state()
+            for value in values:
+                state.add(value)
+            self.assertEqual(state.result(), expected)
+            self.assertEqual(self._split_merge(new_state, values).result(), expected)
+        self.assertIsNone(AvgState().result())
+        self.assertEqual(str(MinState()), 'None')
+
+    def test_count_distinct_exact_when_small(self):
+        values = ['a', 'b', 'a', 'c', 'b'] * 3
+        self.assertEqual(self._split_merge(DistinctState, values).result(), 3)
+
+    def test_count_distinct_approximate(self):
+        values = ['value%d' % (i % 20000) for i in range(50000)]
+        state = self._split_merge(DistinctState, values, parts=4)
+        self.assertIsNone(state.hashes)
+        self.assertEqual(len(state.registers), 1 << aggregate_states.HLL_PRECISION)
+        self.assertAlmostEqual(state.result(), 20000, delta=20000 * 0.05)
+
+        # Merging a small exact state into a sketch
+        small = DistinctState()
+        small.add('other')
+        state.merge(small)
+        self.assertAlmostEqual(state.result(), 20000, delta=20000 * 0.05)
+
+    def test_quantiles_exact_when_small(self):
+        values = [str(v) for v in [5, 1, 4, 2, 3]]
+        self.assertEqual(self._split_merge(state_factory('median'), values).result(), 3.0)
+        self.assertEqual(self._split_merge(state_factory('p100'), values).result(), 5.0)
+        self.assertEqual(self._split_merge(state_factory('p0'), values).result(), 1.0)
+        self.assertIsNone(QuantileState(0.5).result())
+
+    def test_quantiles_approximate(self):
+        rand = random.Random(42)
+        numbers = list(range(100000))
+        rand.shuffle(numbers)
+        values = [str(v) for v in numbers]
+        for quantile in (0.5, 0.95):
+            state = self._split_merge(lambda: QuantileState(quantile), values, parts=5)
+            # Bounded memory, and a small rank error
+            self.assertLess(state.size, 2000)
+            self.assertAlmostEqual(state.result(), quantile * len(values),
+                                   delta=0.02 * len(values))
+
+    def test_state_factory(self):
+        self.assertIsInstance(state_factory('p99.9')(), QuantileState)
+        self.assertAlmostEqual(state_factory('p99.9')().quantile, 0.999)
+        for name in ('sum', 'count', 'p101', 'stddev'):
+            self.assertRaises(ValueError, state_factory, name)
+
+    def test_base_state_is_abstract(self):
+        self.assertRaises(TypeError, aggregate_states.AggregateState)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+import unittest
+from fileops.bloom_filter import BloomFilter, build_key_filter
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(capacity=100)
+        keys = ['key%d' % i for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        # The filter grew past its first slice
+        self.assertGreater(len(bloom.slices), 1)
+        self.assertEqual(len(bloom), 1000)
+        self.assertTrue(all(key in bloom for key in keys))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(5000):
+            bloom.add('in%d' % i)
+        false_positives = sum('out%d' % i in bloom for i in range(20000))
+        self.assertLess(false_positives / 20000, 0.02)
+
+    def test_build_key_filter(self):
+        test_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(test_dir, 'right.csv')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('A,x\nb,y\nČ,z\n')
+            bloom = build_key_filter(path, ',', [0, 1], lower_case=True)
+            self.assertIn('a\tx', bloom)
+            self.assertIn('č\tz', bloom)
+        finally:
+            shutil.rmtree(test_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
+import csv
 import unittest
 import io
-from fileops.csv_unicode import UnicodeReader, UnicodeWriter
+from fileops.csv_unicode import BufferedWriter, UnicodeReader, UnicodeWriter
 
 
 class TestCSVUnicode(unittest.TestCase):
@@ -58,6 +59,69 @@ class TestCSVUnicode(unittest.TestCase):
         self.assertEqual(rows[1], [""])
         self.assertEqual(rows[2], ["", ""])
 
+    def test_split_reader_matches_csv_reader(self):
+        input_data = ('a,b,c\n\n'
+                      'x,,\r\n'
+                      '"quoted, comma",plain\n'
+                      'mid"quote,"multi\nline",end\n'
+                      '"doubled ""quote""",z\n'
+                      'tail,no newline')
+        expected = list(csv.reader(io.StringIO(input_data)))
+        self.assertEqual(list(UnicodeReader(io.StringIO(input_data))), expected)
+        self.assertEqual(len(expected), 7)
+
+        # Rows can also be pulled one by one
+        reader = UnicodeReader(io.StringIO(input_data))
+        self.assertEqual(next(reader), ['a', 'b', 'c'])
+        self.assertEqual(list(reader), expected[1:])
+
+    def test_unquoted_reader(self):
+        input_data = 'a\t"b\tc"\n"d\te\n'
+        rows = list(UnicodeReader(io.StringIO(input_data), delimiter='\t', quoted=False))
+        self.assertEqual(rows, [['a', '"b', 'c"'], ['"d', 'e']])
+
+        # Other csv options go through csv.reader
+        rows = list(UnicodeReader(io.StringIO("'a;b';c\n"), delimiter=';', quotechar="'"))
+        self.assertEqual(rows, [['a;b', 'c']])
+
+    def test_buffered_writer_matches_unicode_writer(self):
+        rows = [["a", "b"], [], [""], ["", ""], ["quo\"te", "com,ma"], ["new\nline", "Café"],
+                ["测试", " spaced "]] * 5
+        for kwds in ({}, {'delimiter': '\t'}, {'delimiter': ';', 'lineterminator': '\n'}):
+            expected = io.StringIO()
+            UnicodeWriter(expected, **kwds).writerows(rows)
+
+            output = io.StringIO()
+            BufferedWriter(output, batch_rows=4, **kwds).writerows(iter(rows))
+            self.assertEqual(output.getvalue(), expected.getvalue())
+
+            # Rows written one by one are buffered until flushed
+            output = io.StringIO()
+            with BufferedWriter(output, batch_rows=4, **kwds) as writer:
+                for row in rows[:6]:
+                    writer.writerow(row)
+                self.assertEqual(output.getvalue(), ''.join(
+                    expected.getvalue().splitlines(True)[:4]))
+                writer.writerows(rows[6:])
+                writer.writerow(rows[0])
+            self.assertEqual(output.getvalue(), expected.getvalue() +
+                             expected.getvalue().splitlines(True)[0])
+
+    def test_buffered_writer_streams_the_first_rows(self):
+        output = io.StringIO()
+        written = []
+
+        def rows():
+            for i in range(20):
+                # Number of lines written when the row is produced
+                written.append(output.getvalue().count('\n'))
+                yield [str(i)]
+
+        BufferedWriter(output, batch_rows=4).writerows(rows())
+        self.assertEqual(output.getvalue(), ''.join('%d\r\n' % i for i in range(20)))
+        # Batches of 1, 2, then 4 rows
+        self.assertEqual(written[:8], [0, 1, 1, 3, 3, 3, 3, 7])
+
 
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
@@ -1,7 +1,9 @@
 import unittest
 import os
 import tempfile
-from fileops.file_diff import process_file_diff
+from unittest import mock
+from fileops import file_ops_common
+from fileops.file_diff import iter_file_diff, process_file_diff, main
 
 
 class TestFileDiff(unittest.TestCase):
@@ -91,6 +93,105 @@ class TestFileDiff(unittest.TestCase):
         )
         self.assertEqual(len(result), 0)
 
+    def test_iter_diff(self):
+        rows = iter_file_diff(
+            self.left_file,
+            self.right_file,
+            left_delim=',',
+            right_delim=','
+        )
+
+        self.assertEqual(next(rows), ['2', 'B', 'Y'])
+        self.assertEqual(list(rows), [['4', 'D', 'W']])
+
+    def test_right_build_side(self):
+        result = process_file_diff(
+            self.left_file,
+            self.right_file,
+            left_delim=',',
+            right_delim=',',
+            build_side='right'
+        )
+
+        self.assertEqual(result, [['2', 'B', 'Y'], ['4', 'D', 'W']])
+
+    def test_auto_build_side_keeps_the_order(self):
+        with open(self.left_file, 'w', encoding='utf-8') as f:
+            f.write('2,A\n4,B\n2,C\n5,D\n6,E\n7,F\n')
+        expected = [['2', 'A'], ['2', 'C'], ['4', 'B'], ['5', 'D'], ['6', 'E'], ['7', 'F']]
+        # The right file is the smaller one, but the rows stay grouped by key
+        self.assertEqual(process_file_diff(self.left_file, self.right_file, left_delim=',',
+                                           right_delim=',', build_side='auto'), expected)
+        self.assertEqual(process_file_diff(self.left_file, self.right_file, left_delim=',',
+                                           right_delim=',', build_side='right'),
+                         [['2', 'A'], ['4', 'B'], ['2', 'C'], ['5', 'D'], ['6', 'E'],
+                          ['7', 'F']])
+
+    def test_compact_keys(self):
+        with open(self.left_file, 'w', encoding='utf-8') as f:
+            f.write('1,A\n3,B\n"2,x",C\n3,D\n1,"E\nmultiline"\n5,F\n')
+        with open(self.right_file, 'w', encoding='utf-8') as f:
+            f.write('3,x\n4,y\n')
+
+        result = process_file_diff(self.left_file, self.right_file, left_delim=',',
+                                   right_delim=',', compact_keys=True)
+        self.assertEqual(result, [['1', 'A'], ['1', 'E\nmultiline'], ['2,x', 'C'], ['5', 'F']])
+
+    def test_bloom_filter(self):
+        with open(self.left_file, 'w', encoding='utf-8') as f:
+            f.write('1,A\n3,B\n2,C\n3,D\n1,E\n5,F\n')
+        with open(self.right_file, 'w', encoding='utf-8') as f:
+            f.write('3,x\n4,y\n')
+
+        result = process_file_diff(self.left_file, self.right_file, left_delim=',',
+                                   right_delim=',', bloom_filter=True)
+        # Rows whose key is not in the filter come out in left file order
+        self.assertEqual(result, [['1', 'A'], ['2', 'C'], ['1', 'E'], ['5', 'F']])
+
+        with mock.patch('fileops.bloom_filter.BloomFilter.__contains__', return_value=True):
+            # False positives are still removed by the hash table
+            result = process_file_diff(self.left_file, self.right_file, left_delim=',',
+                                       right_delim=',', bloom_filter=True)
+        self.assertEqual(result, [['1', 'A'], ['1', 'E'], ['2', 'C'], ['5', 'F']])
+
+        # With compact keys, only the candidate rows are indexed
+        with mock.patch('fileops.bloom_filter.BloomFilter.__contains__',
+                        side_effect=lambda key: key in ('3', '2')), \
+                mock.patch('fileops.file_ops_common.add_offset',
+                           wraps=file_ops_common.add_offset) as add_offset:
+            result = process_file_diff(self.left_file, self.right_file, left_delim=',',
+                                       right_delim=',', bloom_filter=True, compact_keys=True)
+        self.assertEqual(result, [['1', 'A'], ['1', 'E'], ['5', 'F'], ['2', 'C']])
+        self.assertEqual(add_offset.call_count, 3)
+
+    def test_presorted(self):
+        expected = process_file_diff(self.left_file, self.right_file, left_delim=',',
+                                     right_delim=',', algorithm='sort')
+        result = process_file_diff(self.left_file, self.right_file, left_delim=',',
+                                   right_delim=',', presorted=True)
+        self.assertEqual(result, expected)
+        self.assertEqual(result, [['2', 'B', 'Y'], ['4', 'D', 'W']])
+
+        with open(self.right_file, 'w', encoding='utf-8') as f:
+            f.write('3,C,Z\n1,A,X\n')
+        with self.assertRaisesRegex(ValueError, 'right.csv is not sorted by key'):
+            process_file_diff(self.left_file, self.right_file, left_delim=',',
+                              right_delim=',', presorted=True)
+
+    def test_sort_algorithm(self):
+        result = process_file_diff(
+            self.left_file,
+            self.right_file,
+            left_columns='0',
+            right_columns='0',
+            left_delim=',',
+            right_delim=',',
+            algorithm='sort',
+            memory_limit=1
+        )
+
+        self.assertEqual(result, [['2', 'B', 'Y'], ['4', 'D', 'W']])
+
     def test_empty_files(self):
         # Create empty files
         with open(self.left_file, 'w', encoding='utf-8') as f:
@@ -106,6 +207,33 @@ class TestFileDiff(unittest.TestCase):
         )
         self.assertEqual(len(result), 0)
 
+    def test_several_right_files(self):
+        second_file = os.path.join(self.test_dir, 'second.tsv')
+        with open(second_file, 'w', encoding='utf-8') as f:
+            f.write('z\t4\n')
+        try:
+            result = process_file_diff(self.left_file, [self.right_file, second_file],
+                                       left_delim=',', right_columns=['0', '1'],
+                                       right_delim=[',', '\t'])
+            self.assertEqual(result, [['2', 'B', 'Y']])
+            with self.assertRaisesRegex(ValueError, 'Several right files'):
+                process_file_diff(self.left_file, [self.right_file, second_file],
+                                  algorithm='sort')
+
+            # The default right columns apply to both right files
+            output_file = os.path.join(self.test_dir, 'output.csv')
+            with open(second_file, 'w', encoding='utf-8') as f:
+                f.write('4,z\n')
+            argv = ['file_diff.py', '--left-delim=,', '--right-delim=,', '--output',
+                    output_file, self.left_file, self.right_file, second_file]
+            with mock.patch('sys.argv', argv):
+                main()
+            with open(output_file, encoding='utf-8') as f:
+                self.assertEqual(f.read(), '2,B,Y\n')
+            os.unlink(output_file)
+        finally:
+            os.unlink(second_file)
+
 
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
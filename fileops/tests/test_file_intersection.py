@@ -1,7 +1,10 @@
+import gzip
+import lzma
 import unittest
 import os
 import tempfile
-from fileops.file_intersection import process_file_intersection
+from unittest import mock
+from fileops.file_intersection import iter_file_intersection, process_file_intersection, main
 
 
 class TestFileIntersection(unittest.TestCase):
@@ -106,6 +109,153 @@ class TestFileIntersection(unittest.TestCase):
         )
         self.assertEqual(len(result), 2)
 
+    def test_iter_intersection(self):
+        rows = iter_file_intersection(
+            self.left_file,
+            self.right_file,
+            left_delim=',',
+            right_delim=',',
+            insert_cols='3'
+        )
+
+        self.assertEqual(next(rows), ['1', 'A', 'X', 'Extra1'])
+        self.assertEqual(list(rows), [['3', 'C', 'Z', 'Extra2']])
+
+    def test_right_build_side_matches_left(self):
+        with open(self.left_file, 'w', encoding='utf-8') as f:
+            f.write('1,A\n3,B\n2,C\n3,D\n1,E\n5,F\n')
+        with open(self.right_file, 'w', encoding='utf-8') as f:
+            f.write('3,x\n4,y\n1,z\n3,w\n')
+
+        results = [process_file_intersection(
+            self.left_file,
+            self.right_file,
+            left_delim=',',
+            right_delim=',',
+            insert_cols='1',
+            build_side=build_side
+        ) for build_side in ('left', 'right', 'auto')]
+
+        self.assertEqual(results[0], [['3', 'B', 'x'], ['3', 'D', 'x'],
+                                      ['1', 'A', 'z'], ['1', 'E', 'z']])
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+
+    def test_compact_keys(self):
+        with open(self.left_file, 'w', encoding='utf-8') as f:
+            f.write('1,A\n3,B\n"2,x",C\n3,D\n1,"E\nmultiline"\n5,F\n')
+        with open(self.right_file, 'w', encoding='utf-8') as f:
+            f.write('3,x\n4,y\n1,z\n3,w\n"2,x",v\n')
+
+        expected = process_file_intersection(self.left_file, self.right_file,
+                                             left_delim=',', right_delim=',', insert_cols='1')
+        result = process_file_intersection(self.left_file, self.right_file,
+                                           left_delim=',', right_delim=',', insert_cols='1',
+                                           compact_keys=True)
+        self.assertEqual(len(result), 5)
+        self.assertEqual(result, expected)
+
+        # Every key collides: the matches are still verified on the real keys
+        with mock.patch('fileops.file_ops_common.hash_key', return_value=0):
+            result = process_file_intersection(self.left_file, self.right_file,
+                                               left_delim=',', right_delim=',',
+                                               insert_cols='1', compact_keys=True)
+        self.assertEqual(result, expected)
+
+    def test_no_quoting(self):
+        with open(self.left_file, 'w', encoding='utf-8') as f:
+            f.write('"1,A\n2,B\n')
+        with open(self.right_file, 'w', encoding='utf-8') as f:
+            f.write('"1,x\n2,y\n')
+
+        result = process_file_intersection(self.left_file, self.right_file, left_delim=',',
+                                           right_delim=',', insert_cols='1', quoted=False)
+        self.assertEqual(result, [['"1', 'A', 'x'], ['2', 'B', 'y']])
+        for kwargs in ({'compact_keys': True}, {'build_side': 'right'},
+                       {'algorithm': 'sort'}, {'jobs': 2}):
+            self.assertEqual(process_file_intersection(
+                self.left_file, self.right_file, left_delim=',', right_delim=',',
+                insert_cols='1', quoted=False, **kwargs), result)
+
+    def test_compressed_inputs(self):
+        expected = process_file_intersection(self.left_file, self.right_file, left_delim=',',
+                                             right_delim=',', insert_cols='3')
+        left_gz = os.path.join(self.test_dir, 'left.csv.gz')
+        right_xz = os.path.join(self.test_dir, 'right.csv.xz')
+        with open(self.left_file, 'rb') as src, gzip.open(left_gz, 'wb') as dst:
+            dst.write(src.read())
+        with open(self.right_file, 'rb') as src, lzma.open(right_xz, 'wb') as dst:
+            dst.write(src.read())
+        try:
+            for kwargs in ({}, {'build_side': 'right'}, {'algorithm': 'sort'}):
+                result = process_file_intersection(left_gz, right_xz, left_delim=',',
+                                                   right_delim=',', insert_cols='3', **kwargs)
+                self.assertEqual(sorted(result), sorted(expected))
+            # Modes seeking into the files need them uncompressed
+            self.assertRaises(ValueError, process_file_intersection, left_gz, right_xz,
+                              left_delim=',', right_delim=',', jobs=2)
+            self.assertRaises(ValueError, process_file_intersection, left_gz, right_xz,
+                              left_delim=',', right_delim=',', compact_keys=True)
+        finally:
+            os.unlink(left_gz)
+            os.unlink(right_xz)
+
+    def test_bloom_filter(self):
+        expected = process_file_intersection(self.left_file, self.right_file, left_delim=',',
+                                             right_delim=',', insert_cols='2', lower_case=True)
+        self.assertTrue(expected)
+        self.assertEqual(process_file_intersection(
+            self.left_file, self.right_file, left_delim=',', right_delim=',', insert_cols='2',
+            lower_case=True, bloom_filter=True), expected)
+        with mock.patch('fileops.bloom_filter.BloomFilter.__contains__', return_value=False):
+            self.assertEqual(process_file_intersection(
+                self.left_file, self.right_file, left_delim=',', right_delim=',',
+                bloom_filter=True), [])
+        self.assertEqual(process_file_intersection(
+            self.left_file, self.right_file, left_delim=',', right_delim=',', insert_cols='2',
+            lower_case=True, bloom_filter=True, compact_keys=True), expected)
+        with mock.patch('fileops.bloom_filter.BloomFilter.__contains__', return_value=False):
+            self.assertEqual(process_file_intersection(
+                self.left_file, self.right_file, left_delim=',', right_delim=',',
+                bloom_filter=True, compact_keys=True), [])
+
+    def test_presorted(self):
+        with open(self.right_file, 'w', encoding='utf-8') as f:
+            f.write('1,A,X,Extra1\n3,C,Z,Extra2\n3,C,Z,Extra3\n5,E,V,Extra4\n')
+        expected = process_file_intersection(self.left_file, self.right_file, left_delim=',',
+                                             right_delim=',', insert_cols='3',
+                                             algorithm='sort')
+        result = process_file_intersection(self.left_file, self.right_file, left_delim=',',
+                                           right_delim=',', insert_cols='3', presorted=True)
+        self.assertEqual(result, expected)
+        self.assertEqual(result, [['1', 'A', 'X', 'Extra1'], ['3', 'C', 'Z', 'Extra2']])
+
+        with open(self.left_file, 'w', encoding='utf-8') as f:
+            f.write('3,C,Z\n1,A,X\n')
+        with self.assertRaisesRegex(ValueError, 'left.csv is not sorted by key: row 2'):
+            process_file_intersection(self.left_file, self.right_file, left_delim=',',
+                                      right_delim=',', presorted=True)
+        # Without the check, matches after the unsorted row are missed
+        self.assertEqual(process_file_intersection(self.left_file, self.right_file,
+                                                   left_delim=',', right_delim=',',
+                                                   presorted=True, check_order=False),
+                         [['3', 'C', 'Z']])
+
+    def test_sort_algorithm(self):
+        result = process_file_intersection(
+            self.left_file,
+            self.right_file,
+            left_columns='0',
+            right_columns='0',
+            left_delim=',',
+            right_delim=',',
+            insert_cols='3',
+            algorithm='sort',
+            memory_limit=1
+        )
+
+        self.assertEqual(result, [['1', 'A', 'X', 'Extra1'], ['3', 'C', 'Z', 'Extra2']])
+
     def test_empty_files(self):
         # Create empty files
         with open(self.left_file, 'w', encoding='utf-8') as f:
@@ -121,6 +271,44 @@ class TestFileIntersection(unittest.TestCase):
         )
         self.assertEqual(len(result), 0)
 
+    def test_several_right_files(self):
+        second_file = os.path.join(self.test_dir, 'second.tsv')
+        with open(second_file, 'w', encoding='utf-8') as f:
+            f.write('z\t3\nz\t4\nz\t3\n')
+        try:
+            result = process_file_intersection(self.left_file, [self.right_file, second_file],
+                                               left_delim=',', right_columns=['0', '1'],
+                                               right_delim=[',', '\t'])
+            self.assertEqual(result, [['3', 'C', 'Z']])
+            # Keys only in the second file don't count for the first one
+            result = process_file_intersection(self.left_file, [second_file, second_file],
+                                               right_columns='1', left_delim=',')
+            self.assertEqual(result, [['3', 'C', 'Z'], ['4', 'D', 'W']])
+            self.assertEqual(process_file_intersection(
+                self.left_file, [second_file, self.right_file], left_delim=',',
+                right_columns=['1', '0'], right_delim=['\t', ',']), [['3', 'C', 'Z']])
+
+            with self.assertRaisesRegex(ValueError, 'Several right files'):
+                process_file_intersection(self.left_file, [self.right_file, second_file],
+                                          insert_cols='1')
+            with self.assertRaisesRegex(ValueError, 'Got 2 right files, but 1 lists'):
+                process_file_intersection(self.left_file, [self.right_file, second_file],
+                                          right_columns=['0'])
+
+            # The default right columns apply to both right files
+            output_file = os.path.join(self.test_dir, 'output.csv')
+            with open(second_file, 'w', encoding='utf-8') as f:
+                f.write('3,z\n2,z\n')
+            argv = ['file_intersection.py', '--left-delim=,', '--right-delim=,',
+                    '--output', output_file, self.left_file, self.right_file, second_file]
+            with mock.patch('sys.argv', argv):
+                main()
+            with open(output_file, encoding='utf-8') as f:
+                self.assertEqual(f.read(), '3,C,Z\n')
+            os.unlink(output_file)
+        finally:
+            os.unlink(second_file)
+
 
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
@@ -1,5 +1,13 @@
+import bz2
+import gzip
+import lzma
+import os
+import tempfile
 import unittest
-from fileops.file_ops_common import get_key, split_key, set_ops_parser
+from fileops import file_ops_common
+from fileops.file_ops_common import get_key, split_key, set_ops_parser, parse_size, \
+    choose_build_side, split_line_ranges, iter_range_lines, key_getter, iter_offset_rows, \
+    read_row_at, load_offset_index, hash_key, detect_compression, open_input, open_output
 
 
 class TestFileOpsCommon(unittest.TestCase):
@@ -13,6 +21,12 @@ class TestFileOpsCommon(unittest.TestCase):
         key_cols = [0, 2]
         self.assertEqual(get_key(cols, key_cols), "A\tC")
 
+    def test_key_getter(self):
+        cols = ["A", "b", "C"]
+        self.assertEqual(key_getter([1])(cols), "b")
+        self.assertEqual(key_getter([0, 2])(cols), get_key(cols, [0, 2]))
+        self.assertEqual(key_getter([0, 1], lower_case=True)(cols), "a\tb")
+
     def test_split_key_single_value(self):
         key = "A"
         self.assertEqual(split_key(key), ["A"])
@@ -32,6 +46,8 @@ class TestFileOpsCommon(unittest.TestCase):
         self.assertEqual(args.left_delim, '\t')
         self.assertEqual(args.right_delim, '\t')
         self.assertFalse(args.lower_case)
+        self.assertEqual(args.algorithm, 'hash')
+        self.assertEqual(args.memory_limit, 256 * 1024 * 1024)
 
     def test_set_ops_parser_with_options(self):
         parser = set_ops_parser()
@@ -51,6 +67,119 @@ class TestFileOpsCommon(unittest.TestCase):
         self.assertEqual(args.left_delim, ',')
         self.assertEqual(args.right_delim, ';')
 
+    def test_parse_size(self):
+        self.assertEqual(parse_size('1024'), 1024)
+        self.assertEqual(parse_size('4k'), 4096)
+        self.assertEqual(parse_size('512M'), 512 * 1024 ** 2)
+        self.assertEqual(parse_size('1.5GB'), int(1.5 * 1024 ** 3))
+
+    def test_choose_build_side(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            small = os.path.join(test_dir, 'small.txt')
+            big = os.path.join(test_dir, 'big.txt')
+            with open(small, 'w') as f:
+                f.write('a\n')
+            with open(big, 'w') as f:
+                f.write('a\nb\nc\n')
+
+            self.assertEqual(choose_build_side(big, small), 'right')
+            self.assertEqual(choose_build_side(small, big), 'left')
+            self.assertEqual(choose_build_side(small, small), 'left')
+            self.assertEqual(choose_build_side(small, big, 'right'), 'right')
+
+    def test_line_ranges_cover_every_line_once(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            path = os.path.join(test_dir, 'lines.txt')
+            lines = ['line %d %s\n' % (i, 'x' * (i % 13)) for i in range(100)]
+            with open(path, 'w') as f:
+                f.writelines(lines)
+
+            for num_ranges in (1, 3, 7, 1000):
+                ranges = split_line_ranges(path, num_ranges)
+                self.assertLessEqual(len(ranges), num_ranges)
+                result = [line for start, end in ranges
+                          for line in iter_range_lines(path, start, end)]
+                self.assertEqual(result, lines)
+
+    def test_offset_rows(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            path = os.path.join(test_dir, 'rows.csv')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('a,1\n"b\nc",2\ncafé,3\na,4\n')
+
+            rows = list(iter_offset_rows(path, ','))
+            self.assertEqual([cols for _, cols in rows],
+                             [['a', '1'], ['b\nc', '2'], ['café', '3'], ['a', '4']])
+            with open(path, 'rb') as f:
+                for offset, cols in reversed(rows):
+                    self.assertEqual(read_row_at(f, offset, ','), cols)
+
+            index = load_offset_index(path, ',', key_getter([0]))
+            self.assertEqual(list(index.keys()), [hash_key('a'), hash_key('b\nc'), hash_key('café')])
+            self.assertEqual(index[hash_key('a')], [rows[0][0], rows[3][0]])
+
+    def test_compressed_input(self):
+        content = ''.join('row%d,café\n' % i for i in range(50000))
+        with tempfile.TemporaryDirectory() as test_dir:
+            plain = os.path.join(test_dir, 'plain.csv')
+            with open(plain, 'w', encoding='utf-8') as f:
+                f.write(content)
+            self.assertIsNone(detect_compression(plain))
+
+            for name, module in (('gzip', gzip), ('bz2', bz2), ('xz', lzma)):
+                # Detection doesn't depend on the file name
+                path = os.path.join(test_dir, 'compressed-' + name)
+                with module.open(path, 'wt', encoding='utf-8') as f:
+                    f.write(content)
+                self.assertEqual(detect_compression(path), name)
+                with open_input(path, 'r', encoding='utf-8') as f:
+                    self.assertEqual(f.read(), content)
+                with open_input(path, 'rb') as f:
+                    self.assertEqual(f.readline(), b'row0,caf\xc3\xa9\n')
+                # Closing early stops the background thread
+                f = open_input(path, 'r', encoding='utf-8')
+                self.assertEqual(next(f), 'row0,café\n')
+                f.close()
+                f.buffer.raw.thread.join(5)
+                self.assertFalse(f.buffer.raw.thread.is_alive())
+
+            self.assertRaises(ValueError, file_ops_common.require_uncompressed, '--jobs',
+                              plain, path)
+            file_ops_common.require_uncompressed('--jobs', plain)
+
+            # Decompression errors are raised by the reader
+            truncated = os.path.join(test_dir, 'truncated.gz')
+            with open(truncated, 'wb') as f:
+                f.write(gzip.compress(content.encode('utf-8'))[:1000])
+            with open_input(truncated, 'r', encoding='utf-8') as f:
+                self.assertRaises(EOFError, f.read)
+
+    def test_compressed_output(self):
+        with tempfile.TemporaryDirectory() as test_dir:
+            for ext, module in (('', open), ('.gz', gzip.open), ('.bz2', bz2.open),
+                                ('.xz', lzma.open)):
+                path = os.path.join(test_dir, 'out.txt' + ext)
+                with open_output(path) as f:
+                    f.write('a,b\r\ncafé\n')
+                with module(path, 'rb') as f:
+                    self.assertEqual(f.read(), 'a,b\r\ncafé\n'.encode('utf-8'))
+
+    def test_several_right_files(self):
+        args = set_ops_parser().parse_args(['left.txt', 'a.txt', 'b.txt', '-r', '1;0,2'])
+        self.assertEqual(args.more_right_files, ['b.txt'])
+        right_files, right_columns = file_ops_common.right_files_args(args)
+        self.assertEqual(right_files, ['a.txt', 'b.txt'])
+        self.assertEqual(file_ops_common.right_file_specs(right_files, right_columns, ','),
+                         [('a.txt', [1], ','), ('b.txt', [0, 2], ',')])
+        self.assertEqual(file_ops_common.right_files_args(
+            set_ops_parser().parse_args(['left.txt', 'a.txt'])), ('a.txt', '0'))
+
+        # A single list of columns is used for every right file
+        args = set_ops_parser().parse_args(['left.txt', 'a.txt', 'b.txt'])
+        right_files, right_columns = file_ops_common.right_files_args(args)
+        self.assertEqual(file_ops_common.right_file_specs(right_files, right_columns, ','),
+                         [('a.txt', [0], ','), ('b.txt', [0], ',')])
+
 
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
@@ -0,0 +1,75 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from fileops.file_diff import process_file_diff
+from fileops.file_intersection import process_file_intersection
+from fileops.file_reconcile import iter_file_reconcile, process_file_reconcile, main
+
+
+class TestFileReconcile(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+        self.left_file = os.path.join(self.test_dir, 'left.csv')
+        with open(self.left_file, 'w', encoding='utf-8') as f:
+            f.write('1,A,X\n2,B,Y\n3,C,Z\n4,D,W\n2,b,V\n')
+
+        self.right_file = os.path.join(self.test_dir, 'right.csv')
+        with open(self.right_file, 'w', encoding='utf-8') as f:
+            f.write('3,c,first\n5,E,x\n1,a,second\n3,C,third\n6,F,y\n5,E,z\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_reconcile(self):
+        result = process_file_reconcile(self.left_file, self.right_file, left_delim=',',
+                                        right_delim=',', insert_cols='2')
+        self.assertEqual(result, {
+            'left_only': [['2', 'B', 'Y'], ['2', 'b', 'V'], ['4', 'D', 'W']],
+            'right_only': [['5', 'E', 'x'], ['6', 'F', 'y'], ['5', 'E', 'z']],
+            'matched': [['3', 'C', 'Z', 'first'], ['1', 'A', 'X', 'second']]})
+
+    def test_same_as_diffs_and_intersection(self):
+        for kwargs in ({'left_columns': '0', 'right_columns': '0'},
+                       {'left_columns': '0,1', 'right_columns': '0,1', 'lower_case': True},
+                       {'left_columns': '1', 'right_columns': '1'}):
+            result = process_file_reconcile(self.left_file, self.right_file, left_delim=',',
+                                            right_delim=',', insert_cols='2', **kwargs)
+            self.assertEqual(result['left_only'], process_file_diff(
+                self.left_file, self.right_file, left_delim=',', right_delim=',', **kwargs))
+            swapped = dict(kwargs, left_columns=kwargs['right_columns'],
+                           right_columns=kwargs['left_columns'])
+            self.assertEqual(sorted(result['right_only']), sorted(process_file_diff(
+                self.right_file, self.left_file, left_delim=',', right_delim=',', **swapped)))
+            self.assertEqual(result['matched'], process_file_intersection(
+                self.left_file, self.right_file, left_delim=',', right_delim=',',
+                insert_cols='2', **kwargs))
+
+    def test_iter_reconcile_streams_right_only_rows(self):
+        rows = iter_file_reconcile(self.left_file, self.right_file, left_delim=',',
+                                   right_delim=',')
+        self.assertEqual(next(rows), ('matched', ['3', 'C', 'Z']))
+        self.assertEqual(next(rows), ('right_only', ['5', 'E', 'x']))
+
+    def test_main(self):
+        left_only = os.path.join(self.test_dir, 'left_only.csv')
+        matched = os.path.join(self.test_dir, 'matched.csv.gz')
+        argv = ['file_reconcile.py', '--left-delim', ',', '--right-delim', ',',
+                '--left-only', left_only, '--matched', matched, self.left_file,
+                self.right_file]
+        with mock.patch('sys.argv', argv), \
+                mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            main()
+        self.assertEqual(stderr.getvalue(), 'left_only\t3\nright_only\t3\nmatched\t2\n')
+        with open(left_only, encoding='utf-8') as f:
+            self.assertEqual(f.read().splitlines(), ['2,B,Y', '2,b,V', '4,D,W'])
+        with gzip.open(matched, 'rt', encoding='utf-8') as f:
+            self.assertEqual(f.read().splitlines(), ['3,C,Z', '1,A,X'])
+
+
+if __name__ == '__main__':
+    unittest.main()
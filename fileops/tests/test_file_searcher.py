@@ -1,7 +1,10 @@
+import gzip
 import unittest
+import io
 import os
 import tempfile
-from fileops.file_searcher import Searcher
+from unittest import mock
+from fileops.file_searcher import Searcher, main
 
 
 class TestFileSearcher(unittest.TestCase):
@@ -24,6 +27,21 @@ class TestFileSearcher(unittest.TestCase):
         os.unlink(self.test_file)
         os.rmdir(self.test_dir)
 
+    def test_compressed_file(self):
+        compressed = os.path.join(self.test_dir, 'test.txt.gz')
+        with open(self.test_file, 'rb') as src, gzip.open(compressed, 'wb') as dst:
+            dst.write(src.read())
+        try:
+            for use_mmap in (False, True):
+                with Searcher(compressed, use_mmap=use_mmap) as searcher:
+                    self.assertEqual(searcher.find('cherry'), ['cherry'])
+                    self.assertEqual(searcher.find('zebra'), [])
+                    decompressed_path = searcher.decompressed_path
+                    self.assertTrue(os.path.exists(decompressed_path))
+                self.assertFalse(os.path.exists(decompressed_path))
+        finally:
+            os.unlink(compressed)
+
     def test_basic_search(self):
         with Searcher(self.test_file) as searcher:
             results = searcher.find('cherry', verbose=True)
@@ -71,5 +89,118 @@ class TestFileSearcher(unittest.TestCase):
             self.assertEqual(len(results), 2)
             self.assertEqual(results, ['café', 'café au lait'])
 
+    def test_mmap_search(self):
+        with open(self.test_file, 'w', encoding='utf-8') as f:
+            f.write('ab\n')
+            f.write('ab\tx\n')
+            f.write('caffè\n')
+            f.write('café\n')
+            f.write('café au lait\n')
+            f.write('coffee\n')
+            f.write('test1\n')
+            f.write('test2\n')
+            f.write('testing\n')
+            f.write('toast')
+
+        expected = {
+            'ab': ['ab', 'ab\tx'],
+            'ab\t': ['ab\tx'],
+            'caf': ['caffè', 'café', 'café au lait'],
+            'café': ['café', 'café au lait'],
+            'coffee': ['coffee'],
+            'test': ['test1', 'test2', 'testing'],
+            'toast': ['toast'],
+            'toasts': [],
+            'zebra': [],
+            'aa': [],
+        }
+        with Searcher(self.test_file, use_mmap=True) as searcher:
+            for prefix, lines in expected.items():
+                self.assertEqual(searcher.find(prefix), lines, prefix)
+
+    def test_find_many(self):
+        with open(self.test_file, 'w', encoding='utf-8') as f:
+            for i in range(2000):
+                f.write('key%05d\tvalue%d\n' % (i * 3, i))
+
+        prefixes = ['key%05d' % i for i in range(0, 6100, 7)] + ['key0', 'key001', 'a', 'z', '']
+        for use_mmap in (True, False):
+            with Searcher(self.test_file, use_mmap=use_mmap) as searcher:
+                results = searcher.find_many(reversed(prefixes))
+                self.assertEqual(set(results), set(prefixes))
+                for prefix in prefixes:
+                    self.assertEqual(results[prefix], searcher.find(prefix), prefix)
+                self.assertEqual(results['key00021'], ['key00021\tvalue7'])
+                self.assertEqual(len(results['key001']), 33)
+
+        # In text mode, every search starts where the previous one ended
+        with Searcher(self.test_file) as searcher:
+            with mock.patch.object(searcher, '_find_first_match',
+                                   wraps=searcher._find_first_match) as find_first_match:
+                searcher.find_many(prefixes)
+            starts = [call.args[2] for call in find_first_match.call_args_list]
+            self.assertEqual(starts, sorted(starts))
+            self.assertGreater(starts[-1], 30000)
+
+    def test_find_many_text_mode(self):
+        with Searcher(self.test_file) as searcher:
+            results = searcher.find_many(['cherry', 'apple', 'zebra'])
+            self.assertEqual(results, {'apple': ['apple'], 'cherry': ['cherry'], 'zebra': []})
+
+    def test_main_reads_prefixes_from_stdin(self):
+        with mock.patch('sys.argv', ['file_searcher.py', '--mmap', self.test_file]), \
+                mock.patch('sys.stdin', io.StringIO('fig\nzebra\nbanana\n')), \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            main()
+        self.assertEqual(stdout.getvalue(), 'fig\tfig\nbanana\tbanana\n')
+
+    def test_result_cache(self):
+        with Searcher(self.test_file, use_mmap=True, result_cache_entries=2) as searcher:
+            self.assertEqual(searcher.find('cherry'), ['cherry'])
+            self.assertEqual(searcher.find('cherry'), ['cherry'])
+            self.assertEqual(searcher.find_many(['cherry', 'fig', 'zebra']),
+                             {'cherry': ['cherry'], 'fig': ['fig'], 'zebra': []})
+            info = searcher.cache_info()['results']
+            self.assertEqual((info['hits'], info['misses'], info['entries']), (2, 3, 2))
+
+            # The result lists handed out are copies
+            searcher.find('fig').append('oops')
+            self.assertEqual(searcher.find('fig'), ['fig'])
+
+    def test_caches_are_invalidated_when_file_changes(self):
+        with Searcher(self.test_file, use_mmap=True, result_cache_entries=10,
+                      probe_cache_entries=10) as searcher:
+            self.assertEqual(searcher.find('date'), ['date'])
+            with open(self.test_file, 'w', encoding='utf-8') as f:
+                f.write('apple\ndate\ndates\n')
+            self.assertEqual(searcher.find('date'), ['date', 'dates'])
+            self.assertEqual(searcher.cache_info()['results']['entries'], 1)
+
+    def test_probe_cache(self):
+        # Lines longer and shorter than the cached probe heads
+        lines = sorted('%s%04d' % ('x' * (i % 300), i) for i in range(1000))
+        with open(self.test_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        prefixes = ['x' * n for n in (0, 5, 255, 256, 257, 299, 300)] + ['0', 'x0', 'x' * 299 + '0']
+        with Searcher(self.test_file, use_mmap=True, probe_cache_entries=64) as searcher:
+            for _ in range(2):
+                for prefix in prefixes:
+                    expected = [line for line in lines if line.startswith(prefix)]
+                    self.assertEqual(searcher.find(prefix), expected, prefix)
+            self.assertGreater(searcher.cache_info()['probes']['hits'], 0)
+
+    def test_probe_cache_needs_mmap(self):
+        with self.assertRaisesRegex(ValueError, 'needs use_mmap'):
+            Searcher(self.test_file, probe_cache_entries=64)
+
+    def test_mmap_empty_file(self):
+        with open(self.test_file, 'w', encoding='utf-8') as f:
+            pass
+
+        with Searcher(self.test_file, use_mmap=True) as searcher:
+            self.assertEqual(searcher.find('test'), [])
+
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
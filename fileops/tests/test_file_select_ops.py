@@ -2,7 +2,14 @@ import unittest
 import os
 import tempfile
 import shutil
-from fileops.file_select_ops import process_select_operations
+import bz2
+import gzip
+import io
+import json
+import sys
+from unittest import mock
+from fileops import file_select_ops
+from fileops.file_select_ops import iter_select_operations, process_select_operations
 
 class TestFileSelectOps(unittest.TestCase):
 
@@ -43,6 +50,16 @@ class TestFileSelectOps(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.test_dir)
 
+    def write_big_file(self, num_rows, num_names, name_step=1):
+        ''' Write big.csv, with the columns of sample.csv and num_names names '''
+        big_file = os.path.join(self.test_dir, 'big.csv')
+        with open(big_file, 'w', encoding='utf-8') as f:
+            f.write("name,category,value,city\n")
+            for i in range(num_rows):
+                f.write("item%d,%s,%d,city%d\n" % (i * name_step % num_names, 'ABCČ'[i % 4],
+                                                   i % 100, i % 5))
+        return big_file
+
     def test_simple_sum_aggregation(self):
         # Select category (col 1), sum value (col 2)
         # Expected output: [['A', '15.0'], ['B', '35.0'], ['C', '30.0']] (order might vary) for original sample
@@ -177,6 +194,289 @@ class TestFileSelectOps(unittest.TestCase):
         expected_result = [['itemČ', '35.0']]
         self.assertEqual(sorted(result), sorted(expected_result))
 
+    def test_iter_select_operations(self):
+        rows = iter_select_operations(
+            input_file_path=self.test_file_csv,
+            select_cols_str='1',  # category
+            aggregate_cols_str='2',  # value
+            agg_function='sum',
+            where_clauses_list=None,
+            delimiter_char=','
+        )
+        self.assertEqual(sorted(rows), [['A', '40.0'], ['B', '35.0'], ['C', '30.0']])
+
+    def test_parallel_jobs(self):
+        big_file = self.write_big_file(3000, 17)
+
+        for agg_function, where_clauses in (('sum', None), ('count', ['3!=city0', '1=A,Č'])):
+            expected = process_select_operations(big_file, '0,1', '2', agg_function,
+                                                 where_clauses, ',')
+            result = process_select_operations(big_file, '0,1', '2', agg_function,
+                                               where_clauses, ',', jobs=4)
+            self.assertTrue(expected)
+            self.assertEqual(result, expected)
+
+        # The header is only skipped once
+        self.assertEqual(process_select_operations(self.header_only_file_csv, '0', '1', 'count',
+                                                   None, ',', jobs=2), [])
+        self.assertEqual(process_select_operations(self.empty_file, '0', '1', 'count',
+                                                   None, ',', jobs=2), [])
+
+    def test_memory_limit_spills(self):
+        big_file = self.write_big_file(10000, 1500, name_step=7)
+
+        for agg_function, where_clauses in (('sum', None), ('count', ['3!=city0'])):
+            expected = process_select_operations(big_file, '0,1', '2', agg_function,
+                                                 where_clauses, ',')
+            # A tiny budget spills the aggregates after every batch of rows
+            result = process_select_operations(big_file, '0,1', '2', agg_function,
+                                               where_clauses, ',', memory_limit=1)
+            self.assertGreater(len(expected), 1000)
+            self.assertEqual(result, expected)
+
+        # Partitions with too many groups to re-aggregate in memory are split again
+        expected = process_select_operations(big_file, '0,1', '2', 'sum', None, ',')
+        sorted_sizes = []
+        write_records = file_select_ops.sort_merge.write_records
+        def record_sizes(path, records):
+            if isinstance(records, list):
+                sorted_sizes.append(len(records))
+            write_records(path, records)
+        with mock.patch('fileops.sort_merge.write_records', side_effect=record_sizes):
+            # Room for 10 groups of 1 value
+            result = process_select_operations(big_file, '0,1', '2', 'sum', None, ',',
+                                               memory_limit=5000)
+        self.assertEqual(result, expected)
+        self.assertGreater(len(sorted_sizes), 64)
+        self.assertLessEqual(max(sorted_sizes), 10)
+
+        with self.assertRaisesRegex(ValueError, 'memory limit'):
+            process_select_operations(big_file, '0', '2', 'sum', None, ',', jobs=2,
+                                      memory_limit=1)
+        argv = ['file_select_ops.py', '-j', '2', '-m', '1M', big_file]
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch('sys.stderr', new_callable=io.StringIO) as stderr, \
+                self.assertRaises(SystemExit):
+            file_select_ops.parse_args()
+        self.assertIn('--memory-limit can\'t be used with --jobs', stderr.getvalue())
+
+        # Nothing is spilled when the groups fit
+        self.assertEqual(process_select_operations(self.test_file_csv, '1', '2', 'sum', None,
+                                                   ',', memory_limit=1 << 20),
+                         [['A', '40.0'], ['B', '35.0'], ['C', '30.0']])
+        self.assertEqual(process_select_operations(self.empty_file, '0', '1', 'count',
+                                                   None, ',', memory_limit=1), [])
+
+    def test_min_max_avg_aggregations(self):
+        for agg_function, expected in (('min', [['A', '5.0'], ['B', '15.0'], ['C', '30.0']]),
+                                       ('max', [['A', '25.0'], ['B', '20.0'], ['C', '30.0']]),
+                                       ('avg', [['A', '13.333333333333334'], ['B', '17.5'],
+                                                ['C', '30.0']]),
+                                       ('median', [['A', '10.0'], ['B', '15.0'],
+                                                   ['C', '30.0']])):
+            result = process_select_operations(self.test_file_csv, '1', '2', agg_function,
+                                               None, ',')
+            self.assertEqual(sorted(result), expected)
+
+    def test_count_distinct_aggregation(self):
+        result = process_select_operations(self.test_file_csv, '1', '0,3', 'count_distinct',
+                                           None, ',')
+        self.assertEqual(sorted(result), [['A', '2', '2'], ['B', '1', '1'], ['C', '1', '1']])
+
+    def test_states_merge_in_parallel_and_spilling_modes(self):
+        big_file = self.write_big_file(6000, 700)
+
+        for agg_function, agg_cols in (('min', '2'), ('max', '2'), ('avg', '2'),
+                                       ('count_distinct', '0,2')):
+            expected = process_select_operations(big_file, '1', agg_cols, agg_function,
+                                                 None, ',')
+            self.assertEqual(process_select_operations(big_file, '1', agg_cols, agg_function,
+                                                       None, ',', jobs=3), expected)
+            self.assertEqual(process_select_operations(big_file, '1', agg_cols, agg_function,
+                                                       None, ',', memory_limit=1), expected)
+
+        # Sketches merged in a different order give close results
+        for kwargs in ({}, {'jobs': 3}, {'memory_limit': 1}):
+            for _, value in process_select_operations(big_file, '1', '2', 'p90', None, ',',
+                                                      **kwargs):
+                self.assertAlmostEqual(float(value), 90, delta=3)
+
+    def test_having_order_by_limit(self):
+        # SUM of value by name: item1 15, itemČ 35, itemÖ 30, itemØ 25
+        result = process_select_operations(self.test_file_csv, '0', '2', 'sum', None, ',',
+                                           having_clauses_list=['2>20'])
+        self.assertEqual(result, [['itemČ', '35.0'], ['itemÖ', '30.0'], ['itemØ', '25.0']])
+        result = process_select_operations(self.test_file_csv, '0', '2', 'sum', None, ',',
+                                           having_clauses_list=['2>20', '2!=30'])
+        self.assertEqual(result, [['itemČ', '35.0'], ['itemØ', '25.0']])
+
+        result = process_select_operations(self.test_file_csv, '0', '2', 'sum', None, ',',
+                                           order_by_str='2:desc', limit=2)
+        self.assertEqual(result, [['itemČ', '35.0'], ['itemÖ', '30.0']])
+        result = process_select_operations(self.test_file_csv, '0', '2', 'sum', None, ',',
+                                           order_by_str='2')
+        self.assertEqual([row[0] for row in result], ['item1', 'itemØ', 'itemÖ', 'itemČ'])
+        result = process_select_operations(self.test_file_csv, '0', '2', 'sum', None, ',',
+                                           order_by_str='0:desc', limit=3)
+        self.assertEqual([row[0] for row in result], ['itemČ', 'itemØ', 'itemÖ'])
+
+        # Ties keep their order of first occurrence, and LIMIT alone keeps the first groups
+        result = process_select_operations(self.test_file_csv, '1,3', '2', 'count', None, ',',
+                                           order_by_str='2:desc', limit=2)
+        self.assertEqual(result, [['A', 'New York', '2'], ['B', 'London', '2']])
+        result = process_select_operations(self.test_file_csv, '1,3', '2', 'count', None, ',',
+                                           order_by_str='2:desc,1:desc', limit=2)
+        self.assertEqual(result, [['B', 'London', '2'], ['A', 'New York', '2']])
+        result = process_select_operations(self.test_file_csv, '1', '2', 'avg', None, ',',
+                                           limit=2)
+        self.assertEqual(result, [['A', '13.333333333333334'], ['B', '17.5']])
+
+        self.assertRaises(ValueError, process_select_operations, self.test_file_csv, '0',
+                          '2', 'sum', None, ',', having_clauses_list=['2~3'])
+        self.assertRaises(ValueError, process_select_operations, self.test_file_csv, '0',
+                          '2', 'sum', None, ',', order_by_str='3')
+
+    def test_multi_select_operations(self):
+        queries = [
+            {'select_cols': '1', 'aggregate_cols': '2'},
+            {'select_cols': '0,3', 'aggregate_cols': '2', 'aggregate_function': 'count',
+             'where_clauses': ['1!=C']},
+            {'select_cols': '3', 'aggregate_cols': '2', 'aggregate_function': 'MAX',
+             'having': ['2>=20'], 'order_by': '2:desc', 'limit': 2},
+        ]
+        spec_path = os.path.join(self.test_dir, 'queries.json')
+        with open(spec_path, 'w') as f:
+            json.dump(queries, f)
+        loaded = file_select_ops.load_query_specs(spec_path)
+        self.assertEqual([query['aggregate_function'] for query in loaded],
+                         ['sum', 'count', 'max'])
+
+        results = file_select_ops.process_multi_select_operations(self.test_file_csv,
+                                                                  loaded, ',')
+        self.assertEqual(results, [
+            process_select_operations(self.test_file_csv, '1', '2', 'sum', None, ','),
+            process_select_operations(self.test_file_csv, '0,3', '2', 'count', ['1!=C'], ','),
+            process_select_operations(self.test_file_csv, '3', '2', 'max', None, ',',
+                                      having_clauses_list=['2>=20'], order_by_str='2:desc',
+                                      limit=2),
+        ])
+        self.assertEqual(results[2], [['Berlin', '30.0'], ['New York', '25.0']])
+
+        with open(spec_path, 'w') as f:
+            json.dump([{'select_cols': '1', 'where': ['1=A']}], f)
+        self.assertRaises(ValueError, file_select_ops.load_query_specs, spec_path)
+
+        # A bad aggregate function fails when loading, before the scan
+        with open(spec_path, 'w') as f:
+            json.dump([{'select_cols': '1'}, {'aggregate_function': 'avgg'}], f)
+        with self.assertRaisesRegex(ValueError,
+                                    'Query spec 2: Invalid aggregate function: avgg'):
+            file_select_ops.load_query_specs(spec_path)
+
+    def test_main_with_queries_writes_each_output(self):
+        outputs = [os.path.join(self.test_dir, 'out%d.csv' % i) for i in range(2)]
+        spec_path = os.path.join(self.test_dir, 'queries.json')
+        with open(spec_path, 'w') as f:
+            json.dump([{'select_cols': '1', 'aggregate_cols': '2', 'output': outputs[0]},
+                       {'select_cols': '0', 'aggregate_cols': '2',
+                        'aggregate_function': 'count', 'where_clauses': ['1=B'],
+                        'output': outputs[1]}], f)
+        argv = ['file_select_ops.py', '-d', ',', '--queries', spec_path, self.test_file_csv]
+        with mock.patch.object(sys, 'argv', argv):
+            file_select_ops.main()
+        with open(outputs[0], encoding='utf-8') as f:
+            self.assertEqual(f.read().splitlines(), ['A,40.0', 'B,35.0', 'C,30.0'])
+        with open(outputs[1], encoding='utf-8') as f:
+            self.assertEqual(f.read().splitlines(), ['itemČ,2'])
+
+    def test_main_with_invalid_clauses(self):
+        for options, message in ((['--having', '2~3'], 'Invalid HAVING clause: 2~3'),
+                                 (['--having', '1>3'], 'HAVING column 1 is not aggregated'),
+                                 (['--order-by', '2:up'], 'Invalid ORDER BY direction: up')):
+            argv = (['file_select_ops.py', '-d', ',', '-v', '-s', '0', '-a', '2'] + options +
+                    [self.test_file_csv])
+            with mock.patch.object(sys, 'argv', argv), \
+                    mock.patch.object(sys, 'stderr', new_callable=io.StringIO) as stderr:
+                with self.assertRaises(SystemExit):
+                    file_select_ops.main()
+            # Reported like the other bad arguments, before -v prints the query
+            self.assertTrue(stderr.getvalue().startswith('usage:'), options)
+            self.assertIn('error: ' + message, stderr.getvalue())
+
+    def test_compile_where(self):
+        self.assertIsNone(file_select_ops.compile_where({}))
+        for clauses, row, expected in ((['1=A,B'], ['x', 'B'], True),
+                                       (['1=A,B'], ['x', 'C'], False),
+                                       (['0!=x'], ['x', 'A'], False),
+                                       (['0!=x'], ['y', 'A'], True),
+                                       (['0!=x', '1=A'], ['y', 'A'], True),
+                                       (['0!=x', '1=A'], ['x', 'A'], False),
+                                       (['0=y', '1=A'], ['y', 'B'], False)):
+            matches = file_select_ops.compile_where(
+                file_select_ops.parse_where_clauses(clauses))
+            self.assertEqual(matches(row), expected, (clauses, row))
+
+    def test_compile_line_filter(self):
+        parse = file_select_ops.parse_where_clauses
+        # NOT IN clauses can't reject lines, nor IN clauses accepting empty values
+        self.assertIsNone(file_select_ops.compile_line_filter(parse(['0!=a'])))
+        self.assertIsNone(file_select_ops.compile_line_filter(parse(['0=a,'])))
+        line_filter = file_select_ops.compile_line_filter(parse(['0=a.b,c', '2=d', '1!=e']))
+        self.assertTrue(line_filter('a.b,x,d\n'))
+        self.assertTrue(line_filter('x,c,d\n'))
+        self.assertFalse(line_filter('aXb,x,d\n'))
+        self.assertFalse(line_filter('c,x,y\n'))
+
+    def test_prefilter(self):
+        big_file = self.write_big_file(3000, 17)
+
+        where_clauses = ['1=Č,B', '3=city1,city2', '0!=item3']
+        expected = process_select_operations(big_file, '0,1', '2', 'sum', where_clauses, ',')
+        self.assertTrue(expected)
+        # Unquoted input is prefiltered by default
+        with mock.patch.object(file_select_ops, 'compile_line_filter',
+                               wraps=file_select_ops.compile_line_filter) as line_filter:
+            for kwargs in ({}, {'jobs': 3}, {'memory_limit': 1}, {'prefilter': True}):
+                self.assertEqual(process_select_operations(big_file, '0,1', '2', 'sum',
+                                                           where_clauses, ',', quoted=False,
+                                                           **kwargs), expected)
+            self.assertEqual(line_filter.call_count, 4)
+        # The header never goes through the filter
+        self.assertEqual(process_select_operations(self.test_file_csv, '1', '2', 'sum',
+                                                   ['1=category,A'], ',', quoted=False),
+                         [['A', '40.0']])
+
+        # Quoted values may be spelled differently in the line, so quoted
+        # input is never prefiltered
+        with open(big_file, 'w', encoding='utf-8') as f:
+            f.write('name,value\n"x""y",1\n"x\ny",2\n')
+        self.assertEqual(process_select_operations(big_file, '0', '1', 'sum', ['0=x"y,x\ny'],
+                                                   ','), [['x"y', '1.0'], ['x\ny', '2.0']])
+        with self.assertRaisesRegex(ValueError, 'prefilter needs unquoted fields'):
+            process_select_operations(big_file, '0', '1', 'sum', ['0=x"y'], ',',
+                                      prefilter=True)
+        argv = ['file_select_ops.py', '-p', big_file, '-w', '0=a']
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch('sys.stderr', new_callable=io.StringIO) as stderr, \
+                self.assertRaises(SystemExit):
+            file_select_ops.parse_args()
+        self.assertIn('--prefilter needs --no-quoting', stderr.getvalue())
+
+    def test_compressed_input_and_output(self):
+        compressed = os.path.join(self.test_dir, 'sample.csv.bz2')
+        with open(self.test_file_csv, 'rb') as src, bz2.open(compressed, 'wb') as dst:
+            dst.write(src.read())
+        self.assertEqual(process_select_operations(compressed, '1', '2', 'sum', None, ','),
+                         [['A', '40.0'], ['B', '35.0'], ['C', '30.0']])
+
+        output = os.path.join(self.test_dir, 'out.csv.gz')
+        argv = ['file_select_ops.py', '-s', '1', '-a', '2', '-d', ',', '--output', output,
+                compressed]
+        with mock.patch.object(sys, 'argv', argv):
+            file_select_ops.main()
+        with gzip.open(output, 'rt', encoding='utf-8') as f:
+            self.assertEqual(f.read().splitlines(), ['A,40.0', 'B,35.0', 'C,30.0'])
+
     def test_empty_file(self):
         result = process_select_operations(
             input_file_path=self.empty_file,
@@ -0,0 +1,126 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from fileops.file_diff import process_file_diff
+from fileops.file_intersection import process_file_intersection
+from fileops.hash_index import HashIndex, build_index, load_index, index_path_for, main
+
+
+class TestHashIndex(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+        self.right_file = os.path.join(self.test_dir, 'right.csv')
+        self.write_file(self.right_file, ['k1,x,1', 'K2,y,2', 'k3,"multi\nline",3', 'k1,z,4',
+                                          'k5,ž,5'])
+        self.left_file = os.path.join(self.test_dir, 'left.csv')
+        self.write_file(self.left_file, ['k3,a', 'k1,b', 'k2,c', 'k4,d', 'k3,e', 'k5,f'])
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_file(self, path, lines):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def test_lookup(self):
+        with build_index(self.right_file, [0], ',') as index:
+            self.assertEqual(index.num_rows, 5)
+            self.assertEqual([cols for _, cols in index.iter_rows('k1')],
+                             [['k1', 'x', '1'], ['k1', 'z', '4']])
+            self.assertEqual(index.first_row('k3'), (14, ['k3', 'multi\nline', '3']))
+            self.assertIn('k5', index)
+            self.assertNotIn('k2', index)
+            self.assertNotIn('k4', index)
+
+        with build_index(self.right_file, [0, 2], ',', lower_case=True) as index:
+            self.assertEqual(index.first_row('k2\t2')[1], ['K2', 'y', '2'])
+
+    def test_digest_collisions(self):
+        with mock.patch('fileops.file_ops_common.hash_key', return_value=7):
+            with build_index(self.right_file, [0], ',') as index:
+                self.assertEqual(len(index.candidates('k1')), 5)
+                self.assertEqual([cols[2] for _, cols in index.iter_rows('k1')], ['1', '4'])
+                self.assertNotIn('k4', index)
+
+    def test_stale_or_mismatching_index_is_ignored(self):
+        build_index(self.right_file, [0], ',').close()
+        self.assertTrue(os.path.exists(index_path_for(self.right_file, [0])))
+        self.assertIsNone(load_index(self.right_file, [1], ','))
+        self.assertIsNone(load_index(self.right_file, [0], ',', lower_case=True))
+        self.assertIsNone(load_index(self.right_file, [0], '\t'))
+        self.assertIsNone(load_index(self.right_file, [0], ',', quoted=False))
+        load_index(self.right_file, [0], ',').close()
+
+        with open(self.right_file, 'a', encoding='utf-8') as f:
+            f.write('k4,w,6\n')
+        self.assertIsNone(load_index(self.right_file, [0], ','))
+
+    def test_empty_file(self):
+        open(self.right_file, 'w').close()
+        with build_index(self.right_file, [0], ',') as index:
+            self.assertEqual(index.num_rows, 0)
+            self.assertNotIn('k1', index)
+
+    def test_compressed_file(self):
+        compressed = os.path.join(self.test_dir, 'right.csv.gz')
+        with gzip.open(compressed, 'wt') as f:
+            f.write('k1,x\n')
+        with self.assertRaisesRegex(ValueError, 'needs an uncompressed file'):
+            build_index(compressed, [0], ',')
+
+    def test_set_operations_probe_the_index(self):
+        kwargs = {'left_delim': ',', 'right_delim': ','}
+        runs = [(process_file_intersection, {'insert_cols': '1,2'}),
+                (process_file_intersection, {'lower_case': True, 'insert_cols': '1'}),
+                (process_file_diff, {}),
+                (process_file_diff, {'lower_case': True}),
+                (process_file_diff, {'build_side': 'right'})]
+        expected = [run(self.left_file, self.right_file, **kwargs, **options)
+                    for run, options in runs]
+        build_index(self.right_file, [0], ',').close()
+        build_index(self.right_file, [0], ',', lower_case=True).close()
+
+        # The keys are in a different order in the two files, and the output
+        # order is the same: right file order of the keys, then left file order
+        probed = [run(self.left_file, self.right_file, **kwargs, **options)
+                  for run, options in runs]
+        self.assertEqual(probed, expected)
+        self.assertEqual([row[:2] for row in probed[0]],
+                         [['k1', 'b'], ['k3', 'a'], ['k3', 'e'], ['k5', 'f']])
+
+        # Only the lookups of the most recent keys are cached
+        with mock.patch('fileops.hash_index.LOOKUP_CACHE_ENTRIES', 1), \
+                mock.patch('fileops.hash_index.HashIndex.first_row',
+                           autospec=True, side_effect=HashIndex.first_row) as first_row:
+            self.assertEqual(process_file_intersection(self.left_file, self.right_file,
+                                                       insert_cols='1,2', **kwargs),
+                             probed[0])
+            self.assertEqual(first_row.call_count, 6)
+            self.assertEqual(process_file_diff(self.left_file, self.right_file, **kwargs),
+                             expected[2])
+            self.assertEqual(first_row.call_count, 12)
+        with mock.patch('fileops.hash_index.HashIndex.first_row', return_value=None):
+            self.assertEqual(process_file_intersection(self.left_file, self.right_file,
+                                                       **kwargs), [])
+            self.assertEqual(len(process_file_diff(self.left_file, self.right_file, **kwargs)),
+                             6)
+
+    def test_main(self):
+        argv = ['hash_index.py', '-d', ',', '-k', '0,2', '-i', self.right_file]
+        with mock.patch('sys.argv', argv), \
+                mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            main()
+            main()
+        self.assertTrue(os.path.exists(index_path_for(self.right_file, [0, 2], True)))
+        self.assertEqual(stderr.getvalue().splitlines(),
+                         ['%s: indexed 5 rows' % self.right_file,
+                          '%s: index is up to date' % self.right_file])
+
+
+if __name__ == '__main__':
+    unittest.main()
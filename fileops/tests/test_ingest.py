@@ -0,0 +1,175 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from fileops import csv_unicode
+from fileops.file_diff import process_file_diff
+from fileops.file_intersection import process_file_intersection
+from fileops.file_select_ops import process_select_operations, process_multi_select_operations
+from fileops.ingest import ingest, load_cache, cache_path_for, iter_file_rows, main
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+        self.test_file = os.path.join(self.test_dir, 'sample.csv')
+        lines = ['name,category,value,price,city']
+        for i in range(300):
+            lines.append('item%d,%s,%d,%r,%s' % (i % 17, 'ABČD'[i % 4], i * 7 % 50,
+                                                 i * 0.37, ['Paris', '"New, York"'][i % 2]))
+        self.lines = lines
+        self.write_file(self.test_file, lines)
+
+        self.right_file = os.path.join(self.test_dir, 'right.csv')
+        self.write_file(self.right_file, ['item%d,%d' % (i, i * 10) for i in range(0, 30, 3)])
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_file(self, path, lines):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def parse(self, path):
+        with open(path, encoding='utf-8') as f:
+            return list(csv_unicode.UnicodeReader(f, delimiter=','))
+
+    def test_round_trip(self):
+        cache = ingest(self.test_file, ',')
+        self.assertEqual(cache.num_rows, 300)
+        self.assertEqual([cache.column(col).kind for col in range(5)],
+                         ['str', 'str', 'int', 'float', 'str'])
+        # The header is kept apart, so it doesn't turn numeric columns into text
+        self.assertEqual(cache.first_row, ['name', 'category', 'value', 'price', 'city'])
+        cache.close()
+
+        expected = self.parse(self.test_file)
+        self.assertEqual(list(iter_file_rows(self.test_file, ',')), expected)
+        projected = list(iter_file_rows(self.test_file, ',', cols=[1, 3]))
+        self.assertEqual(projected[1], ['', 'A', '', '0.0'])
+        self.assertEqual([row[3] for row in projected], [row[3] for row in expected])
+
+    def test_numbers_keep_their_text(self):
+        self.write_file(self.test_file, ['h', '10', '-3', '007'])
+        with ingest(self.test_file, ',') as cache:
+            # '007' isn't printed back as is, so the column is dictionary encoded
+            self.assertEqual(cache.column(0).kind, 'str')
+        self.assertEqual(list(iter_file_rows(self.test_file, ',')),
+                         [['h'], ['10'], ['-3'], ['007']])
+
+    def test_negative_zero(self):
+        self.write_file(self.test_file, ['x,name,value', '0.0,a,1', '-0.0,b,2', '0.0,c,4', '1.5,d,8'])
+        queries = [('0', '2', 'sum', None), ('1', '2', 'sum', ['0=0.0']),
+                   ('1', '2', 'count', ['0!=-0.0'])]
+        expected = [process_select_operations(self.test_file, *query, ',')
+                    for query in queries]
+        self.assertEqual(expected[0], [['0.0', '5.0'], ['-0.0', '2.0'], ['1.5', '8.0']])
+        with ingest(self.test_file, ',') as cache:
+            # -0.0 is equal to 0.0 as a number, so the column is dictionary encoded
+            self.assertEqual(cache.column(0).kind, 'str')
+        self.assertEqual([process_select_operations(self.test_file, *query, ',')
+                          for query in queries], expected)
+
+    def test_ragged_rows(self):
+        self.write_file(self.test_file, ['a,b,c', '1,x', '2,y,z,w', '', '3'])
+        with ingest(self.test_file, ',') as cache:
+            self.assertEqual(cache.min_width, 0)
+            self.assertFalse(cache.has_columns([0]))
+        self.assertEqual(list(iter_file_rows(self.test_file, ',')),
+                         self.parse(self.test_file))
+        self.assertEqual(list(iter_file_rows(self.test_file, ',', cols=[2])),
+                         [['a', 'b', 'c'], ['', ''], ['', '', 'z'], [], ['']])
+
+    def test_empty_file(self):
+        open(self.test_file, 'w').close()
+        with ingest(self.test_file, ',') as cache:
+            self.assertIsNone(cache.first_row)
+        self.assertEqual(list(iter_file_rows(self.test_file, ',')), [])
+
+    def test_stale_or_mismatching_cache_is_ignored(self):
+        ingest(self.test_file, ',').close()
+        self.assertIsNone(load_cache(self.test_file, '\t'))
+        self.assertIsNone(load_cache(self.test_file, ',', quoted=False))
+        load_cache(self.test_file, ',').close()
+
+        with open(self.test_file, 'a', encoding='utf-8') as f:
+            f.write('item99,Z,1,0.5,Rome\n')
+        self.assertIsNone(load_cache(self.test_file, ','))
+        self.assertEqual(list(iter_file_rows(self.test_file, ','))[-1],
+                         ['item99', 'Z', '1', '0.5', 'Rome'])
+
+    def test_compressed_file(self):
+        compressed = os.path.join(self.test_dir, 'sample.csv.gz')
+        with open(self.test_file, 'rb') as src, gzip.open(compressed, 'wb') as dst:
+            dst.write(src.read())
+        ingest(compressed, ',').close()
+        self.assertEqual(list(iter_file_rows(compressed, ',')), self.parse(self.test_file))
+
+    def test_select_operations_use_the_cache(self):
+        queries = [('0', '2', 'sum', None), ('1,4', '3,2', 'sum', ['1=A,Č', '4!=Paris']),
+                   ('4', '2', 'count', ['2=7,14']), ('1', '3', 'max', None),
+                   ('1', '0', 'count_distinct', None), ('0', '3,3', 'sum', ['3=0.37,0.74'])]
+        expected = [process_select_operations(self.test_file, *query, ',')
+                    for query in queries]
+        expected_spilled = process_select_operations(self.test_file, '1', '2', 'sum', None,
+                                                     ',', memory_limit=1)
+        multi = [{'select_cols': '1', 'aggregate_cols': '2', 'aggregate_function': 'sum',
+                  'where_clauses': ['4=Paris'], 'having': None, 'order_by': '1:desc',
+                  'limit': 2}]
+        expected_multi = process_multi_select_operations(self.test_file, multi, ',')
+        ingest(self.test_file, ',').close()
+
+        with mock.patch('fileops.csv_unicode.UnicodeReader') as reader:
+            for query, result in zip(queries, expected):
+                self.assertEqual(process_select_operations(self.test_file, *query, ','),
+                                 result)
+            self.assertEqual(process_select_operations(
+                self.test_file, '1', '2', 'sum', None, ',', memory_limit=1), expected_spilled)
+            self.assertEqual(process_multi_select_operations(self.test_file, multi, ','),
+                             expected_multi)
+            reader.assert_not_called()
+
+    def test_set_operations_use_the_cache(self):
+        kwargs = {'left_delim': ',', 'right_delim': ',', 'insert_cols': '1'}
+        expected = [process_file_intersection(self.test_file, self.right_file, **kwargs),
+                    process_file_intersection(self.test_file, self.right_file,
+                                              build_side='right', **kwargs),
+                    process_file_intersection(self.test_file, self.right_file,
+                                              algorithm='sort', **kwargs),
+                    process_file_diff(self.test_file, self.right_file, left_delim=',',
+                                      right_delim=','),
+                    process_file_diff(self.test_file, self.right_file, left_delim=',',
+                                      right_delim=',', build_side='right')]
+        ingest(self.test_file, ',').close()
+        ingest(self.right_file, ',').close()
+
+        with mock.patch('fileops.csv_unicode.UnicodeReader') as reader:
+            result = [process_file_intersection(self.test_file, self.right_file, **kwargs),
+                      process_file_intersection(self.test_file, self.right_file,
+                                                build_side='right', **kwargs),
+                      process_file_intersection(self.test_file, self.right_file,
+                                                algorithm='sort', **kwargs),
+                      process_file_diff(self.test_file, self.right_file, left_delim=',',
+                                        right_delim=','),
+                      process_file_diff(self.test_file, self.right_file, left_delim=',',
+                                        right_delim=',', build_side='right')]
+            reader.assert_not_called()
+        self.assertEqual(result, expected)
+
+    def test_main(self):
+        with mock.patch('sys.argv', ['ingest.py', '-d', ',', self.test_file]), \
+                mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            main()
+            main()
+        self.assertTrue(os.path.isdir(cache_path_for(self.test_file)))
+        self.assertEqual(stderr.getvalue().splitlines(),
+                         ['%s: cached 300 rows of 5 columns' % self.test_file,
+                          '%s: cache is up to date' % self.test_file])
+
+
+if __name__ == '__main__':
+    unittest.main()
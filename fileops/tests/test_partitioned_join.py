@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+from fileops.file_diff import process_file_diff
+from fileops.file_intersection import process_file_intersection
+from fileops.partitioned_join import iter_partitioned_diff, iter_partitioned_intersection
+
+
+class TestPartitionedJoin(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+        # Duplicate keys on both sides, in a scrambled order
+        self.left_file = os.path.join(self.test_dir, 'left.tsv')
+        with open(self.left_file, 'w', encoding='utf-8') as f:
+            for i in range(300):
+                f.write('k%d\tleft%d\n' % ((i * 7) % 97, i))
+
+        self.right_file = os.path.join(self.test_dir, 'right.tsv')
+        with open(self.right_file, 'w', encoding='utf-8') as f:
+            for i in range(100):
+                f.write('K%d\tright%d\n' % ((i * 11) % 71, i))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_intersection_matches_single_process(self):
+        expected = process_file_intersection(self.left_file, self.right_file,
+                                             lower_case=True, insert_cols='1')
+        result = list(iter_partitioned_intersection(
+            self.left_file, self.right_file, [0], [0], '\t', '\t', True, [1], jobs=3))
+        self.assertTrue(expected)
+        self.assertEqual(result, expected)
+
+    def test_diff_matches_single_process(self):
+        expected = process_file_diff(self.left_file, self.right_file, lower_case=True)
+        result = list(iter_partitioned_diff(
+            self.left_file, self.right_file, [0], [0], '\t', '\t', True, jobs=3))
+        self.assertTrue(expected)
+        self.assertEqual(result, expected)
+
+    def test_unordered_output(self):
+        expected = process_file_diff(self.left_file, self.right_file, lower_case=True)
+        result = process_file_diff(self.left_file, self.right_file, lower_case=True,
+                                   jobs=4, preserve_order=False)
+        self.assertEqual(sorted(result), sorted(expected))
+
+    def test_empty_files(self):
+        open(self.left_file, 'w').close()
+        open(self.right_file, 'w').close()
+        result = process_file_intersection(self.left_file, self.right_file, jobs=2)
+        self.assertEqual(result, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
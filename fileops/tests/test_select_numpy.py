@@ -0,0 +1,91 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from fileops.file_select_ops import process_select_operations
+from fileops.ingest import ingest
+from fileops.select_numpy import iter_select_operations_numpy, np
+
+
+@unittest.skipIf(np is None, 'NumPy is not installed')
+class TestSelectNumpy(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+        # Values whose floating point sums depend on the order of the additions
+        rng = random.Random(42)
+        self.test_file = os.path.join(self.test_dir, 'sample.tsv')
+        with open(self.test_file, 'w', encoding='utf-8') as f:
+            f.write("name\tcategory\tvalue\tcity\n")
+            for i in range(5000):
+                f.write('%s\t%s\t%r\t%s\n' % (
+                    rng.choice(['item1', 'itemČ', 'itemÖ', 'itemØ']),
+                    rng.choice('ABCDEFGHIJ'),
+                    rng.uniform(-1e6, 1e6) * 10 ** rng.randint(-8, 8),
+                    rng.choice(['New York', 'London', 'Paris', 'Berlin'])))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def assertSameOutput(self, select_cols, aggregate_cols, agg_function, where_clauses):
+        expected = process_select_operations(self.test_file, select_cols, aggregate_cols,
+                                             agg_function, where_clauses, '\t')
+        result = process_select_operations(self.test_file, select_cols, aggregate_cols,
+                                           agg_function, where_clauses, '\t', engine='numpy')
+        self.assertTrue(expected)
+        self.assertEqual(result, expected)
+
+    def test_sum(self):
+        self.assertSameOutput('1', '2', 'sum', None)
+
+    def test_count(self):
+        self.assertSameOutput('0,1', '2,1', 'count', None)
+
+    def test_where_clauses(self):
+        self.assertSameOutput('0,3', '2', 'sum', ['1=A,B,C', '3!=Paris'])
+
+    def test_repeated_aggregate_column(self):
+        self.assertSameOutput('1', '2,2', 'sum', None)
+
+    def test_small_chunks(self):
+        # Groups first seen in later chunks, and chunks where no row matches
+        expected = process_select_operations(self.test_file, '1,3', '2', 'sum', ['0=itemÖ'], '\t')
+        result = list(iter_select_operations_numpy(
+            self.test_file, [1, 3], [2], 'sum', {0: {'op': 'IN', 'vals': ['itemÖ']}}, '\t',
+            chunk_rows=7))
+        self.assertEqual(result, expected)
+
+    def test_no_rows_match_where(self):
+        self.assertEqual(process_select_operations(self.test_file, '1', '2', 'sum', ['1=X'],
+                                                   '\t', engine='numpy'), [])
+
+    def test_ragged_rows(self):
+        # Rows too short for the query are fine if the where clauses drop them
+        with open(self.test_file, 'w', encoding='utf-8') as f:
+            f.write('name,category,value\nx,A,1\ny\nx,B,2\nz,C\n')
+        for engine in ('python', 'numpy'):
+            self.assertEqual(process_select_operations(
+                self.test_file, '0', '2', 'sum', ['0=x'], ',', engine=engine), [['x', '3.0']])
+            self.assertEqual(process_select_operations(
+                self.test_file, '0', '2', 'count', ['0!=y,z'], ',', engine=engine)[0],
+                ['x', '2'])
+            with self.assertRaises(IndexError):
+                process_select_operations(self.test_file, '0', '2', 'sum', ['0=x,z'], ',',
+                                          engine=engine)
+
+    def test_columnar_cache(self):
+        queries = [('1', '2', 'sum', None), ('0,1', '2,1', 'count', None),
+                   ('0,3', '2', 'sum', ['1=A,B,C', '3!=Paris']), ('1', '2,2', 'sum', None),
+                   ('3', '1', 'count', ['1=X'])]
+        expected = [process_select_operations(self.test_file, *query, '\t')
+                    for query in queries]
+        ingest(self.test_file).close()
+        for query, result in zip(queries, expected):
+            self.assertEqual(process_select_operations(self.test_file, *query, '\t',
+                                                       engine='numpy'), result)
+
+
+if __name__ == '__main__':
+    unittest.main()
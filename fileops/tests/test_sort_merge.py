@@ -0,0 +1,68 @@
+import unittest
+from unittest import mock
+from fileops import sort_merge
+from fileops.sort_merge import external_sort, merge_join, merge_anti_join, check_sorted
+
+
+class TestSortMerge(unittest.TestCase):
+    def _records(self, keys):
+        return [(key, seq, [key, str(seq)]) for seq, key in enumerate(keys)]
+
+    def test_external_sort_in_memory(self):
+        records = self._records(['c', 'a', 'b', 'a'])
+        result = list(external_sort(iter(records)))
+        self.assertEqual(result, sorted(records))
+
+    def test_external_sort_spills_runs(self):
+        keys = ['k%03d' % ((i * 37) % 101) for i in range(500)]
+        records = self._records(keys)
+        # A tiny memory limit forces one run per record, and multiple merge passes
+        result = list(external_sort(iter(records), memory_limit=1))
+        self.assertEqual(result, sorted(records))
+
+    def test_external_sort_runs_are_half_the_limit(self):
+        records = [('k%03d' % ((i * 37) % 101), i, ['x']) for i in range(100)]
+        # Each record counts as 261 bytes
+        run_sizes = []
+        write_run = sort_merge._write_run
+
+        def spy(buffer, run_dir, num):
+            run_sizes.append(len(buffer))
+            return write_run(buffer, run_dir, num)
+
+        with mock.patch('fileops.sort_merge._write_run', side_effect=spy):
+            result = list(external_sort(iter(records), memory_limit=261 * 20))
+        self.assertEqual(result, sorted(records))
+        self.assertEqual(run_sizes, [10] * 10)
+
+    def test_merge_join(self):
+        left = sorted(self._records(['a', 'b', 'b', 'd']))
+        right = sorted([('b', 0, ['b', 'first']), ('b', 1, ['b', 'second']),
+                        ('c', 2, ['c', 'x']), ('d', 3, ['d', 'y'])])
+        result = list(merge_join(iter(left), iter(right), [1]))
+        self.assertEqual(result, [['b', '1', 'first'], ['b', '2', 'first'],
+                                  ['d', '3', 'y']])
+
+    def test_merge_anti_join(self):
+        left = sorted(self._records(['a', 'b', 'b', 'd', 'e']))
+        right = sorted(self._records(['b', 'c', 'd']))
+        result = list(merge_anti_join(iter(left), iter(right)))
+        self.assertEqual(result, [['a', '0'], ['e', '4']])
+
+    def test_check_sorted(self):
+        records = self._records(['a', 'b', 'b', 'c'])
+        self.assertEqual(list(check_sorted(iter(records), 'f')), records)
+        checked = check_sorted(iter(self._records(['a', 'c', 'b'])), 'f')
+        self.assertEqual(next(checked)[0], 'a')
+        self.assertEqual(next(checked)[0], 'c')
+        with self.assertRaisesRegex(ValueError, "f is not sorted by key: row 3 has key 'b'"):
+            next(checked)
+
+    def test_empty_inputs(self):
+        self.assertEqual(list(merge_join(iter([]), iter([]), [])), [])
+        self.assertEqual(list(merge_anti_join(iter(self._records(['a'])), iter([]))),
+                         [['a', '0']])
+
+
+if __name__ == '__main__':
+    unittest.main()
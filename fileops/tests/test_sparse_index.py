@@ -0,0 +1,81 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from fileops.file_searcher import Searcher
+from fileops.sparse_index import build_index, load_index, index_path_for, main
+
+
+class TestSparseIndex(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+        self.test_file = os.path.join(self.test_dir, 'sorted.txt')
+        self.lines = sorted(['key%04d\tcafé %d' % (i * 7 % 1000, i) for i in range(500)] +
+                            ['key', 'key0', 'ke'])
+        with open(self.test_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.lines) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_build_and_load(self):
+        built = build_index(self.test_file, interval=10, prefix_bytes=5)
+        self.assertTrue(os.path.exists(index_path_for(self.test_file)))
+        self.assertEqual(len(built.offsets), 51)
+
+        loaded = load_index(self.test_file)
+        self.assertEqual(loaded.keys, built.keys)
+        self.assertEqual(loaded.offsets, built.offsets)
+        self.assertEqual(loaded.keys[0], b'ke')
+
+    def test_stale_index_is_ignored(self):
+        build_index(self.test_file)
+        with open(self.test_file, 'a', encoding='utf-8') as f:
+            f.write('zzz\n')
+        self.assertIsNone(load_index(self.test_file))
+
+    def test_missing_index(self):
+        self.assertIsNone(load_index(self.test_file))
+
+    def test_searcher_uses_index(self):
+        # Short key prefixes, so many index entries compare equal to the probes
+        build_index(self.test_file, interval=3, prefix_bytes=5)
+        prefixes = ['k', 'ke', 'key', 'key0', 'key00', 'key01', 'key0140', 'key0140\tcafé',
+                    'key0999', 'key1', 'a', 'z']
+        for use_mmap in (True, False):
+            with Searcher(self.test_file, use_mmap=use_mmap, use_index=False) as plain, \
+                    Searcher(self.test_file, use_mmap=use_mmap) as indexed:
+                self.assertIsNone(plain.index)
+                self.assertIsNotNone(indexed.index)
+                many = indexed.find_many(prefixes)
+                for prefix in prefixes:
+                    expected = [line for line in self.lines if line.startswith(prefix)]
+                    self.assertEqual(plain.find(prefix), expected, prefix)
+                    self.assertEqual(indexed.find(prefix), expected, prefix)
+                    self.assertEqual(many[prefix], expected, prefix)
+
+        # In text mode too, the index narrows down the lines read by the search
+        num_reads = []
+        for use_index in (False, True):
+            with Searcher(self.test_file, use_index=use_index) as searcher:
+                with mock.patch.object(searcher, '_read_line_at_pos',
+                                       wraps=searcher._read_line_at_pos) as read_line_at_pos:
+                    self.assertEqual(len(searcher.find('key0140')), 1)
+                num_reads.append(read_line_at_pos.call_count)
+        self.assertLess(num_reads[1], num_reads[0])
+
+    def test_main_refreshes_stale_index(self):
+        with mock.patch('sys.argv', ['sparse_index.py', '-n', '100', self.test_file]), \
+                mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            main()
+            main()
+        self.assertEqual(stderr.getvalue(),
+                         '%s: indexed 6 lines\n%s: index is up to date\n'
+                         % (self.test_file, self.test_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,12 @@ setup(
     python_requires='>=3.6',
     install_requires=[],
     extras_require={
+        'numpy': [
+            'numpy>=1.17',
+        ],
+        'yaml': [
+            'PyYAML>=5.1',
+        ],
         'test': [
             'pytest>=6.0.0',
             'pytest-cov>=2.10.0',